@@ -21,14 +21,15 @@ import lockfile
 import sys
 import os
 import json
-import re
 import traceback
 from bluepy import btle
 
 sys.path.insert(0, 'lib/python')
 
-from google_cloud import GoogleCsvUploader
+from google_cloud import GoogleCsvUploader, RollingCsvUploader
 from fujitsu_packet_processor import FujitsuPacketProcessor
+from tag_aggregator import TagAggregator
+from upload_spool import SpoolReplayer, UploadSpool
 from logger import DreamAssetsLogger
 import packet_decoder
 import dream_environment
@@ -37,7 +38,6 @@ env = dream_environment.fetch()
 
 
 class ScanFujitsu(btle.DefaultDelegate):
-    fujitsu_packet_regex = re.compile(r'010003000300')
 
     def __init__(self, opts, processor, logger=None):
         btle.DefaultDelegate.__init__(self)
@@ -80,17 +80,22 @@ class ScanFujitsu(btle.DefaultDelegate):
         # in dBm's
 
         packet_payload = self.extract_packet_payload(packet)
-        # if the packet matches a fujitsu packet, i.e., has the regex 010003000300
-        if re.search(self.fujitsu_packet_regex, packet_payload):
+        # fast_decode only returns a reading if the packet is a fujitsu packet,
+        # i.e., has 010003000300 right before the measurements
+        reading = packet_decoder.fast_decode(packet_payload)
+        if reading:
             # We transform a `packet` with meaningless binary values (0x0123)
             # into a `measurement` with meaningful decimal values (72 degF)
             measurement = {
                 'tag_id': packet.addr.replace(':', ''),
                 'rssi': packet.rssi,
-                'hub_id': env['host']
+                'hub_id': env['host'],
+                # acceleration/temperature data which we've decoded from the payload
+                'temperature': reading.temperature,
+                'x_acc': reading.x_acc,
+                'y_acc': reading.y_acc,
+                'z_acc': reading.z_acc
             }
-            # Add acceleration/temperature data which we've decoded from payload to measurement
-            measurement.update(packet_decoder.decode(packet_payload))
             # add measurement to our processor
             # why do we have a processor? what does it do exactly? why does it do the uploading?
             self.processor.addMeasurement(measurement)
@@ -122,8 +127,40 @@ class DreamCollector():
     def __init__(self, options, env, **kwargs):
         self.options = options
         self.uploader = None
+        self.replayer = None
         self.logger = kwargs.get('logger', None)
-        if not options.scan_only:
+        # a row per tag per scan window instead of every measurement, set per deployment
+        aggregate = (options.output or env['output']) == 'aggregate'
+        bq_table = env['bq_aggregate_table'] if aggregate else env['bq_table']
+        spool, spool_dir = options.spool, options.spool_dir
+        if aggregate:
+            # aggregates have columns of their own, so they get spools of their own
+            spool = "%s.aggregates%s" % os.path.splitext(spool)
+            spool_dir = spool_dir and spool_dir.rstrip('/') + '-aggregates'
+        upload_spool = None
+        if not options.scan_only and spool_dir:
+            # store and forward: objects go to the spool directory, the replayer uploads them
+            upload_spool = UploadSpool(spool_dir, options.spool_max_bytes, gzip_level=options.gzip_level,
+                                       logger=self.logger)
+        if not options.scan_only and options.roll_seconds > 0:
+            # bundles go into a local spool that is uploaded as one bigger object
+            self.uploader = RollingCsvUploader(
+                env['project_id'],
+                env['credentials'],
+                env['host'],
+                env['bucket'],
+                env['directory'],
+                env['bq_dataset'],
+                bq_table,
+                spool=spool,
+                roll_bytes=options.roll_bytes,
+                roll_seconds=options.roll_seconds,
+                upload_spool=upload_spool,
+                gzip_level=options.gzip_level,
+                aggregates=aggregate,
+                big_query_update=options.big_query_update,
+                logger=self.logger)
+        elif not options.scan_only:
             self.uploader = GoogleCsvUploader(
                 env['project_id'],
                 env['credentials'],
@@ -131,19 +168,40 @@ class DreamCollector():
                 env['bucket'],
                 env['directory'],
                 env['bq_dataset'],
-                env['bq_table'],
+                bq_table,
+                upload_spool=upload_spool,
+                gzip_level=options.gzip_level,
+                aggregates=aggregate,
                 big_query_update=options.big_query_update,
                 logger=self.logger)
-        self.processor = FujitsuPacketProcessor(options, self.uploader, logger=self.logger)
+        if upload_spool:
+            self.replayer = SpoolReplayer(upload_spool, self.uploader.upload_spooled,
+                                          concurrency=options.replay_uploads,
+                                          max_failures=options.replay_max_failures, logger=self.logger)
+        self.processor = FujitsuPacketProcessor(options, self.uploader, logger=self.logger,
+                                                aggregator=TagAggregator() if aggregate else None)
         self.fujitsu_listener = ScanFujitsu(options, self.processor, self.logger)
-        self.scanner = btle.Scanner(options.hci).withDelegate(self.fujitsu_listener)
+        if options.replay_tags:
+            # load testing: replay synthetic advertisements instead of listening to the radio
+            sys.path.insert(0, 'sobun')
+            from dream.replay import ReplayScanner, tag_population
+            source = tag_population(tags=options.replay_tags)
+            self.scanner = ReplayScanner(source, rate=options.replay_rate).withDelegate(self.fujitsu_listener)
+        else:
+            self.scanner = btle.Scanner(options.hci).withDelegate(self.fujitsu_listener)
 
 
     def shutdown(self, sig, frame):
         self.logger.debug("Caught signal {}".format(sig))
-        self.processor and self.processor.flush()
+        # run() flushes and stops the uploads on its way out, once
         sys.exit(0)
 
+    def stop_replayer(self):
+        # whatever isn't uploaded yet stays in the spool for the next run
+        if self.replayer:
+            self.replayer.stop(timeout=self.options.time_per_scan)
+            self.logger.info("Spool: %s" % self.replayer.stats())
+
     def timed_scan_and_flush(self, scan_time):
         self.logger.debug("Scan for %d seconds..." % scan_time)
         # The code below `scanner.scan()` is very much like
@@ -156,7 +214,10 @@ class DreamCollector():
         self.scanner.scan(scan_time)
         self.logger.debug("done")
         self.logger.debug("Flushing packets...")
+        # this only queues the bundle, the upload happens while we scan again
         self.processor.flush()
+        self.logger.debug("Uploads: %s" % self.processor.stats())
+        self.replayer and self.logger.debug("Spool: %s" % self.replayer.stats())
 
     def run(self):
         uploader = None
@@ -165,6 +226,7 @@ class DreamCollector():
         print("Scanning for Fujitsu Packets...")
 
         scan_time = self.options.time_per_scan
+        self.replayer and self.replayer.start()
         try:
             self.logger.debug("Sanity check scan for 10 seconds...")
             self.timed_scan_and_flush(10)
@@ -180,7 +242,10 @@ class DreamCollector():
             self.logger.fatal(backtrace)
         finally:
             self.logger.info("Flushing remaining measurements")
-            self.processor.flush()
+            # give the queued uploads a moment, but don't hang on a dead connection
+            self.processor.close(timeout=self.options.time_per_scan)
+            self.logger.info("Uploads: %s" % self.processor.stats())
+            self.stop_replayer()
         self.logger.info("Done scanning")
 
 def main():
@@ -199,6 +264,33 @@ def main():
     #maybe increase the default bundle size to 1000?
     parser.add_argument('-b', '--bundle-size', type=int,
                         help='Number of measurements to send in each bundle', default=100)
+    # uploads run in the background while we scan; this is how many bundles may wait for one
+    parser.add_argument('--upload-queue', type=int, default=10,
+                        help='Number of bundles that can wait for an upload before new ones are dropped')
+    # one object per bundle is a lot of tiny objects, so bundles are spooled and
+    # uploaded together every --roll-seconds, or sooner once they add up to --roll-bytes
+    parser.add_argument('--roll-seconds', type=int, default=60,
+                        help='Upload the spooled bundles after this many seconds. 0 uploads every bundle as its own object')
+    parser.add_argument('--roll-bytes', type=int, default=1000000,
+                        help='Upload the spooled bundles once they are this big')
+    parser.add_argument('--spool', default='dream_spool.csv',
+                        help='File the bundles are spooled in until they are uploaded')
+    # objects wait in the spool directory until they're uploaded, so nothing is lost while
+    # the network is down. When the spool outgrows --spool-max-bytes the oldest files go
+    parser.add_argument('--spool-dir', default='spool',
+                        help='Directory objects wait in until they are uploaded. Empty to upload straight away')
+    parser.add_argument('--spool-max-bytes', type=int, default=100000000,
+                        help='Disk space for the spool, the oldest files are deleted past it')
+    parser.add_argument('--replay-uploads', type=int, default=2,
+                        help='Number of spooled files uploaded at once')
+    parser.add_argument('--replay-max-failures', type=int, default=5,
+                        help='Failed uploads of a spooled file, network outages aside, before it is moved to the spool\'s failed directory')
+    # gzipped CSV is several times smaller over cellular, GCS serves it decompressed
+    parser.add_argument('--gzip-level', type=int, default=6,
+                        help='Compression level (1-9) for uploaded objects. 0 uploads plain CSV')
+    # asset tracking rarely needs every advert, a row per tag per scan is enough
+    parser.add_argument('--output', choices=['raw', 'aggregate'], default=None,
+                        help="Upload every measurement (raw) or a row per tag per scan (aggregate). Default: COLLECTOR_OUTPUT in secrets/environment.py, else raw")
     # always leave this off
     parser.add_argument('--big-query-update', action='store_true', help="Enable the BigQuery update notification after new data has been sent to Google. Default: false")
     # scan-only is useful in debugging. Must be used with verbose -v mode so you can see the output
@@ -210,6 +302,11 @@ def main():
     # ps -ef | grep python
     parser.add_argument('-d', '--daemonize', action='store_true',
                         help='Run as a daemon in the background')
+    # replay is for load testing on a machine without BLE. Use it with -S so nothing gets uploaded.
+    parser.add_argument('--replay-tags', type=int, default=0,
+                        help='Replay advertisements from this many synthetic tags instead of scanning')
+    parser.add_argument('--replay-rate', type=float, default=None,
+                        help='Advertisements per second to replay. Default: as fast as possible')
     # verbose mode shows the output on the terminal screen. super helpful.
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Increase output verbosity')
@@ -228,6 +325,14 @@ def main():
         parser.print_help()
         exit(1);
 
+    # aggregates go to a table of their own, BigQuery can't load them into the raw one
+    if (arg.output or env['output']) == 'aggregate' and arg.big_query_update and not arg.scan_only \
+            and not env['bq_aggregate_table']:
+        print("***", file=sys.stderr)
+        print("*** Aggregate output with --big-query-update needs GOOGLE_BQ_AGGREGATE_TABLE in secrets/environment.py", file=sys.stderr)
+        print("***", file=sys.stderr)
+        exit(1)
+
     if arg.verbose:
         print("Command-line arguments:")
         print(repr(arg))
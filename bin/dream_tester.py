@@ -81,7 +81,8 @@ def main():
             print(msg, file=sys.stderr)
             pass
 
-    processor.flush()
+    # flushes and waits for the upload
+    processor.close()
     logger.info("Done")
 
 
@@ -15,6 +15,10 @@ def fetch():
       'directory': env.SECRETS["GOOGLE_DIRECTORY"] or os.getenv("GOOGLE_DIRECTORY"),
       'bq_dataset': env.SECRETS["GOOGLE_BQ_DATASET"] or os.getenv("GOOGLE_BQ_DATASET"),
       'bq_table': env.SECRETS["GOOGLE_BQ_TABLE"] or os.getenv("GOOGLE_BQ_TABLE"),
+      # only with 'COLLECTOR_OUTPUT': 'aggregate', see TagAggregator for its columns
+      'bq_aggregate_table': env.SECRETS.get("GOOGLE_BQ_AGGREGATE_TABLE") or os.getenv("GOOGLE_BQ_AGGREGATE_TABLE"),
+      # 'raw' uploads every measurement, 'aggregate' a row per tag per scan window
+      'output': env.SECRETS.get("COLLECTOR_OUTPUT") or os.getenv("COLLECTOR_OUTPUT") or 'raw',
       'host': env.SECRETS.get("HUB_ID", socket.gethostname())
     }
     if not os.path.isfile(settings['credentials']):
@@ -1,11 +1,26 @@
 import re
+import threading
 import time
 
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
+
 # This class processes measurements by collecting them in
 # bundle and when the bundle is the right size, upload them via the
 # uploader (which is passed in when we construct the instance of the
 # processor)
 #
+# The uploads happen on a worker thread, so the scanner starts listening again
+# right after a flush instead of waiting for a slow cellular upload. Finished
+# bundles wait in a queue of `upload_queue` bundles; when the uploads can't keep
+# up and the queue is full, the newest bundle is dropped (and counted).
+#
+# With an `aggregator` (a TagAggregator), measurements are folded into per-tag
+# aggregates as they come in, and a flush uploads one row per tag instead of the
+# raw measurements.
+#
 # kwargs means keyword argument
 class FujitsuPacketProcessor():
     fujitsu_packet_regex = re.compile(r'010003000300')
@@ -17,17 +32,98 @@ class FujitsuPacketProcessor():
         self.opts = opts
         self.uploader = uploader
         self.logger = kwargs.get('logger', None)
+        self.uploads = Queue(kwargs.get('upload_queue', getattr(opts, 'upload_queue', 10)))
+        self.aggregator = kwargs.get('aggregator', None)
+        self.worker = None
+        # counters for stats()
+        self.uploaded = 0
+        self.failed = 0
+        self.dropped = 0
+        self.dropped_measurements = 0
+        self.upload_seconds = 0.0
+        self.last_upload_seconds = None
 
     def addMeasurement(self, measurement):
         measurement.update({'timestamp': time.time()})
-        self.bundle.append(measurement)
+        if self.aggregator is not None:
+            self.aggregator.add(measurement)
+        else:
+            self.bundle.append(measurement)
 
     def flush(self):
         self.upload_and_reset()
 
     def upload_and_reset(self):
+        if self.aggregator is not None:
+            self.bundle = self.aggregator.flush()
         if (len(self.bundle) > 0):
-            self.uploader and self.uploader.package_and_upload(self.bundle)
+            self.uploader and self.enqueue(self.bundle)
             self.bundle = []
         else:
-            self.logger.warn("Nothing to upload")
+            self.logger and self.logger.warn("Nothing to upload")
+
+    def enqueue(self, bundle):
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self.upload_worker, name="uploader")
+            self.worker.daemon = True
+            self.worker.start()
+        try:
+            self.uploads.put_nowait(bundle)
+        except Full:
+            # an aggregate row stands for `count` measurements
+            measurements = sum(row['count'] for row in bundle) if self.aggregator is not None else len(bundle)
+            self.dropped += 1
+            self.dropped_measurements += measurements
+            self.logger and self.logger.warn("Upload queue is full, dropped a bundle of %d measurements" % measurements)
+
+    def upload_worker(self):
+        while True:
+            bundle = self.uploads.get()
+            if bundle is None:
+                return
+            started = time.time()
+            try:
+                self.uploader.package_and_upload(bundle)
+                self.uploaded += 1
+            except Exception as e:
+                # one failed upload shouldn't stop the ones after it
+                self.failed += 1
+                self.logger and self.logger.error("Failed to upload a bundle of %d measurements: %s" % (len(bundle), e))
+            self.last_upload_seconds = time.time() - started
+            self.upload_seconds += self.last_upload_seconds
+
+    def stats(self):
+        done = self.uploaded + self.failed
+        stats = self.aggregator.stats() if self.aggregator is not None else {}
+        stats.update({
+            'queue_depth': self.uploads.qsize(),
+            'uploaded': self.uploaded,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'dropped_measurements': self.dropped_measurements,
+            'last_upload_seconds': self.last_upload_seconds,
+            'mean_upload_seconds': self.upload_seconds / done if done else None,
+        })
+        return stats
+
+    def close(self, timeout=None):
+        """ Flushes, then waits up to `timeout` seconds for the queued uploads to finish """
+        self.flush()
+        if self.worker is not None:
+            # the queue and the uploads share one deadline, close() may run in a signal handler
+            deadline = None if timeout is None else time.time() + timeout
+            try:
+                self.uploads.put(None, timeout=time_left(deadline))
+            except Full:
+                # the worker is still busy with the backlog and keeps the queue
+                return
+            self.worker.join(time_left(deadline))
+            if self.worker.is_alive():
+                return
+            self.worker = None
+        # e.g. the rolling uploader sends what it has spooled
+        self.uploader and self.uploader.close()
+
+
+def time_left(deadline):
+    return None if deadline is None else max(0, deadline - time.time())
@@ -0,0 +1,120 @@
+import threading
+import time
+
+from fujitsu_packet_processor import FujitsuPacketProcessor
+from tag_aggregator import TagAggregator
+
+
+class BlockingUploader(object):
+    """ Holds every upload until release is set, like a stalled cellular connection """
+
+    def __init__(self):
+        self.uploading = threading.Event()
+        self.release = threading.Event()
+        self.bundles = []
+        self.closed = False
+
+    def package_and_upload(self, bundle):
+        self.uploading.set()
+        self.release.wait(5)
+        if bundle[0].get('fail'):
+            raise IOError("upload failed")
+        self.bundles.append(bundle)
+
+    def close(self):
+        self.closed = True
+
+
+def make_measurement(**kwargs):
+    measurement = dict(hub_id='hub', tag_id='tag', temperature=20.0, x_acc=0.0, y_acc=0.0, z_acc=1.0, rssi=-60)
+    measurement.update(kwargs)
+    return measurement
+
+
+def scan(processor, count, **kwargs):
+    for i in range(count):
+        processor.addMeasurement(make_measurement(**kwargs))
+    processor.flush()
+
+
+def test_a_full_upload_queue_drops_the_newest_bundle():
+    uploader = BlockingUploader()
+    processor = FujitsuPacketProcessor(None, uploader, upload_queue=1)
+    scan(processor, 3)
+    # the worker holds the first bundle, the second waits, the third has no room
+    uploader.uploading.wait(1)
+    scan(processor, 4)
+    scan(processor, 5)
+    stats = processor.stats()
+    assert (stats['queue_depth'], stats['dropped'], stats['dropped_measurements']) == (1, 1, 5)
+
+    uploader.release.set()
+    processor.close(timeout=1)
+    assert [len(bundle) for bundle in uploader.bundles] == [3, 4]
+    assert processor.stats()['uploaded'] == 2
+    assert uploader.closed
+
+
+def test_a_dropped_bundle_of_aggregates_counts_the_measurements_behind_them():
+    uploader = BlockingUploader()
+    processor = FujitsuPacketProcessor(None, uploader, upload_queue=1, aggregator=TagAggregator())
+    scan(processor, 3)
+    uploader.uploading.wait(1)
+    scan(processor, 4)
+    # 2 rows standing for 10 measurements
+    for tag_id in ['a', 'b']:
+        for i in range(5):
+            processor.addMeasurement(make_measurement(tag_id=tag_id))
+    processor.flush()
+    stats = processor.stats()
+    assert (stats['dropped'], stats['dropped_measurements']) == (1, 10)
+    assert (stats['aggregated_measurements'], stats['aggregates']) == (17, 4)
+    uploader.release.set()
+    processor.close(timeout=1)
+
+
+def test_a_failed_upload_doesnt_stop_the_ones_after_it():
+    uploader = BlockingUploader()
+    uploader.release.set()
+    processor = FujitsuPacketProcessor(None, uploader)
+    scan(processor, 2, fail=True)
+    scan(processor, 3)
+    processor.close(timeout=1)
+    stats = processor.stats()
+    assert (stats['uploaded'], stats['failed']) == (1, 1)
+    assert [len(bundle) for bundle in uploader.bundles] == [3]
+
+
+def test_close_returns_within_its_timeout_while_an_upload_hangs():
+    uploader = BlockingUploader()
+    processor = FujitsuPacketProcessor(None, uploader, upload_queue=1)
+    scan(processor, 1)
+    uploader.uploading.wait(1)
+    scan(processor, 1)
+    # the queue is full, so the stop marker can't go in either
+    started = time.time()
+    processor.close(timeout=0.2)
+    assert time.time() - started < 0.35
+    worker = processor.worker
+    assert worker.is_alive() and not uploader.closed
+
+    # a bundle after that goes to the same worker, not a second one
+    scan(processor, 1)
+    assert processor.worker is worker
+
+    uploader.release.set()
+    processor.close(timeout=1)
+    assert processor.worker is None and uploader.closed
+
+
+def test_a_new_worker_starts_after_close():
+    uploader = BlockingUploader()
+    uploader.release.set()
+    processor = FujitsuPacketProcessor(None, uploader)
+    scan(processor, 1)
+    processor.close(timeout=1)
+    assert processor.worker is None
+
+    scan(processor, 2)
+    processor.close(timeout=1)
+    assert [len(bundle) for bundle in uploader.bundles] == [1, 2]
@@ -1,7 +1,12 @@
 from google.cloud import storage, bigquery
 import google.api_core.exceptions as exceptions
+import gzip
+import io
+import os
+import shutil
 import time
 import six
+from tag_aggregator import TagAggregator
 
 # We originally had the Hub interact with BigQuery 
 # but we've disabled this by default. We don't really use this code. 
@@ -41,30 +46,59 @@ class GoogleBigQuery:
       self.logger and self.logger.error("[job: %s] failed %s" % (job_id, bad_request))
 
 
+# Bundles are written a few hundred rows at a time into a buffer that's kept between
+# uploads, gzipped on the way at `gzip_level` (0 leaves them plain), and uploaded
+# from that buffer with Content-Encoding: gzip. GCS serves the objects decompressed
+# and BigQuery loads them as they are, while the cellular link carries several
+# times fewer bytes. The buffer belongs to the thread that uploads, which is the
+# collector's one upload worker.
 class GoogleCloudStorage:
-  def __init__(self, project_id, credentials_file, hub_id, bucket_name, directory, logger):
+  def __init__(self, project_id, credentials_file, hub_id, bucket_name, directory, logger, gzip_level=6):
     self.project_id = project_id
     self.credentials_file = credentials_file
     self.hub_id = hub_id
     self.bucket_name = bucket_name
     self.base_directory = directory or ''
     self.client = None
+    self.bucket = None
     self.suffix = None
     self.content_type = None
     self.mime_type = None
     self.logger = logger
+    self.gzip_level = gzip_level
+    self.buffer = io.BytesIO()
 
   def upload(self, bundle):
     if len(bundle) <= 0:
       return
-    self.logger and self.logger.debug("Uploading a bundle of %d measurements", len(bundle))
+    self.buffer.seek(0)
+    self.buffer.truncate()
+    if self.gzip_level:
+      # mtime=0 leaves the time out of the header, it's in the file name already
+      out = gzip.GzipFile(fileobj=self.buffer, mode='wb', compresslevel=self.gzip_level, mtime=0)
+      self.write_measurements(bundle, out)
+      out.close()
+    else:
+      self.write_measurements(bundle, self.buffer)
+    size = self.buffer.tell()
+    self.logger and self.logger.debug("Uploading a bundle of %d measurements (%d bytes)", len(bundle), size)
     filename = self._generate_filename()
     blob = storage.blob.Blob(filename, self._bucket())
-    blob.upload_from_string(self._format_measurements(bundle), self.mime_type)
+    blob.content_encoding = 'gzip' if self.gzip_level else None
+    blob.upload_from_file(self.buffer, rewind=True, size=size, content_type=self.mime_type)
 
     google_url = "gs://%s/%s" % (self.bucket_name, filename)
     return google_url
 
+  def upload_file(self, path, content_encoding=None):
+    filename = self._generate_filename()
+    self.logger and self.logger.debug("Uploading %s (%d bytes)", path, os.path.getsize(path))
+    blob = storage.blob.Blob(filename, self._bucket())
+    # a gzipped file is stored as it is and served decompressed
+    blob.content_encoding = content_encoding
+    blob.upload_from_filename(path, content_type=self.mime_type)
+    return "gs://%s/%s" % (self.bucket_name, filename)
+
   def _client(self):
     if not self.client:
       self.client = storage.client.Client.from_service_account_json(self.credentials_file)
@@ -76,37 +110,54 @@ class GoogleCloudStorage:
     return "/".join([self.base_directory, time.strftime("%Y/%m/%d"), filename])
 
   def _bucket(self):
-    return self._client().get_bucket(self.bucket_name)
+    # client.bucket() makes the handle without get_bucket's API request,
+    # a missing bucket shows up as an error on the upload instead
+    if not self.bucket:
+      self.bucket = self._client().bucket(self.bucket_name)
+    return self.bucket
 
 # why do we have this class? we output in this format with the -v option, but never to Google Cloud (i thought)
 class GoogleCloudCSVStorage(GoogleCloudStorage):
 
   HEADERS = ['hub_id', 'tag_id', 'temperature', 'x_acc', 'y_acc', 'z_acc',  'rssi', 'timestamp']
+  # a whole row in one formatting operation
+  ROW = "%s,%s,%2.2f,%2.3f,%2.3f,%2.3f,%d,%d\n"
+  # GzipFile.write has a cost of its own, so rows go to it this many at a time
+  ROWS_PER_WRITE = 500
 
-  def __init__(self, project_id, credentials_file, hub_id, bucket_name, directory, logger=None):
-    GoogleCloudStorage.__init__(self, project_id, credentials_file, hub_id, bucket_name, directory, logger)
+  def __init__(self, project_id, credentials_file, hub_id, bucket_name, directory, logger=None, gzip_level=6):
+    GoogleCloudStorage.__init__(self, project_id, credentials_file, hub_id, bucket_name, directory, logger, gzip_level)
     self.suffix = "csv"
     self.mime_type = "text/csv"
     self.content_type = "text/csv"
 
-  def _format_measurements(self, measurements):
-    return "\n".join(map(self._measurement_row, measurements))
-
-  def _measurement_row(self, measurement):
-    return ",".join([
-      measurement['hub_id'],
-      measurement['tag_id'],
-      "%2.2f" % measurement['temperature'],
-      "%2.3f" % measurement['x_acc'],
-      "%2.3f" % measurement['y_acc'],
-      "%2.3f" % measurement['z_acc'],
-      "%d" % measurement['rssi'],
-      "%d" % measurement['timestamp']
-    ])
+  def write_measurements(self, measurements, out):
+    """ Writes the measurements as CSV rows to the binary file `out` """
+    row = self.ROW
+    for start in range(0, len(measurements), self.ROWS_PER_WRITE):
+      out.write("".join([
+        row % (m['hub_id'], m['tag_id'], m['temperature'], m['x_acc'], m['y_acc'], m['z_acc'], m['rssi'], m['timestamp'])
+        for m in measurements[start:start + self.ROWS_PER_WRITE]
+      ]).encode('utf-8'))
 
   def _generate_filename(self):
     return GoogleCloudStorage._generate_filename(self) + ".csv"
 
+# The rows of a TagAggregator, one per tag per scan window. They have columns of their
+# own, so they go into an `aggregates` directory next to the raw measurements.
+class GoogleCloudAggregateCSVStorage(GoogleCloudCSVStorage):
+
+  HEADERS = TagAggregator.HEADERS
+  ROW = "%s,%s,%d,%d,%d,%2.2f,%2.2f,%2.2f,%2.3f,%2.3f,%d\n"
+
+  def __init__(self, project_id, credentials_file, hub_id, bucket_name, directory, logger=None, gzip_level=6):
+    GoogleCloudCSVStorage.__init__(self, project_id, credentials_file, hub_id, bucket_name, "/".join([directory or '', "aggregates"]), logger, gzip_level)
+
+  def write_measurements(self, aggregates, out):
+    """ Writes the aggregates as CSV rows to the binary file `out` """
+    headers = self.HEADERS
+    out.write("".join([self.ROW % tuple(aggregate[name] for name in headers) for aggregate in aggregates]).encode('utf-8'))
+
 # we don't (?) use this class because it's for BiqQuery which we're not using
 class GoogleCsvUploader():
   def __init__(self, project_id, credentials_file, hub_id, bucket_name, directory, dataset_name, table_name, **kwargs):
@@ -119,15 +170,103 @@ class GoogleCsvUploader():
     self.table_name = table_name
     self.auto_update_big_query = kwargs.get('big_query_update', False)
     self.logger = kwargs.get('logger', None)
+    # with an UploadSpool, objects go into the spool and a SpoolReplayer uploads them
+    self.upload_spool = kwargs.get('upload_spool', None)
+    # 0 uploads plain CSV
+    self.gzip_level = kwargs.get('gzip_level', 6)
+    # uploads the rows of a TagAggregator instead of measurements
+    self.aggregates = kwargs.get('aggregates', False)
+    # made for the first upload and kept, with their client and bucket handles
+    self.gcs = None
+    self.gbq = None
 
   def package_and_upload(self, measurements):
+    if self.upload_spool:
+      self.logger and self.logger.debug("Spooling %d measurements" % len(measurements))
+      self.upload_spool.put(lambda spool: self.storage().write_measurements(measurements, spool))
+      return
     self.logger and self.logger.info("Uploading %d measurements to the %s bucket" % (len(measurements), self.bucket_name))
-    gcs = GoogleCloudCSVStorage(self.project_id, self.credentials_file, self.hub_id, self.bucket_name, self.base_directory, self.logger)
-    url = gcs.upload(measurements)
+    url = self.storage().upload(measurements)
     self.logger and self.logger.debug("Uploaded to %s" % url)
+    self.update_big_query(url)
+    return url
+
+  def storage(self):
+    if not self.gcs:
+      storage_class = GoogleCloudAggregateCSVStorage if self.aggregates else GoogleCloudCSVStorage
+      self.gcs = storage_class(self.project_id, self.credentials_file, self.hub_id, self.bucket_name, self.base_directory, self.logger, self.gzip_level)
+    return self.gcs
+
+  def upload_spooled(self, path):
+    """ Uploads a file from the UploadSpool """
+    # files spooled before --gzip-level changed keep the encoding they were written with
+    url = self.storage().upload_file(path, content_encoding='gzip' if path.endswith('.gz') else None)
+    self.logger and self.logger.debug("Uploaded %s to %s" % (path, url))
+    self.update_big_query(url)
+    return url
 
+  def update_big_query(self, url):
     if self.auto_update_big_query:
-      gbq = GoogleBigQuery(self.project_id, self.credentials_file, self.dataset_name, self.table_name, self.logger)
-      gbq.update(url)
+      if not self.gbq:
+        self.gbq = GoogleBigQuery(self.project_id, self.credentials_file, self.dataset_name, self.table_name, self.logger)
+      self.gbq.update(url)
       self.logger and self.logger.debug("Updated BigQuery:%s:%s" % (self.dataset_name, self.table_name))
+
+  def close(self):
+    pass
+
+
+# Instead of one small object a bundle, this appends the bundles to a local spool
+# file and uploads it as one object once it holds `roll_bytes` bytes or its first
+# rows are `roll_seconds` old. The spool stays on disk until it's uploaded, so a
+# failed upload is tried again with the next bundle, and a restart picks it up.
+# With an UploadSpool, the rolled file goes there instead of straight to GCS.
+class RollingCsvUploader(GoogleCsvUploader):
+  def __init__(self, project_id, credentials_file, hub_id, bucket_name, directory, dataset_name, table_name, **kwargs):
+    GoogleCsvUploader.__init__(self, project_id, credentials_file, hub_id, bucket_name, directory, dataset_name, table_name, **kwargs)
+    self.spool = kwargs.get('spool', 'dream_spool.csv')
+    self.roll_bytes = kwargs.get('roll_bytes', 1000000)
+    self.roll_seconds = kwargs.get('roll_seconds', 60)
+    # what's left from before a restart starts the clock now
+    self.started = time.time() if self._spooled() else None
+
+  def package_and_upload(self, measurements):
+    with open(self.spool, 'ab') as spool:
+      self.storage().write_measurements(measurements, spool)
+    if self.started is None:
+      self.started = time.time()
+    self.logger and self.logger.debug("Spooled %d measurements, %d bytes waiting" % (len(measurements), self._spooled()))
+    if self._spooled() >= self.roll_bytes or time.time() - self.started >= self.roll_seconds:
+      return self.roll()
+
+  def roll(self):
+    size = self._spooled()
+    if not size:
+      return
+    if self.upload_spool:
+      self.upload_spool.put_file(self.spool)
+      self.started = None
+      return
+    self.logger and self.logger.info("Uploading %d spooled bytes to the %s bucket" % (size, self.bucket_name))
+    if self.gzip_level:
+      # the spool keeps growing by appends, so it's only gzipped when it's rolled
+      with open(self.spool, 'rb') as src:
+        with gzip.GzipFile(self.spool + ".gz", 'wb', compresslevel=self.gzip_level) as dst:
+          shutil.copyfileobj(src, dst)
+      try:
+        url = self.storage().upload_file(self.spool + ".gz", content_encoding='gzip')
+      finally:
+        os.remove(self.spool + ".gz")
+    else:
+      url = self.storage().upload_file(self.spool)
+    os.remove(self.spool)
+    self.started = None
+    self.logger and self.logger.debug("Uploaded to %s" % url)
+    self.update_big_query(url)
     return url
+
+  def close(self):
+    self.roll()
+
+  def _spooled(self):
+    return os.path.getsize(self.spool) if os.path.exists(self.spool) else 0
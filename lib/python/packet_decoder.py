@@ -3,7 +3,10 @@
 # The raw Fujitsu data will arrive in this regular expression (REGEX)
 # We define the <names> and {number of characters} for each part of the REGEX
 
+import binascii
+import collections
 import re
+import struct
 
 PACKET_DATA_REGEX = re.compile(r'010003000300(?P<temperature>.{4})(?P<x_acc>.{4})(?P<y_acc>.{4})(?P<z_acc>.{4})$')
 
@@ -26,6 +29,91 @@ def decode(packet_hex_string):
     'z_acc': _compute_acceleration(hex_z_acc)
   }
 
+
+# The numpy dtype that decode_batch() returns, one float column per measurement
+BATCH_DTYPE = [
+  ('temperature', 'f8'),
+  ('x_acc', 'f8'),
+  ('y_acc', 'f8'),
+  ('z_acc', 'f8')
+]
+
+# The Fujitsu identifier sits right before the last 16 hex characters of the packet
+FUJITSU_PREFIX = '010003000300'
+
+
+def decode_batch(packet_hex_strings):
+  """ Decodes a whole bundle of manufacturer data strings in one go.
+
+  Returns a numpy structured array with the BATCH_DTYPE columns and one row per
+  input string (in the same order). Rows that are not Fujitsu packets are NaN,
+  just like decode() would have returned None for them.
+
+  Example:
+    readings = decode_batch(['59000100030003007F03A503C4FFA907', 'junk'])
+    readings['temperature']  # array([ 77.67..., nan])
+  """
+  # numpy is only needed on hubs that decode in bulk
+  import numpy
+
+  packet_hex_strings = list(packet_hex_strings)
+  readings = numpy.full(len(packet_hex_strings), numpy.nan, dtype=BATCH_DTYPE)
+
+  # same test as PACKET_DATA_REGEX: the prefix followed by exactly 16 characters
+  indexes = [
+    index for index, packet_hex_string in enumerate(packet_hex_strings)
+    if packet_hex_string and packet_hex_string[-28:-16] == FUJITSU_PREFIX
+  ]
+  if not indexes:
+    return readings
+
+  # one hex->bytes conversion for the whole bundle, then read the fujitsu
+  # values as little-endian int16 (that's the byte flipping done for us)
+  hex_measurements = ''.join(packet_hex_strings[index][-16:] for index in indexes)
+  values = numpy.frombuffer(binascii.unhexlify(hex_measurements), dtype='<i2')
+  values = values.reshape(-1, 4).astype('f8')
+
+  # formula provided by fujitsu, evaluated in the same order as decode()
+  readings['temperature'][indexes] = (((values[:, 0] / 333.87) + 21.0) * 9.0 / 5.0) + 32
+  readings['x_acc'][indexes] = values[:, 1] / 2048.0
+  readings['y_acc'][indexes] = values[:, 2] / 2048.0
+  readings['z_acc'][indexes] = values[:, 3] / 2048.0
+  return readings
+
+
+# A decoded packet as a plain tuple (namedtuples don't carry a per-instance dict)
+Reading = collections.namedtuple('Reading', ['temperature', 'x_acc', 'y_acc', 'z_acc'])
+
+# the four fujitsu values are little-endian signed 16-bit integers
+MEASUREMENTS_STRUCT = struct.Struct('<hhhh')
+
+
+def fast_decode(packet_hex_string):
+  """ Same result as decode() but returned as a Reading tuple instead of a dict.
+
+  Meant for callers that decode one packet at a time in a hot loop (like the
+  bluepy discovery callback): no regex, no byte flipping through lists of
+  strings, just a position check and one struct unpack.
+  """
+  if not packet_hex_string or packet_hex_string[-28:-16] != FUJITSU_PREFIX:
+    return
+
+  try:
+    # binascii instead of bytes.fromhex so this also runs on python 2
+    raw_temperature, raw_x_acc, raw_y_acc, raw_z_acc = MEASUREMENTS_STRUCT.unpack(
+      binascii.unhexlify(packet_hex_string[-16:]))
+  except (TypeError, ValueError):
+    # not valid hex after all
+    return
+
+  return Reading(
+    # formula provided by fujitsu
+    (((raw_temperature / 333.87) + 21.0) * 9.0 / 5.0) + 32,
+    raw_x_acc / 2048.0,
+    raw_y_acc / 2048.0,
+    raw_z_acc / 2048.0
+  )
+
 # where do we use this? i don't think i've seen this
 def each_slice(size, iterable):
     """ Chunks the iterable into size elements at a time, each yielded as a list.
@@ -50,7 +138,7 @@ def each_slice(size, iterable):
 
 # super important since fujitsu bytes need flipping
 def _flip_bytes(hex_bytes):
-  return ''.join(map(lambda pr: ''.join(pr), each_slice(2, list(hex_bytes)))[::-1])
+  return ''.join(list(map(lambda pr: ''.join(pr), each_slice(2, list(hex_bytes))))[::-1])
 
 # formula provided by fujitsu
 def _compute_temperature(hex_temperature):
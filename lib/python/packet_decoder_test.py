@@ -0,0 +1,50 @@
+import math
+
+import pytest
+
+import packet_decoder
+
+# the "Manufacturer" value bluepy gives us for the sample packets in dream_collector.py
+SAMPLE_PACKETS = [
+  '59000100030003007F03A503C4FFA907',
+  '59000100030003004C036100BDFF0F08',
+  '5900010003000300F9048D0058001E08',
+]
+
+NOT_FUJITSU = [
+  '4c000215fda50693a4e24fb1afcfc6eb07647825',
+  '',
+  None,
+  # the Fujitsu prefix, but not right before the last 16 characters
+  '59000100030003007F03A503C4FFA90700',
+]
+
+
+def test_fast_decode_agrees_with_decode():
+  for packet in SAMPLE_PACKETS:
+    assert packet_decoder.fast_decode(packet)._asdict() == packet_decoder.decode(packet)
+  for packet in NOT_FUJITSU:
+    assert packet_decoder.fast_decode(packet) is None
+    assert packet_decoder.decode(packet) is None
+
+
+def test_decode_batch_agrees_with_decode():
+  # numpy is only needed on hubs that decode in bulk
+  pytest.importorskip('numpy')
+  packets = [NOT_FUJITSU[0]] + SAMPLE_PACKETS[:2] + NOT_FUJITSU[1:] + SAMPLE_PACKETS[2:]
+  readings = packet_decoder.decode_batch(packets)
+  assert len(readings) == len(packets)
+  for packet, reading in zip(packets, readings):
+    expected = packet_decoder.decode(packet)
+    for field, _type in packet_decoder.BATCH_DTYPE:
+      if expected is None:
+        assert math.isnan(reading[field])
+      else:
+        assert reading[field] == pytest.approx(expected[field])
+
+
+def test_decode_batch_without_fujitsu_packets_is_all_nan():
+  numpy = pytest.importorskip('numpy')
+  readings = packet_decoder.decode_batch(NOT_FUJITSU)
+  assert numpy.isnan(readings['temperature']).all()
+  assert len(packet_decoder.decode_batch([])) == 0
@@ -0,0 +1,86 @@
+import math
+
+# Fujitsu tags advertise several times a second, and for asset tracking a row per tag
+# per scan window tells as much as all of them. The TagAggregator folds every
+# measurement of a window into its tag's running aggregate as it arrives, so a window
+# holds one small list per tag instead of a dict per advert, and flush() turns them
+# into one row per tag:
+#
+#   window_start, window_end     timestamps of the tag's first and last measurement
+#   count                        how many measurements the row stands for
+#   temperature_min/max/mean
+#   acc_mean, acc_peak           magnitude of the acceleration, sqrt(x^2 + y^2 + z^2), in g
+#   rssi_max                     the best signal, i.e. when the tag was closest
+#
+# A tag at rest reads about 1g, whichever way it lies; a peak well above that means
+# it was moved or dropped during the window.
+
+# positions in a tag's running aggregate
+START, END, COUNT, TEMPERATURE_MIN, TEMPERATURE_MAX, TEMPERATURE_SUM, ACC_SUM, ACC_PEAK, RSSI_MAX = range(9)
+
+
+class TagAggregator(object):
+  HEADERS = ['hub_id', 'tag_id', 'window_start', 'window_end', 'count',
+             'temperature_min', 'temperature_max', 'temperature_mean', 'acc_mean', 'acc_peak', 'rssi_max']
+
+  def __init__(self):
+    self.tags = {}
+    self.hub_id = None
+    # counters for stats()
+    self.measurements = 0
+    self.aggregates = 0
+
+  def add(self, measurement):
+    temperature = measurement['temperature']
+    acc = math.sqrt(measurement['x_acc'] ** 2 + measurement['y_acc'] ** 2 + measurement['z_acc'] ** 2)
+    timestamp = measurement['timestamp']
+    rssi = measurement['rssi']
+    self.hub_id = measurement['hub_id']
+    self.measurements += 1
+    tag = self.tags.get(measurement['tag_id'])
+    if tag is None:
+      self.tags[measurement['tag_id']] = [timestamp, timestamp, 1, temperature, temperature, temperature, acc, acc, rssi]
+      return
+    tag[END] = timestamp
+    tag[COUNT] += 1
+    tag[TEMPERATURE_SUM] += temperature
+    tag[ACC_SUM] += acc
+    if temperature < tag[TEMPERATURE_MIN]:
+      tag[TEMPERATURE_MIN] = temperature
+    elif temperature > tag[TEMPERATURE_MAX]:
+      tag[TEMPERATURE_MAX] = temperature
+    if acc > tag[ACC_PEAK]:
+      tag[ACC_PEAK] = acc
+    if rssi > tag[RSSI_MAX]:
+      tag[RSSI_MAX] = rssi
+
+  def __len__(self):
+    return len(self.tags)
+
+  def flush(self):
+    """ The window's rows, one per tag, and starts a new window """
+    rows = []
+    for tag_id in sorted(self.tags):
+      tag = self.tags[tag_id]
+      rows.append({
+        'hub_id': self.hub_id,
+        'tag_id': tag_id,
+        'window_start': tag[START],
+        'window_end': tag[END],
+        'count': tag[COUNT],
+        'temperature_min': tag[TEMPERATURE_MIN],
+        'temperature_max': tag[TEMPERATURE_MAX],
+        'temperature_mean': tag[TEMPERATURE_SUM] / tag[COUNT],
+        'acc_mean': tag[ACC_SUM] / tag[COUNT],
+        'acc_peak': tag[ACC_PEAK],
+        'rssi_max': tag[RSSI_MAX],
+      })
+    self.tags = {}
+    self.aggregates += len(rows)
+    return rows
+
+  def stats(self):
+    return {
+      'aggregated_measurements': self.measurements,
+      'aggregates': self.aggregates,
+    }
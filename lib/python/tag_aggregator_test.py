@@ -0,0 +1,46 @@
+import pytest
+
+from tag_aggregator import TagAggregator
+
+
+def reading(tag_id, timestamp, temperature, acc, rssi):
+  x, y, z = acc
+  return dict(hub_id='hub', tag_id=tag_id, timestamp=timestamp, temperature=temperature,
+              x_acc=x, y_acc=y, z_acc=z, rssi=rssi)
+
+
+def test_a_window_becomes_one_row_per_tag():
+  aggregator = TagAggregator()
+  aggregator.add(reading('b', 100, 21.0, (0, 0, 1), -70))
+  aggregator.add(reading('a', 101, 20.0, (0, 0.6, 0.8), -60))
+  aggregator.add(reading('a', 102, 24.0, (0, 0, 3), -50))
+  aggregator.add(reading('a', 103, 19.0, (0, 0, 1), -80))
+  assert len(aggregator) == 2
+
+  a, b = aggregator.flush()
+  assert a == {
+    'hub_id': 'hub', 'tag_id': 'a', 'window_start': 101, 'window_end': 103, 'count': 3,
+    'temperature_min': 19.0, 'temperature_max': 24.0, 'temperature_mean': pytest.approx(21.0),
+    'acc_mean': pytest.approx(5 / 3.0), 'acc_peak': 3.0, 'rssi_max': -50,
+  }
+  assert (b['tag_id'], b['count'], b['window_start'], b['window_end']) == ('b', 1, 100, 100)
+  assert (b['temperature_min'], b['temperature_max'], b['acc_peak'], b['rssi_max']) == (21.0, 21.0, 1.0, -70)
+  assert sorted(a) == sorted(TagAggregator.HEADERS)
+
+
+def test_a_flush_starts_a_new_window():
+  aggregator = TagAggregator()
+  aggregator.add(reading('a', 100, 30.0, (0, 0, 2), -40))
+  aggregator.add(reading('b', 101, 20.0, (0, 0, 1), -60))
+  assert len(aggregator.flush()) == 2
+  assert len(aggregator) == 0
+
+  # nothing of the first window is left in the second
+  aggregator.add(reading('a', 110, 10.0, (0, 0, 1), -90))
+  aggregator.add(reading('a', 111, 12.0, (0, 0, 1), -80))
+  rows = aggregator.flush()
+  assert [(row['tag_id'], row['count'], row['window_start'], row['window_end']) for row in rows] == [('a', 2, 110, 111)]
+  assert (rows[0]['temperature_max'], rows[0]['acc_peak'], rows[0]['rssi_max']) == (12.0, 1.0, -80)
+
+  assert aggregator.flush() == []
+  assert aggregator.stats() == {'aggregated_measurements': 4, 'aggregates': 3}
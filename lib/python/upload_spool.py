@@ -0,0 +1,237 @@
+from contextlib import contextmanager
+import gzip
+import os
+import shutil
+import threading
+import time
+
+try:
+  import google.api_core.exceptions as google_exceptions
+  import google.auth.exceptions as auth_exceptions
+except ImportError:
+  google_exceptions = auth_exceptions = None
+
+# The collector's store-and-forward: every object goes into a spool directory as a
+# CSV file first, gzipped at `gzip_level` (0 leaves it plain), and SpoolReplayer uploads them from there, oldest first.
+# Like the SQLite database on the sobun Hubs, the spool keeps what couldn't be
+# uploaded yet on disk instead of in memory, and it survives a restart.
+#
+# The spool holds at most `max_bytes`; when a new file takes it past that, the
+# oldest files are evicted (deleted and counted) to make room, since the newest
+# readings are the ones worth the most.
+#
+# Files are named after the time they were spooled, so their names sort oldest first.
+#
+# A file Google won't take is moved to the `failed` directory inside the spool, where
+# it's kept for someone to look at but neither uploaded nor counted against `max_bytes`.
+
+# Google answers these when the request may work next time
+RETRYABLE_CODES = (401, 408, 429)
+
+
+class UploadSpool(object):
+  SUFFIX = ".csv"
+  GZIP_SUFFIX = ".csv.gz"
+
+  def __init__(self, directory, max_bytes, gzip_level=6, logger=None):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.gzip_level = gzip_level
+    self.logger = logger
+    self.lock = threading.Lock()
+    self.claimed = set()
+    self.sequence = 0
+    self.evicted = 0
+    self.evicted_bytes = 0
+    self.given_up = 0
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def put(self, write):
+    """ Spools what write(file) writes to the binary file it's given """
+    with self._new_file() as spool:
+      write(spool)
+
+  def put_file(self, path):
+    """ Spools the CSV file at `path`, which is removed """
+    with self._new_file() as spool:
+      with open(path, 'rb') as src:
+        shutil.copyfileobj(src, spool)
+    os.remove(path)
+
+  @contextmanager
+  def _new_file(self):
+    # written under a temporary name and renamed, so the replayer never sees half a file
+    with self.lock:
+      self.sequence += 1
+      name = "%017.6f-%06d%s" % (time.time(), self.sequence % 1000000, self.GZIP_SUFFIX if self.gzip_level else self.SUFFIX)
+    path = os.path.join(self.directory, name)
+    if self.gzip_level:
+      spool = gzip.open(path + ".tmp", 'wb', self.gzip_level)
+    else:
+      spool = open(path + ".tmp", 'wb')
+    try:
+      yield spool
+    except Exception:
+      spool.close()
+      os.remove(path + ".tmp")
+      raise
+    spool.close()
+    os.rename(path + ".tmp", path)
+    self.evict()
+
+  def files(self):
+    """ The spooled files, oldest first, gzipped or not whatever the level is now """
+    return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                  if name.endswith(self.SUFFIX) or name.endswith(self.GZIP_SUFFIX))
+
+  def usage(self):
+    """ How many files are spooled and how many bytes they take """
+    with self.lock:
+      files = self.files()
+      return len(files), sum(os.path.getsize(path) for path in files)
+
+  def evict(self):
+    with self.lock:
+      files = self.files()
+      sizes = [os.path.getsize(path) for path in files]
+      total = sum(sizes)
+      for path, size in zip(files, sizes):
+        # the newest file stays, however big
+        if total <= self.max_bytes or path == files[-1]:
+          break
+        if path in self.claimed:
+          continue
+        os.remove(path)
+        total -= size
+        self.evicted += 1
+        self.evicted_bytes += size
+        self.logger and self.logger.warn("Spool is over %d bytes, evicted %s" % (self.max_bytes, path))
+
+  def claim(self):
+    """ The oldest file nobody is uploading, or None """
+    with self.lock:
+      for path in self.files():
+        if path not in self.claimed:
+          self.claimed.add(path)
+          return path
+
+  def release(self, path, uploaded):
+    with self.lock:
+      self.claimed.discard(path)
+      if uploaded:
+        os.remove(path)
+
+  def give_up(self, path):
+    """ Moves a file that can't be uploaded to the failed directory """
+    failed = os.path.join(self.directory, 'failed')
+    with self.lock:
+      self.claimed.discard(path)
+      if not os.path.isdir(failed):
+        os.makedirs(failed)
+      os.rename(path, os.path.join(failed, os.path.basename(path)))
+      self.given_up += 1
+
+
+class SpoolReplayer(object):
+  """ Uploads the spooled files with `concurrency` threads, oldest first.
+
+  upload(path) uploads one file and raises if it can't. A thread whose upload
+  failed waits `interval` seconds, twice as long after every further failure, up
+  to `max_interval`; meanwhile the file stays in the spool.
+
+  While the network or Google is down every upload fails, and that's no reason
+  to give up on a file. Any other failure counts against the file: after
+  `max_failures` of them, or straight away when Google turns it down for good
+  (e.g. 400, 403 or 404), the file is moved out of the way so the ones behind it
+  go up.
+  """
+
+  def __init__(self, spool, upload, concurrency=2, interval=1.0, max_interval=300, max_failures=5, logger=None):
+    self.spool = spool
+    self.upload = upload
+    self.concurrency = concurrency
+    self.interval = interval
+    self.max_interval = max_interval
+    self.max_failures = max_failures
+    self.logger = logger
+    self.stopping = threading.Event()
+    self.threads = []
+    # failures per file, while it's still spooled
+    self.file_failures = {}
+    self.uploaded = 0
+    self.failed = 0
+    self.uploaded_bytes = 0
+
+  def start(self):
+    for i in range(self.concurrency):
+      thread = threading.Thread(target=self.replay, name="replay-%d" % i)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def replay(self):
+    failures = 0
+    while not self.stopping.is_set():
+      path = self.spool.claim()
+      if path is None:
+        self.stopping.wait(self.interval)
+        continue
+      size = os.path.getsize(path)
+      try:
+        self.upload(path)
+      except Exception as e:
+        self.failed += 1
+        if not outage(e):
+          self.file_failures[path] = self.file_failures.get(path, 0) + 1
+          if permanent(e) or self.file_failures[path] >= self.max_failures:
+            del self.file_failures[path]
+            self.spool.give_up(path)
+            self.logger and self.logger.error("Gave up on %s, moved it to failed: %s" % (path, e))
+            continue
+        self.spool.release(path, uploaded=False)
+        failures += 1
+        delay = min(self.max_interval, self.interval * 2 ** min(failures - 1, 20))
+        self.logger and self.logger.error("Failed to upload %s, trying again in %ds: %s" % (path, delay, e))
+        self.stopping.wait(delay)
+        continue
+      self.spool.release(path, uploaded=True)
+      self.file_failures.pop(path, None)
+      self.uploaded += 1
+      self.uploaded_bytes += size
+      failures = 0
+
+  def stats(self):
+    files, size = self.spool.usage()
+    return {
+      'spooled_files': files,
+      'spooled_bytes': size,
+      'uploaded': self.uploaded,
+      'uploaded_bytes': self.uploaded_bytes,
+      'failed': self.failed,
+      'given_up': self.spool.given_up,
+      'evicted': self.spool.evicted,
+      'evicted_bytes': self.spool.evicted_bytes,
+    }
+
+  def stop(self, timeout=None):
+    """ Stops after the uploads that are going; what's left stays spooled for next time """
+    self.stopping.set()
+    # one deadline for all the threads
+    deadline = None if timeout is None else time.time() + timeout
+    for thread in self.threads:
+      thread.join(None if deadline is None else max(0, deadline - time.time()))
+    self.threads = []
+
+
+def outage(error):
+  """ Whether an upload failed because the network or Google is down, not because of the file """
+  if google_exceptions is not None and isinstance(error, (google_exceptions.ServerError, auth_exceptions.TransportError)):
+    return True
+  return isinstance(error, EnvironmentError)
+
+
+def permanent(error):
+  """ Whether Google turned an upload down for good """
+  return (google_exceptions is not None and isinstance(error, google_exceptions.ClientError)
+          and error.code not in RETRYABLE_CODES)
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+import upload_spool
+from upload_spool import SpoolReplayer, UploadSpool
+
+
+class Stopping(object):
+  """ Stands in for the replayer's stopping event: records the waits and stops after `waits` of them """
+
+  def __init__(self, waits):
+    self.waits = []
+    self.max_waits = waits
+
+  def is_set(self):
+    return len(self.waits) >= self.max_waits
+
+  def wait(self, delay):
+    self.waits.append(delay)
+
+  def set(self):
+    self.max_waits = 0
+
+
+class ClientError(Exception):
+  code = None
+
+
+class Forbidden(ClientError):
+  code = 403
+
+
+class TooManyRequests(ClientError):
+  code = 429
+
+
+class ServerError(Exception):
+  pass
+
+
+class TransportError(Exception):
+  pass
+
+
+class GoogleExceptions(object):
+  ClientError = ClientError
+  ServerError = ServerError
+
+
+class AuthExceptions(object):
+  TransportError = TransportError
+
+
+def make_spool(tmpdir, count, max_bytes=10 ** 6, gzip_level=0):
+  spool = UploadSpool(str(tmpdir), max_bytes, gzip_level=gzip_level)
+  for i in range(count):
+    spool.put(lambda f, i=i: f.write(("%d,%s\n" % (i, "x" * 99)).encode('ascii')))
+  return spool
+
+
+def contents(paths):
+  return [open(path, 'rb').read().split(b',')[0] for path in paths]
+
+
+def test_the_spool_evicts_the_oldest_files_past_max_bytes(tmpdir):
+  # 102 bytes a file, room for 3
+  spool = make_spool(tmpdir, 5, max_bytes=350)
+  assert contents(spool.files()) == [b'2', b'3', b'4']
+  assert spool.usage() == (3, 306)
+  assert (spool.evicted, spool.evicted_bytes) == (2, 204)
+
+
+def test_the_spool_keeps_a_claimed_file_from_eviction(tmpdir):
+  spool = make_spool(tmpdir, 1, max_bytes=150)
+  uploading = spool.claim()
+  spool.put(lambda f: f.write(b"1," + b"x" * 99))
+  assert uploading in spool.files()
+  assert spool.evicted == 0
+
+
+def test_gzipped_and_plain_files_are_both_replayed(tmpdir):
+  make_spool(tmpdir, 1, gzip_level=6)
+  spool = make_spool(tmpdir, 1, gzip_level=0)
+  gzipped, plain = spool.files()
+  assert gzipped.endswith('.csv.gz') and plain.endswith('.csv')
+  assert contents([plain]) == [b'0']
+
+
+def test_the_replayer_uploads_the_oldest_first(tmpdir):
+  spool = make_spool(tmpdir, 3)
+  uploaded = []
+  replayer = SpoolReplayer(spool, lambda path: uploaded.extend(contents([path])))
+  # runs in this thread until the spool is empty and it waits for more
+  replayer.stopping = Stopping(1)
+  replayer.replay()
+  assert uploaded == [b'0', b'1', b'2']
+  assert spool.files() == []
+  stats = replayer.stats()
+  assert (stats['uploaded'], stats['uploaded_bytes'], stats['failed']) == (3, 306, 0)
+
+
+def test_the_replayer_backs_off_and_keeps_the_files_during_an_outage(tmpdir, monkeypatch):
+  monkeypatch.setattr(upload_spool, 'google_exceptions', GoogleExceptions)
+  monkeypatch.setattr(upload_spool, 'auth_exceptions', AuthExceptions)
+  spool = make_spool(tmpdir, 2)
+  outage = [IOError("network is down"), ServerError("503"), TransportError("no token")]
+
+  def upload(path):
+    raise outage[len(replayer.stopping.waits) % 3]
+
+  replayer = SpoolReplayer(spool, upload, interval=1, max_interval=5, max_failures=2)
+  replayer.stopping = Stopping(6)
+  replayer.replay()
+  assert replayer.stopping.waits == [1, 2, 4, 5, 5, 5]
+  assert len(spool.files()) == 2
+  stats = replayer.stats()
+  assert (stats['failed'], stats['given_up'], stats['uploaded']) == (6, 0, 0)
+
+
+def test_the_replayer_moves_files_google_wont_take_out_of_the_way(tmpdir, monkeypatch):
+  monkeypatch.setattr(upload_spool, 'google_exceptions', GoogleExceptions)
+  monkeypatch.setattr(upload_spool, 'auth_exceptions', AuthExceptions)
+  spool = make_spool(tmpdir, 4)
+  uploaded = []
+
+  def upload(path):
+    number = contents([path])[0]
+    if number == b'0':
+      raise Forbidden("403")
+    if number == b'1':
+      raise TooManyRequests("429")
+    if number == b'2':
+      raise ValueError("not a CSV file")
+    uploaded.append(number)
+
+  replayer = SpoolReplayer(spool, upload, interval=1, max_failures=2)
+  # 1 and 2 fail twice each before they're moved, with a wait after the first
+  # failure of each, then the empty spool is waited on
+  replayer.stopping = Stopping(3)
+  replayer.replay()
+  assert uploaded == [b'3']
+  assert spool.files() == []
+  assert sorted(contents(os.path.join(str(tmpdir), 'failed', name)
+                         for name in os.listdir(os.path.join(str(tmpdir), 'failed')))) == [b'0', b'1', b'2']
+  stats = replayer.stats()
+  assert (stats['failed'], stats['given_up'], stats['uploaded']) == (5, 3, 1)
+  assert replayer.file_failures == {}
+
+
+def test_stop_waits_once_for_all_the_threads(tmpdir):
+  spool = make_spool(tmpdir, 2)
+  uploading = threading.Event()
+  released = threading.Event()
+
+  def upload(path):
+    uploading.set()
+    released.wait(5)
+
+  replayer = SpoolReplayer(spool, upload, concurrency=2)
+  replayer.start()
+  uploading.wait(1)
+  started = time.time()
+  replayer.stop(timeout=0.2)
+  assert time.time() - started < 0.35
+  released.set()
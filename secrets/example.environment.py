@@ -5,5 +5,7 @@ SECRETS = {
     'GOOGLE_BQ_DATASET': 'measurements_dataset',
     'GOOGLE_BQ_TABLE': 'measurements_table',
     'GOOGLE_CREDENTIALS_JSON_FILE': './secrets/my-google-credentials.json',
-    'HUB_ID': 'the-name-of-the-hub'
+    'HUB_ID': 'the-name-of-the-hub',
+    # 'raw' or 'aggregate'
+    'COLLECTOR_OUTPUT': 'raw'
 }
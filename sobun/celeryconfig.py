@@ -3,6 +3,9 @@
 # use the redis server for the queue
 broker_url = 'redis://localhost:6379/0'
 
+# syncer.batch sends its bundles packed (see dream/wire.py); json is for everything else
+accept_content = ['json', 'dream-bundle']
+
 # restart the worker (on the syncer service) after 10k tasks (packets)
 # this is a work-around for why the worker hangs after publishing to PubSub for a while 
 # worker_max_tasks_per_child = 10000
@@ -1,24 +1,61 @@
 # Create the db scheame
 
+from contextlib import contextmanager
+from functools import wraps
+from itertools import groupby
+import binascii
+import os
+import re
 import signal
 import sqlite3
+import struct
 import sys
-import time
 
 from dream import config
 
 
+# PRAGMA auto_vacuum values: 0 is NONE, 1 is FULL and 2 is INCREMENTAL
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class Connection(sqlite3.Connection):
+    """ A connection that remembers which schema its database has (see is_compact) """
+    compact = None
+
+
 def dbconnect(name=None):
     if not name:
-        name = 'measurements.db'
+        name = config.DREAM_DB
 
     # Wait at most for 30 seconds for the lock to go away
-    conn = sqlite3.connect(name, timeout=30000)
+    conn = sqlite3.connect(name, timeout=30000, factory=Connection)
     conn.row_factory = sqlite3.Row
+
+    # With a write-ahead log the syncer's inserts don't wait for the batcher's reads
+    # and every commit appends to one file instead of rewriting pages on the SD card.
+    # synchronous=NORMAL is safe with WAL: a power cut can only lose the last commits.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA wal_autocheckpoint={}".format(int(config.DREAM_WAL_AUTOCHECKPOINT)))
+    # the first write after a complete checkpoint truncates the log to this size
+    conn.execute("PRAGMA journal_size_limit={}".format(int(config.DREAM_WAL_SIZE_LIMIT)))
     return conn
 
 
 def create_schema(dbconn):
+    # Published rows leave free pages behind; maintain() hands them back a few at a time.
+    # auto_vacuum only changes with a VACUUM once the file exists, so older hubs
+    # get one full VACUUM here the first time (a new database is done instantly).
+    auto_vacuum, = dbconn.execute("PRAGMA auto_vacuum").fetchone()
+    if auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+        dbconn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        dbconn.commit()
+        dbconn.execute("VACUUM")
+
+    if is_compact(dbconn):
+        create_compact_schema(dbconn)
+        return
+
     SCHEMA = """
     CREATE TABLE IF NOT EXISTS measurements(
         batch_id integer default 0,
@@ -36,8 +73,184 @@ def create_schema(dbconn):
     dbconn.execute("CREATE INDEX IF NOT EXISTS tag_idx on measurements (tag_id)")
     dbconn.commit()
 
+    create_batch_state(dbconn)
+
+
+# batch_state is a one row table that keeps the number of pending rows (batch_id = 0)
+# and the next batch id, so creating a batch doesn't have to count the whole table.
+# The triggers keep `pending` right no matter who writes to the {table} table.
+# The measurements table's triggers have no prefix, the readings table's are readings_*
+BATCH_STATE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS batch_state(
+        id integer primary key check (id = 1),
+        next_batch_id integer not null,
+        pending integer not null
+    )
+    """,
+    """
+    INSERT OR IGNORE INTO batch_state (id, next_batch_id, pending)
+    SELECT 1,
+        coalesce(max(batch_id), 0) + 1,
+        (SELECT count(*) FROM {table} WHERE batch_id = 0)
+    FROM {table}
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS {prefix}pending_on_insert AFTER INSERT ON {table}
+    WHEN new.batch_id = 0
+    BEGIN
+        UPDATE batch_state SET pending = pending + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS {prefix}pending_on_delete AFTER DELETE ON {table}
+    WHEN old.batch_id = 0
+    BEGIN
+        UPDATE batch_state SET pending = pending - 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS {prefix}pending_on_update AFTER UPDATE OF batch_id ON {table}
+    WHEN (old.batch_id = 0) != (new.batch_id = 0)
+    BEGIN
+        UPDATE batch_state SET pending = pending + (new.batch_id = 0) - (old.batch_id = 0);
+    END
+    """,
+]
+
+
+@contextmanager
+def write_lock(dbconn):
+    """ Runs the block as one BEGIN IMMEDIATE transaction, even if it creates tables.
+
+    python's sqlite3 commits before every CREATE/DROP on its own, this doesn't.
+    """
+    isolation_level = dbconn.isolation_level
+    dbconn.isolation_level = None
+    try:
+        dbconn.execute("BEGIN IMMEDIATE")
+        yield dbconn
+        dbconn.execute("COMMIT")
+    except Exception:
+        dbconn.execute("ROLLBACK")
+        raise
+    finally:
+        dbconn.isolation_level = isolation_level
+
+
+def create_batch_state(dbconn, table='measurements', prefix=''):
+    # nothing may be inserted between counting the pending rows and creating the triggers
+    with write_lock(dbconn):
+        for statement in BATCH_STATE_SCHEMA:
+            dbconn.execute(statement.format(table=table, prefix=prefix))
+
+
+# The compact schema keeps every tag's MAC address once in `tags`, and each reading
+# refers to it by number and stores the 8 measurement bytes as a blob. It only has
+# the one index the batcher needs. `python -m dream.batcher --compact` migrates to it;
+# everybody keeps using the measurements table until the migration drops it.
+COMPACT_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS tags(
+        id integer primary key,
+        tag_id text unique not null
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS readings(
+        batch_id integer not null default 0,
+        timestamp integer,
+        tag integer,
+        measurements blob,
+        hci integer,
+        rssi integer
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS readings_batched_idx on readings (batch_id)",
+]
+
+
+def create_compact_schema(dbconn):
+    with write_lock(dbconn):
+        for statement in COMPACT_SCHEMA:
+            dbconn.execute(statement)
+    create_batch_state(dbconn, table='readings', prefix='readings_')
+    forget_schema(dbconn)
+
+
+def tables(dbconn):
+    res = dbconn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return set(name for name, in res)
+
+
+def is_compact(dbconn):
+    # looked up once per connection: only --compact changes it, and when that runs in
+    # another process our next statement on the measurements table fails and
+    # follows_compact() looks again
+    compact = getattr(dbconn, 'compact', None)
+    if compact is None:
+        names = tables(dbconn)
+        compact = 'measurements' not in names and 'readings' in names
+        if isinstance(dbconn, Connection):
+            dbconn.compact = compact
+    return compact
+
+
+def forget_schema(dbconn):
+    if isinstance(dbconn, Connection):
+        dbconn.compact = None
+
+
+def dropped_measurements(error):
+    return 'no such table' in str(error)
+
+
+def follows_compact(function):
+    """ Calls `function(dbconn, ...)` again when --compact dropped the measurements
+    table under it. Its first statement on the table fails, before it wrote anything. """
+    @wraps(function)
+    def wrapper(dbconn, *args, **kwargs):
+        try:
+            return function(dbconn, *args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if not dropped_measurements(e):
+                raise
+            forget_schema(dbconn)
+            return function(dbconn, *args, **kwargs)
+    return wrapper
+
+
+def measurements_table(dbconn):
+    return 'readings' if is_compact(dbconn) else 'measurements'
+
+
+# insert() takes rows as dicts or as tuples of these, in this order
+ROW_FIELDS = ('timestamp', 'tag_id', 'measurements', 'hci', 'rssi')
+
+
+def as_tuple(row):
+    if isinstance(row, dict):
+        return tuple(row[field] for field in ROW_FIELDS)
+    return row
+
 
 def insert(row_or_rows, cursor, many=False):
+    rows = [as_tuple(row) for row in row_or_rows] if many else [as_tuple(row_or_rows)]
+    try:
+        _insert(rows, cursor)
+    except sqlite3.OperationalError as e:
+        # --compact dropped the measurements table between our check and our insert
+        if not dropped_measurements(e):
+            raise
+        forget_schema(cursor.connection)
+        _insert(rows, cursor)
+
+
+def _insert(rows, cursor):
+    if is_compact(cursor.connection):
+        _insert_compact(rows, cursor)
+        return
+
     sql = """
         INSERT OR IGNORE INTO measurements
         (
@@ -47,58 +260,148 @@ def insert(row_or_rows, cursor, many=False):
             hci,
             rssi
         )
-        VALUES
+        VALUES (?, ?, ?, ?, ?)
+    """
+    cursor.executemany(sql, rows)
+
+
+def _insert_compact(rows, cursor, batch_ids=None):
+    # rows are tuples in ROW_FIELDS order, batch_ids[i] is the batch of rows[i] (0 if not given)
+    tag_ids = sorted(set(tag_id for _timestamp, tag_id, _measurements, _hci, _rssi in rows))
+    cursor.executemany("INSERT OR IGNORE INTO tags (tag_id) VALUES (?)", [(tag_id,) for tag_id in tag_ids])
+    sql = """
+        INSERT INTO readings
         (
-            :timestamp,
-            :tag_id,
-            :measurements,
-            :hci,
-            :rssi
+            batch_id,
+            timestamp,
+            tag,
+            measurements,
+            hci,
+            rssi
         )
+        VALUES (?, ?, (SELECT id FROM tags WHERE tag_id = ?), ?, ?, ?)
     """
-    if many:
-        cursor.executemany(sql, row_or_rows)
-    else:
-        cursor.execute(sql, row_or_rows)
+    if batch_ids is None:
+        batch_ids = [0] * len(rows)
+    cursor.executemany(sql, [
+        (batch_id, timestamp, tag_id, sqlite3.Binary(binascii.unhexlify(measurements)), hci, rssi)
+        for batch_id, (timestamp, tag_id, measurements, hci, rssi) in zip(batch_ids, rows)
+    ])
 
 
+@follows_compact
 def create_unique_batch(dbconn, batch_size=None):
     if batch_size is None:
         batch_size = int(config.BATCH_SIZE)
+    table = measurements_table(dbconn)
     cursor = dbconn.cursor()
-    res = cursor.execute("SELECT count(*) FROM measurements WHERE batch_id = 0")
-    count, = res.fetchone()
+    res = cursor.execute("SELECT next_batch_id, pending FROM batch_state")
+    batch_id, count = res.fetchone()
     if count > batch_size:
-        sql = """
-            UPDATE measurements SET batch_id = (SELECT MAX(batch_id)+1 from measurements)
+        # the batch is the oldest batch_size pending rows in insertion (rowid) order.
+        # the batch_id index is ordered by (batch_id, rowid) so both statements only
+        # touch the rows of the batch, however big the table is.
+        res = cursor.execute("""
+            SELECT rowid FROM {}
             WHERE batch_id = 0
-            ORDER BY timestamp
-            LIMIT :batch_size
-        """
-        cursor.execute(sql, dict(batch_size=batch_size))
-        res = cursor.execute("select max(batch_id) from measurements")
-        max_batch_id, = res.fetchone()
-        print('batch {} was created and will be published soon'.format(max_batch_id))
+            ORDER BY rowid
+            LIMIT 1 OFFSET :offset
+        """.format(table), dict(offset=batch_size - 1))
+        row = res.fetchone()
+        if row is None:
+            # pending also counts the rows --compact has already moved to readings
+            print('waiting for the compact schema migration to create another batch')
+            return None
+        last_rowid, = row
+        sql = """
+            UPDATE {} SET batch_id = :batch_id
+            WHERE batch_id = 0 AND rowid <= :last_rowid
+        """.format(table)
+        cursor.execute(sql, dict(batch_id=batch_id, last_rowid=last_rowid))
+        cursor.execute("UPDATE batch_state SET next_batch_id = next_batch_id + 1")
+        print('batch {} was created and will be published soon'.format(batch_id))
+        return batch_id
     else:
         print('{} more payloads is needed to create another batch'.format(batch_size - count))
+        return None
 
 
-def publish_batch(dbconn, batch_id):
-    from dream.gpub import send_batch
-
-    sql = """
-        SELECT
-            timestamp,
-            tag_id,
-            measurements,
-            hci,
-            rssi
-        FROM measurements
+@follows_compact
+def split_batch(dbconn, batch_id, batch_size):
+    """ Moves the rows of a batch past its first batch_size into a new batch, for a batch
+    PubSub turned down as too large. Returns the new batch's id, or None if it fits. """
+    table = measurements_table(dbconn)
+    cursor = dbconn.cursor()
+    res = cursor.execute("""
+        SELECT rowid FROM {}
         WHERE batch_id = :batch_id
-        ORDER BY tag_id
-    """
+        ORDER BY rowid
+        LIMIT 1 OFFSET :offset
+    """.format(table), dict(batch_id=batch_id, offset=batch_size - 1))
+    row = res.fetchone()
+    if row is None:
+        return None
+    last_rowid, = row
+    new_batch_id, = cursor.execute("SELECT next_batch_id FROM batch_state").fetchone()
+    cursor.execute("""
+        UPDATE {} SET batch_id = :new_batch_id
+        WHERE batch_id = :batch_id AND rowid > :last_rowid
+    """.format(table), dict(new_batch_id=new_batch_id, batch_id=batch_id, last_rowid=last_rowid))
+    moved = cursor.rowcount
+    if not moved:
+        return None
+    cursor.execute("UPDATE batch_state SET next_batch_id = next_batch_id + 1")
+    print('batch {} was split, its last {} rows are batch {}'.format(batch_id, moved, new_batch_id))
+    return new_batch_id
+
+
+def batch_payload(dbconn, batch_id, payload_format=None):
+    """ The batch as PubSub message data, in the csv or the columnar format """
+    if payload_format is None:
+        payload_format = config.DREAM_PAYLOAD_FORMAT
+    if payload_format == 'columnar':
+        rows = batch_rows(dbconn, batch_id).fetchall()
+        if fits_columnar(rows):
+            return columnar_payload(rows)
+        print('batch {} has rows the columnar format can\'t hold, sending it as csv'.format(batch_id))
+        return csv_payload(rows)
+    return csv_payload(batch_rows(dbconn, batch_id))
+
+
+@follows_compact
+def batch_rows(dbconn, batch_id):
+    if is_compact(dbconn):
+        # same columns (and hex measurements) as the measurements table gives us
+        sql = """
+            SELECT
+                readings.timestamp,
+                tags.tag_id,
+                lower(hex(readings.measurements)),
+                readings.hci,
+                readings.rssi
+            FROM readings
+            JOIN tags ON tags.id = readings.tag
+            WHERE readings.batch_id = :batch_id
+            ORDER BY tags.tag_id
+        """
+    else:
+        sql = """
+            SELECT
+                timestamp,
+                tag_id,
+                measurements,
+                hci,
+                rssi
+            FROM measurements
+            WHERE batch_id = :batch_id
+            ORDER BY tag_id
+        """
     cursor = dbconn.cursor()
-    rows = cursor.execute(sql, dict(batch_id=batch_id))
+    return cursor.execute(sql, dict(batch_id=batch_id))
+
+
+def csv_payload(rows):
+    # a row per line, the tag_id is left out when it's the same as on the line before
     lines = []
     last_tag_id = None
     for row in rows:
@@ -109,62 +412,239 @@ def publish_batch(dbconn, batch_id):
             last_tag_id = tag_id
         compacted_row = (timestamp, tag_id, measurements, hci, rssi)
         lines.append(",".join(map(str, compacted_row)))
-    payload = "\n".join(lines)
-
-    msg_id = send_batch(payload)
+    return "\n".join(lines)
+
+
+# The columnar format stores a batch as blocks of rows of one tag. After a header of
+# magic, version and number of blocks, each block has
+#
+#   uint8 length and the tag_id, uint32 number of rows
+#   the timestamps as zigzag varints, each the difference to the one before (the first to 0)
+#   a uint8 hci per row, an int8 rssi per row, 8 bytes of measurements per row
+#
+# The drainer reads it with helpers.rows_from_columnar.
+COLUMNAR_MAGIC = b'DRMC'
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct('<4sBI')
+COLUMNAR_TAG = struct.Struct('<B')
+COLUMNAR_ROWS = struct.Struct('<I')
+
+
+def varint(value, out):
+    # zigzag, so small negative differences stay small too
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+COLUMNAR_MEASUREMENTS = re.compile(r'^[0-9a-fA-F]{16}$')
+
+
+def fits_columnar(rows):
+    """ Whether every row has the 16 hex characters of measurements, an hci and an rssi
+    that fit a byte, and a tag_id that fits its length byte. One short measurement
+    would shift every row after it in the block. """
+    for _timestamp, tag_id, measurements, hci, rssi in rows:
+        if not COLUMNAR_MEASUREMENTS.match(measurements or ''):
+            return False
+        if not (0 <= int(hci) <= 255 and -128 <= int(rssi) <= 127 and len(tag_id.encode('ascii', 'replace')) <= 255):
+            return False
+    return True
+
+
+def columnar_payload(rows):
+    blocks = []
+    for tag_id, tag_rows in groupby(rows, key=lambda row: row[1]):
+        tag_rows = list(tag_rows)
+        tag = tag_id.encode('ascii')
+        block = bytearray(COLUMNAR_TAG.pack(len(tag)) + tag + COLUMNAR_ROWS.pack(len(tag_rows)))
+        last_timestamp = 0
+        for timestamp, _tag_id, _measurements, _hci, _rssi in tag_rows:
+            varint(int(timestamp) - last_timestamp, block)
+            last_timestamp = int(timestamp)
+        count = len(tag_rows)
+        block += struct.pack('<{}B'.format(count), *[int(row[3]) for row in tag_rows])
+        block += struct.pack('<{}b'.format(count), *[int(row[4]) for row in tag_rows])
+        block += binascii.unhexlify(''.join([row[2] for row in tag_rows]))
+        blocks.append(bytes(block))
+    return COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, len(blocks)) + b''.join(blocks)
+
+
+@follows_compact
+def delete_batch(dbconn, batch_id):
+    table = measurements_table(dbconn)
+    dbconn.execute("DELETE FROM {} WHERE batch_id = :batch_id".format(table), dict(batch_id=batch_id))
+
+
+def publish_batch(dbconn, batch_id, send_batch=None):
+    if send_batch is None:
+        from dream.gpub import send_batch
+
+    msg_id = send_batch(batch_payload(dbconn, batch_id))
     if msg_id:
         print("Pub/Sub msg_id was created: {}".format(msg_id))
-        dbconn.execute("DELETE FROM measurements WHERE batch_id = :batch_id", dict(batch_id=batch_id))
-        dbconn.execute("VACUUM")
+        delete_batch(dbconn, batch_id)
         dbconn.commit()
         print('Successfully published batch {} data to the Cloud'.format(batch_id))
+        maintain(dbconn)
+
+
+def publish_batches(dbconn, batch_ids, send_batches=None):
+    """ Publishes several batches with as few PubSub requests as possible """
+    if send_batches is None:
+        from dream.gpub import send_batches
+
+    payloads = [batch_payload(dbconn, batch_id) for batch_id in batch_ids]
+    return acknowledge(dbconn, batch_ids, send_batches(payloads))
 
 
-def publish_next_batch(dbconn):
-    create_unique_batch(dbconn)
+def acknowledge(dbconn, batch_ids, msg_ids):
+    """ Deletes the batches PubSub gave a msg_id to; the others stay for another try """
+    published = 0
+    for batch_id, msg_id in zip(batch_ids, msg_ids):
+        if msg_id:
+            print("Pub/Sub msg_id was created: {}".format(msg_id))
+            delete_batch(dbconn, batch_id)
+            print('Successfully published batch {} data to the Cloud'.format(batch_id))
+            published += 1
+    if published:
+        dbconn.commit()
+        maintain(dbconn)
+    return published
+
+
+def maintain(dbconn, vacuum_pages=None, checkpoint_pages=None):
+    """ Gives a bounded number of free pages back to the file system and checkpoints
+    the write-ahead log once it has grown past checkpoint_pages.
+
+    Unlike a full VACUUM this never rewrites the whole database, so the syncer keeps
+    inserting while the backlog drains.
+    """
+    if vacuum_pages is None:
+        vacuum_pages = int(config.DREAM_VACUUM_PAGES)
+    if checkpoint_pages is None:
+        checkpoint_pages = int(config.DREAM_CHECKPOINT_PAGES)
+
+    free_pages, = dbconn.execute("PRAGMA freelist_count").fetchone()
+    if free_pages and vacuum_pages:
+        # executescript steps the pragma to the end, execute would free a single page
+        dbconn.executescript("PRAGMA incremental_vacuum({});".format(min(free_pages, vacuum_pages)))
+
+    page_size, = dbconn.execute("PRAGMA page_size").fetchone()
+    for _seq, name, path in dbconn.execute("PRAGMA database_list").fetchall():
+        wal = path + '-wal'
+        if name == 'main' and path and os.path.exists(wal):
+            if os.path.getsize(wal) // page_size > checkpoint_pages:
+                # PASSIVE never waits for the syncer, it copies what it can right now
+                dbconn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+
+
+def publish_next_batch(dbconn, max_batches=None):
+    """ Publishes the oldest batch, or up to max_batches of them when there is a backlog """
+    if max_batches is None:
+        max_batches = int(config.DREAM_PUBLISH_MAX_BATCHES)
+
+    batch_ids = ready_batch_ids(dbconn, max_batches)
+    while len(batch_ids) < max_batches:
+        batch_id = create_unique_batch(dbconn)
+        if batch_id is None:
+            break
+        batch_ids.append(batch_id)
     dbconn.commit()
 
-    cursor = dbconn.cursor()
-    res = cursor.execute("SELECT min(batch_id) FROM measurements WHERE batch_id > 0")
-    batch_id, = res.fetchone()
-    if batch_id:
-        publish_batch(dbconn, batch_id)
+    if len(batch_ids) > 1:
+        publish_batches(dbconn, batch_ids)
+    elif batch_ids:
+        publish_batch(dbconn, batch_ids[0])
     else:
         print("Not enough payloads to create a batch")
 
 
-def generate_sample_payloads(dbconn):
-    cursor = dbconn.cursor()
+@follows_compact
+def oldest_batch_id(dbconn):
+    res = dbconn.execute("SELECT min(batch_id) FROM {} WHERE batch_id > 0".format(measurements_table(dbconn)))
+    batch_id, = res.fetchone()
+    return batch_id
+
+
+def pending_rows(dbconn):
+    """ How many rows wait for a batch """
+    pending, = dbconn.execute("SELECT pending FROM batch_state").fetchone()
+    return pending
+
+
+@follows_compact
+def ready_batch_ids(dbconn, limit):
+    """ The oldest batches that were created but not published yet """
     sql = """
-        INSERT OR IGNORE INTO measurements
-        (
-            timestamp,
-            tag_id,
-            measurements,
-            hci,
-            rssi
-        )
-        VALUES
-        (
-            ?,
-            ?,
-            ?,
-            ?,
-            ?
-        )
+        SELECT DISTINCT batch_id FROM {}
+        WHERE batch_id > 0
+        ORDER BY batch_id
+        LIMIT :limit
+    """.format(measurements_table(dbconn))
+    return [batch_id for batch_id, in dbconn.execute(sql, dict(limit=limit))]
+
+
+def migrate_to_compact(dbconn, chunk_size=10000):
+    """ Moves every row from the measurements table to the compact schema.
+
+    The syncer and the batcher can keep running: the oldest rows move over in short
+    transactions, and the last ones move in the same transaction that drops the old
+    table, which is when everybody switches to the compact tables.
+    """
+    if 'measurements' not in tables(dbconn):
+        return
+    create_schema(dbconn)
+    create_compact_schema(dbconn)
+
+    moved = 0
+    done = False
+    while not done:
+        with write_lock(dbconn):
+            count = _move_to_compact(dbconn, chunk_size)
+            done = count < chunk_size
+            if done:
+                # the table is empty and nobody can add a row before it's gone
+                dbconn.execute("DROP TABLE measurements")
+                forget_schema(dbconn)
+        moved += count
+        print('{} rows moved to the compact schema'.format(moved))
+
+    # hand the old table's pages back in one go
+    dbconn.executescript("PRAGMA incremental_vacuum;")
+
+
+def _move_to_compact(dbconn, chunk_size):
+    sql = """
+        SELECT rowid, batch_id, timestamp, tag_id, measurements, hci, rssi
+        FROM measurements
+        ORDER BY rowid
+        LIMIT :chunk_size
     """
+    chunk = dbconn.execute(sql, dict(chunk_size=chunk_size)).fetchall()
+    if chunk:
+        rows = [tuple(row)[2:] for row in chunk]
+        _insert_compact(rows, dbconn.cursor(), batch_ids=[row['batch_id'] for row in chunk])
+        dbconn.execute("DELETE FROM measurements WHERE rowid <= :rowid", dict(rowid=chunk[-1]['rowid']))
+    return len(chunk)
+
+
+def generate_sample_payloads(dbconn):
     with open('fixtures/sample_rows.txt') as src:
         lines = src.readlines()
-        rows = [row.strip().split(',') for row in lines]
-        cursor.executemany(sql, rows)
+        rows = [tuple(row.strip().split(',')) for row in lines]
+        insert(rows, dbconn.cursor(), many=True)
     dbconn.commit()
 
 
 USAGE = """
-Usage: dream.batcher  [--reset|--set-batch-id|--next-batch|--genpayloads]
+Usage: dream.batcher  [--reset|--set-batch-id|--next-batch|--genpayloads|--compact]
 
 Options:
     --reset     Reset the datebase
+    --compact   Move the database to the compact schema, while the Hub keeps running
     -h --help   Show this screen.
 """
 
@@ -175,14 +655,20 @@ def main(dbconn):
         dbconn.close()
         sys.exit()
 
+    from dream.pipeline import PublishPipeline
+
+    pipeline = PublishPipeline(dbconn)
+
     signal.signal(signal.SIGHUP, stop)
     signal.signal(signal.SIGINT, stop)
     signal.signal(signal.SIGTERM, stop)
     signal.signal(signal.SIGTSTP, stop)
+    # the Soracom hooks send these when the cellular link comes up and goes down
+    signal.signal(signal.SIGUSR1, lambda signum, frame: pipeline.resume())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: pipeline.pause())
 
-    while True:
-        publish_next_batch(dbconn)
-        time.sleep(1)
+    pipeline.start()
+    pipeline.run(idle=int(config.DREAM_BATCHER_IDLE_MS) / 1000.0)
 
 if __name__ == "__main__":
     from docopt import docopt
@@ -190,16 +676,24 @@ if __name__ == "__main__":
     args = docopt(USAGE)
 
     dbconn = dbconnect()
+    # adds whatever is missing, e.g. batch_state on hubs that were set up before it existed
+    create_schema(dbconn)
 
     if args['--reset']:
         dbconn.execute('DROP TABLE IF EXISTS measurements')
+        dbconn.execute('DROP TABLE IF EXISTS readings')
+        dbconn.execute('DROP TABLE IF EXISTS tags')
+        dbconn.execute('DROP TABLE IF EXISTS batch_state')
         dbconn.commit()
+        forget_schema(dbconn)
         create_schema(dbconn)
     elif args['--set-batch-id']:
         create_unique_batch(dbconn)
         dbconn.commit()
     elif args['--next-batch']:
         publish_next_batch(dbconn)
+    elif args['--compact']:
+        migrate_to_compact(dbconn)
     elif args['--genpayloads']:
         for x in xrange(200):
             generate_sample_payloads(dbconn)
@@ -0,0 +1,248 @@
+from dream import batcher
+
+
+def make_rows(count, start=1539648250):
+    return [
+        dict(timestamp=start + i, tag_id="tag{}".format(i % 3),
+             measurements="f5039700f3ffc208", hci=0, rssi=-57)
+        for i in range(count)
+    ]
+
+
+def pending(dbconn):
+    count, = dbconn.execute("SELECT pending FROM batch_state").fetchone()
+    return count
+
+
+def test_batch_state_tracks_pending_rows():
+    dbconn = batcher.dbconnect(':memory:')
+    batcher.create_schema(dbconn)
+    batcher.insert(make_rows(10), dbconn.cursor(), many=True)
+    dbconn.commit()
+    assert pending(dbconn) == 10
+
+    dbconn.execute("UPDATE measurements SET batch_id = 7 WHERE rowid <= 4")
+    assert pending(dbconn) == 6
+    dbconn.execute("DELETE FROM measurements WHERE batch_id = 0 AND rowid > 8")
+    assert pending(dbconn) == 4
+    dbconn.execute("DELETE FROM measurements WHERE batch_id = 7")
+    assert pending(dbconn) == 4
+
+
+def test_create_unique_batch_takes_the_oldest_rows():
+    dbconn = batcher.dbconnect(':memory:')
+    batcher.create_schema(dbconn)
+    batcher.insert(make_rows(25), dbconn.cursor(), many=True)
+
+    batcher.create_unique_batch(dbconn, batch_size=10)
+    batcher.create_unique_batch(dbconn, batch_size=10)
+    # only 5 rows left, not enough for another batch
+    batcher.create_unique_batch(dbconn, batch_size=10)
+    dbconn.commit()
+
+    batches = dbconn.execute(
+        "SELECT batch_id, count(*), min(rowid), max(rowid) FROM measurements GROUP BY batch_id").fetchall()
+    assert [tuple(row) for row in batches] == [(0, 5, 21, 25), (1, 10, 1, 10), (2, 10, 11, 20)]
+    assert pending(dbconn) == 5
+
+
+def test_split_batch_moves_the_rows_past_the_size_into_a_new_batch():
+    dbconn = batcher.dbconnect(':memory:')
+    batcher.create_schema(dbconn)
+    batcher.insert(make_rows(25), dbconn.cursor(), many=True)
+    batcher.create_unique_batch(dbconn, batch_size=20)
+
+    assert batcher.split_batch(dbconn, 1, 8) == 2
+    assert batcher.split_batch(dbconn, 2, 8) == 3
+    # 4 rows fit in a batch of 8
+    assert batcher.split_batch(dbconn, 3, 8) is None
+    dbconn.commit()
+
+    batches = dbconn.execute(
+        "SELECT batch_id, count(*), min(rowid), max(rowid) FROM measurements GROUP BY batch_id").fetchall()
+    assert [tuple(row) for row in batches] == [(0, 5, 21, 25), (1, 8, 1, 8), (2, 8, 9, 16), (3, 4, 17, 20)]
+    assert pending(dbconn) == 5
+    assert batcher.create_unique_batch(dbconn, batch_size=2) == 4
+
+
+def test_create_schema_picks_up_existing_rows():
+    dbconn = batcher.dbconnect(':memory:')
+    batcher.create_schema(dbconn)
+    # what a database from before batch_state looks like
+    for trigger in ["pending_on_insert", "pending_on_delete", "pending_on_update"]:
+        dbconn.execute("DROP TRIGGER {}".format(trigger))
+    dbconn.execute("DROP TABLE batch_state")
+    batcher.insert(make_rows(12), dbconn.cursor(), many=True)
+    dbconn.execute("UPDATE measurements SET batch_id = 3 WHERE rowid <= 2")
+    dbconn.commit()
+
+    batcher.create_schema(dbconn)
+    next_batch_id, count = dbconn.execute("SELECT next_batch_id, pending FROM batch_state").fetchone()
+    assert (next_batch_id, count) == (4, 10)
+
+
+def test_publish_batch_reclaims_free_pages(tmpdir, monkeypatch):
+    monkeypatch.setattr(batcher.config, "DREAM_PAYLOAD_FORMAT", "csv")
+    dbconn = batcher.dbconnect(str(tmpdir.join('measurements.db')))
+    batcher.create_schema(dbconn)
+    assert dbconn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    assert dbconn.execute("PRAGMA auto_vacuum").fetchone()[0] == batcher.AUTO_VACUUM_INCREMENTAL
+
+    batcher.insert(make_rows(5000), dbconn.cursor(), many=True)
+    batcher.create_unique_batch(dbconn, batch_size=4000)
+    dbconn.commit()
+    size_before, = dbconn.execute("PRAGMA page_count").fetchone()
+
+    payloads = []
+    batcher.publish_batch(dbconn, 1, send_batch=lambda payload: payloads.append(payload) or "msg-1")
+    assert payloads[0].count("\n") == 3999
+    assert dbconn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert dbconn.execute("PRAGMA page_count").fetchone()[0] < size_before
+
+
+def test_maintain_shrinks_the_write_ahead_log(tmpdir, monkeypatch):
+    monkeypatch.setattr(batcher.config, "DREAM_WAL_SIZE_LIMIT", "65536")
+    monkeypatch.setattr(batcher.config, "DREAM_WAL_AUTOCHECKPOINT", "0")
+    path = str(tmpdir.join('measurements.db'))
+    dbconn = batcher.dbconnect(path)
+    batcher.create_schema(dbconn)
+    # a long offline stretch
+    batcher.insert(make_rows(20000), dbconn.cursor(), many=True)
+    dbconn.commit()
+    assert tmpdir.join('measurements.db-wal').size() > 65536
+
+    batcher.maintain(dbconn, checkpoint_pages=0)
+    batcher.insert(make_rows(1), dbconn.cursor(), many=True)
+    dbconn.commit()
+    assert tmpdir.join('measurements.db-wal').size() <= 65536
+
+
+def publish_all(dbconn, batch_size):
+    payloads = []
+    batcher.create_unique_batch(dbconn, batch_size=batch_size)
+    dbconn.commit()
+    batch_id = batcher.oldest_batch_id(dbconn)
+    batcher.publish_batch(dbconn, batch_id, send_batch=lambda payload: payloads.append(payload) or "msg-1")
+    return payloads
+
+
+def test_compact_schema_publishes_the_same_payload(monkeypatch):
+    monkeypatch.setattr(batcher.config, "DREAM_PAYLOAD_FORMAT", "csv")
+    rows = make_rows(30)
+    rows[4]["measurements"] = "4c036100bdff0f08"
+
+    legacy = batcher.dbconnect(':memory:')
+    batcher.create_schema(legacy)
+    batcher.insert(rows, legacy.cursor(), many=True)
+
+    compact = batcher.dbconnect(':memory:')
+    batcher.create_schema(compact)
+    batcher.migrate_to_compact(compact)
+    assert batcher.is_compact(compact)
+    batcher.insert(rows, compact.cursor(), many=True)
+
+    expected = publish_all(legacy, batch_size=20)
+    assert expected[0].startswith("1539648250,tag0,f5039700f3ffc208,0,-57\n1539648253,,")
+    assert publish_all(compact, batch_size=20) == expected
+    assert pending(compact) == pending(legacy) == 10
+
+
+def test_the_schema_is_looked_up_once_per_connection(tmpdir, monkeypatch):
+    monkeypatch.setattr(batcher.config, "DREAM_PAYLOAD_FORMAT", "csv")
+    path = str(tmpdir.join('measurements.db'))
+    hub = batcher.dbconnect(path)
+    batcher.create_schema(hub)
+    batcher.insert(make_rows(25), hub.cursor(), many=True)
+    hub.commit()
+
+    lookups = []
+    tables = batcher.tables
+    monkeypatch.setattr(batcher, "tables", lambda dbconn: lookups.append(dbconn) or tables(dbconn))
+    assert batcher.create_unique_batch(hub, batch_size=10) == 1
+    batcher.insert(make_rows(5, start=1539648300), hub.cursor(), many=True)
+    hub.commit()
+    assert lookups == []
+
+    # `dream.batcher --compact` in another process
+    migrator = batcher.dbconnect(path)
+    batcher.migrate_to_compact(migrator)
+    assert batcher.is_compact(migrator)
+
+    batcher.insert(make_rows(5, start=1539648400), hub.cursor(), many=True)
+    assert batcher.create_unique_batch(hub, batch_size=10) == 2
+    hub.commit()
+    assert batcher.is_compact(hub)
+    assert lookups.count(hub) == 1
+    assert sorted(row[0] for row in batcher.batch_rows(hub, 1)) == list(range(1539648250, 1539648260))
+
+
+def test_migrate_to_compact_keeps_rows_and_batches():
+    dbconn = batcher.dbconnect(':memory:')
+    batcher.create_schema(dbconn)
+    batcher.insert(make_rows(25), dbconn.cursor(), many=True)
+    batcher.create_unique_batch(dbconn, batch_size=10)
+    dbconn.commit()
+
+    batcher.migrate_to_compact(dbconn, chunk_size=7)
+    assert 'measurements' not in batcher.tables(dbconn)
+    assert pending(dbconn) == 15
+    batches = dbconn.execute(
+        "SELECT batch_id, count(*), min(timestamp), max(timestamp) FROM readings GROUP BY batch_id").fetchall()
+    assert [tuple(row) for row in batches] == [(0, 15, 1539648260, 1539648274), (1, 10, 1539648250, 1539648259)]
+
+    # new rows line up behind the migrated ones
+    batcher.insert(make_rows(5, start=1539648300), dbconn.cursor(), many=True)
+    batcher.create_unique_batch(dbconn, batch_size=15)
+    dbconn.commit()
+    assert pending(dbconn) == 5
+    assert dbconn.execute("SELECT min(timestamp) FROM readings WHERE batch_id = 2").fetchone()[0] == 1539648260
+    assert dbconn.execute("SELECT count(*) FROM tags").fetchone()[0] == 3
+
+
+def random_batch(rng, count):
+    tag_ids = ['%012x' % rng.getrandbits(48) for _ in range(rng.randint(1, 20))]
+    timestamp = 1539648250
+    rows = []
+    for _ in range(count):
+        timestamp += rng.choice([0, 0, 1, 2, -1, 3600, -7200])
+        measurements = '%016x' % rng.getrandbits(64)
+        rows.append((timestamp, rng.choice(tag_ids), measurements, rng.choice([0, 1]), rng.randint(-127, 0)))
+    # the order batch_rows gives them in
+    return sorted(rows, key=lambda row: row[1])
+
+
+def test_columnar_payload_gives_the_same_rows_as_csv():
+    import random
+    from dream.drainer import helpers
+
+    for seed in range(50):
+        rng = random.Random(seed)
+        rows = random_batch(rng, rng.randint(0, 500))
+        expected = list(helpers.rows_from_payloads(batcher.csv_payload(rows), "hub"))
+        assert list(helpers.rows_from_batch(batcher.columnar_payload(rows), "hub")) == expected
+
+
+def test_batch_payload_formats():
+    dbconn = batcher.dbconnect(':memory:')
+    batcher.create_schema(dbconn)
+    batcher.insert(make_rows(12), dbconn.cursor(), many=True)
+    batcher.create_unique_batch(dbconn, batch_size=10)
+
+    csv = batcher.batch_payload(dbconn, 1, payload_format='csv')
+    assert csv.startswith("1539648250,tag0,f5039700f3ffc208,0,-57\n1539648253,,")
+    columnar = batcher.batch_payload(dbconn, 1, payload_format='columnar')
+    assert columnar.startswith(batcher.COLUMNAR_MAGIC)
+    assert len(columnar) < len(csv) // 2
+
+
+def test_a_batch_the_columnar_format_cant_hold_goes_out_as_csv():
+    rows = make_rows(12)
+    # one character short, it would shift the measurements of every row after it
+    rows[4]["measurements"] = "f5039700f3ffc20"
+    dbconn = batcher.dbconnect(':memory:')
+    batcher.create_schema(dbconn)
+    batcher.insert(rows, dbconn.cursor(), many=True)
+    batcher.create_unique_batch(dbconn, batch_size=10)
+
+    payload = batcher.batch_payload(dbconn, 1, payload_format='columnar')
+    assert payload == batcher.batch_payload(dbconn, 1, payload_format='csv')
@@ -0,0 +1,288 @@
+# this file is used for performance testing
+#
+# It pushes replayed BLE advertisements through the whole Hub pipeline on one
+# machine, without radios, Redis or Google:
+#
+#   sniffer.PushDelegate -> PacketBundler -> syncer.batch (celery eager mode)
+#       -> batcher.insert -> SQLite <- create_unique_batch <- publish_batch
+#
+# With --embedded, PacketBundler hands its bundles to ingest.EmbeddedSyncer instead.
+#
+# publish_batch runs in its own thread like the batcher service, with a stubbed
+# send_batch. The results are printed as JSON so runs can be compared between
+# releases, e.g.
+#
+#   python -m dream.benchmark --tags 100,1000 --batch-sizes 2000,20000 > before.json
+#
+# Every configuration runs in a Python process of its own, so its peak_rss_kb is its own.
+
+from __future__ import division, print_function
+
+import json
+from itertools import islice
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from dream import batcher, config
+from dream.drainer.helpers import rows_from_batch
+from dream.replay import ReplayScanner, tag_population
+
+HUB_ID = platform.node()
+
+
+def percentiles(samples):
+    """ Summarizes latencies (in seconds) as milliseconds """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p99": at(0.99),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def database_bytes(path):
+    return sum(os.path.getsize(name) for name in (path, path + '-wal') if os.path.exists(name))
+
+
+class TimedCleaner(object):
+    """ Wraps the syncer task that PacketBundler pushes to and times each call """
+
+    def __init__(self, task):
+        self.task = task
+        self.latencies = []
+
+    def delay(self, bundle, hci):
+        started = time.time()
+        self.task.delay(bundle, hci)
+        self.latencies.append(time.time() - started)
+
+
+class StubPublisher(object):
+    """ Stands in for gpub.send_batch and remembers what it was sent """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def __call__(self, payload):
+        time.sleep(self.latency)
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        self.messages += 1
+        self.rows += sum(1 for _row in rows_from_batch(payload, HUB_ID))
+        self.bytes += len(payload)
+        return {"messageIds": [str(self.messages)]}
+
+
+class BenchmarkBatcher(threading.Thread):
+    """ Runs the batcher loop on its own connection until told to stop """
+
+    def __init__(self, path, batch_size, send_batch, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.batch_size = batch_size
+        self.send_batch = send_batch
+        self.interval = interval
+        self.create_latencies = []
+        self.publish_latencies = []
+        self.peak_bytes = database_bytes(path)
+        self.finished = threading.Event()
+
+    def run(self):
+        dbconn = batcher.dbconnect(self.path)
+        while True:
+            # once ingest is done, keep going until no full batch is left
+            draining = self.finished.is_set()
+
+            started = time.time()
+            batcher.create_unique_batch(dbconn, self.batch_size)
+            dbconn.commit()
+            self.create_latencies.append(time.time() - started)
+
+            batch_id = batcher.oldest_batch_id(dbconn)
+            if batch_id:
+                started = time.time()
+                batcher.publish_batch(dbconn, batch_id, send_batch=self.send_batch)
+                self.publish_latencies.append(time.time() - started)
+            elif draining:
+                break
+
+            self.peak_bytes = max(self.peak_bytes, database_bytes(self.path))
+            time.sleep(self.interval)
+        dbconn.close()
+
+
+def run_once(tags, batch_size, packets, rate, send_latency, interval, workdir, embedded=False):
+    from dream.sniffer import PushDelegate
+
+    path = os.path.join(workdir, 'measurements-{}-{}.db'.format(tags, batch_size))
+    config.DREAM_DB = path
+    dbconn = batcher.dbconnect(path)
+    batcher.create_schema(dbconn)
+    dbconn.close()
+    start_bytes = database_bytes(path)
+
+    send_batch = StubPublisher(send_latency)
+    batch_thread = BenchmarkBatcher(path, batch_size, send_batch, interval)
+
+    if embedded:
+        from dream.ingest import EmbeddedSyncer
+        writer = EmbeddedSyncer(path)
+        writer.start()
+        cleaner = TimedCleaner(writer)
+    else:
+        from dream import syncer
+        # run the syncer task in process instead of through redis
+        syncer.app.conf.task_always_eager = True
+        cleaner = TimedCleaner(syncer.batch)
+    delegate = PushDelegate(0, cleaner=cleaner)
+
+    # time every discovery, minus the syncer work it triggered
+    sniffer_latencies = []
+    handle_discovery = delegate.handleDiscovery
+
+    def timed_discovery(entry, is_new, is_new_data):
+        syncs = len(cleaner.latencies)
+        started = time.time()
+        handle_discovery(entry, is_new, is_new_data)
+        elapsed = time.time() - started
+        if len(cleaner.latencies) > syncs:
+            elapsed -= cleaner.latencies[-1]
+        sniffer_latencies.append(elapsed)
+
+    delegate.handleDiscovery = timed_discovery
+
+    source = islice(tag_population(tags=tags), packets)
+    scanner = ReplayScanner(source, rate=rate).withDelegate(delegate)
+
+    started = time.time()
+    batch_thread.start()
+    while not scanner.exhausted:
+        scanner.process(1)
+    delegate.bundler.flush()
+    # commit what the syncer's writer still holds, the next run uses another database
+    if not embedded:
+        writer = syncer.get_writer()
+        syncer.writer = None
+    writer.close()
+    ingest_seconds = time.time() - started
+    batch_thread.finished.set()
+    batch_thread.join()
+    total_seconds = time.time() - started
+    end_bytes = database_bytes(path)
+
+    return {
+        "embedded": embedded,
+        "tags": tags,
+        "batch_size": batch_size,
+        "packets": scanner.delivered,
+        "throughput": {
+            "ingest_packets_per_second": round(scanner.delivered / ingest_seconds, 1),
+            "published_rows_per_second": round(send_batch.rows / total_seconds, 1),
+            "published_rows": send_batch.rows,
+            "published_messages": send_batch.messages,
+            "published_bytes": send_batch.bytes,
+        },
+        "syncer_commits": writer.stats(),
+        "latency_ms": {
+            "sniffer": percentiles(sniffer_latencies),
+            "syncer": percentiles(cleaner.latencies),
+            "create_batch": percentiles(batch_thread.create_latencies),
+            "publish": percentiles(batch_thread.publish_latencies),
+        },
+        "sqlite_bytes": {
+            "start": start_bytes,
+            "peak": max(batch_thread.peak_bytes, end_bytes),
+            "end": end_bytes,
+        },
+        # ru_maxrss is in kilobytes on Linux and never goes down, hence a process a run
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "seconds": round(total_seconds, 3),
+    }
+
+
+USAGE = """
+Usage: dream.benchmark [options]
+
+Options:
+    --tags=<list>           Comma separated tag counts to run [default: 100,1000]
+    --batch-sizes=<list>    Comma separated BATCH_SIZE values to run [default: 2000,20000]
+    --packets=<n>           Advertisements per run [default: 100000]
+    --rate=<n>              Advertisements per second, unthrottled if not given
+    --send-latency=<s>      Seconds the stubbed send_batch takes [default: 0]
+    --interval=<s>          Seconds the batcher sleeps between rounds [default: 1]
+    --embedded              Write from the sniffer's process like `dream.sniffer --embedded`
+    --output=<file>         Write the JSON report here instead of stdout
+    --in-process            Run every configuration in this process, peak_rss_kb then includes the earlier runs
+    -h --help               Show this screen.
+"""
+
+def run_isolated(tags, batch_size, args):
+    """ Runs one configuration in a new Python process and returns its report """
+    command = [sys.executable, '-m', 'dream.benchmark', '--in-process',
+               '--tags={}'.format(tags), '--batch-sizes={}'.format(batch_size),
+               '--packets={}'.format(args['--packets']), '--send-latency={}'.format(args['--send-latency']),
+               '--interval={}'.format(args['--interval'])]
+    if args['--rate']:
+        command.append('--rate={}'.format(args['--rate']))
+    if args['--embedded']:
+        command.append('--embedded')
+    return json.loads(subprocess.check_output(command).decode('utf-8'))["runs"][0]
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    args = docopt(USAGE)
+    rate = float(args['--rate']) if args['--rate'] else None
+
+    workdir = tempfile.mkdtemp(prefix='dream-benchmark-')
+    report = {
+        "started": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "runs": [],
+    }
+
+    # the pipeline prints a line per packet; keep the report readable
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for tags in [int(x) for x in args['--tags'].split(',')]:
+            for batch_size in [int(x) for x in args['--batch-sizes'].split(',')]:
+                if not args['--in-process']:
+                    report["runs"].append(run_isolated(tags, batch_size, args))
+                    continue
+                report["runs"].append(run_once(
+                    tags, batch_size, int(args['--packets']), rate,
+                    float(args['--send-latency']), float(args['--interval']), workdir,
+                    embedded=args['--embedded']))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(workdir)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args['--output']:
+        with open(args['--output'], 'w') as dst:
+            dst.write(output + "\n")
+    else:
+        print(output)
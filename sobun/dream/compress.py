@@ -0,0 +1,68 @@
+# this file compresses payloads before they go over the cellular link
+#
+# The payloads are CSV full of hex and repeated timestamps, so they compress
+# several-fold. The Hub tells the drainer how a message is compressed with the
+# message's `encoding` attribute; messages without one are plain text.
+#
+#   identity   not compressed (no attribute is sent)
+#   zlib       zlib stream
+#   gzip       gzip file
+#   zstd       zstandard frame, if the `zstandard` package is installed
+
+from __future__ import print_function
+
+import zlib
+
+ENCODINGS = ('identity', 'zlib', 'gzip', 'zstd')
+
+# zlib's wbits for a gzip header and trailer instead of zlib's
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+LEVELS = {'zlib': 6, 'gzip': 6, 'zstd': 3}
+
+
+def available(encoding):
+    if encoding == 'zstd':
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            return False
+        return True
+    return encoding in ENCODINGS
+
+
+def choose(encoding):
+    """ The encoding to use for the configured one; zstd falls back to gzip without zstandard """
+    if encoding not in ENCODINGS:
+        raise ValueError("unknown encoding {}, use one of {}".format(encoding, ", ".join(ENCODINGS)))
+    if not available(encoding):
+        print("{} isn't available, using gzip".format(encoding))
+        return 'gzip'
+    return encoding
+
+
+def compress(data, encoding):
+    if encoding == 'identity':
+        return data
+    if encoding == 'zlib':
+        return zlib.compress(data, LEVELS['zlib'])
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(LEVELS['gzip'], zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=LEVELS['zstd']).compress(data)
+    raise ValueError("unknown encoding {}".format(encoding))
+
+
+def decompress(data, encoding):
+    if encoding == 'identity':
+        return data
+    if encoding == 'zlib':
+        return zlib.decompress(data)
+    if encoding == 'gzip':
+        return zlib.decompress(data, GZIP_WBITS)
+    if encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError("unknown encoding {}".format(encoding))
@@ -0,0 +1,19 @@
+from dream import compress
+
+
+def sample_payload():
+    with open('fixtures/sample_rows.txt', 'rb') as src:
+        return src.read()
+
+
+def test_round_trip():
+    data = sample_payload()
+    for encoding in ['identity', 'zlib', 'gzip', 'zstd']:
+        if compress.available(encoding):
+            assert compress.decompress(compress.compress(data, encoding), encoding) == data
+    assert len(compress.compress(data, 'gzip')) < len(data) // 3
+
+
+def test_choose():
+    assert compress.choose('zlib') == 'zlib'
+    assert compress.choose('zstd') == ('zstd' if compress.available('zstd') else 'gzip')
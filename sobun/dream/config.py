@@ -13,3 +13,69 @@ GOOGLE_PUBSUB_TOPIC = os.environ.get("GOOGLE_PUBSUB_TOPIC ", "batched-payloads")
 BATCH_SIZE = os.environ.get("BATCH_SIZE", "20000")
 DREAM_PUBSUB_TIMEOUT = os.environ.get("DREAM_PUBSUB_TIMEOUT", "300")
 GOOGLE_APPLICATION_CREDENTIALS = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS", "./google-credentials.secret.json")
+DREAM_DB = os.environ.get("DREAM_DB", "measurements.db")
+
+# The BigQuery table the drainer fills, which `python -m dream.healthz` counts
+DREAM_BIGQUERY_DATASET = os.environ.get("DREAM_BIGQUERY_DATASET", "dream_assets_raw_packets")
+DREAM_BIGQUERY_TABLE = os.environ.get("DREAM_BIGQUERY_TABLE", "measurements_table")
+
+# SQLite maintenance after every publish: reclaim at most DREAM_VACUUM_PAGES free pages and
+# checkpoint the write-ahead log once it holds more than DREAM_CHECKPOINT_PAGES pages.
+# DREAM_WAL_AUTOCHECKPOINT is SQLite's own backstop in case the batcher isn't running.
+DREAM_VACUUM_PAGES = os.environ.get("DREAM_VACUUM_PAGES", "500")
+DREAM_CHECKPOINT_PAGES = os.environ.get("DREAM_CHECKPOINT_PAGES", "1000")
+DREAM_WAL_AUTOCHECKPOINT = os.environ.get("DREAM_WAL_AUTOCHECKPOINT", "10000")
+# Bytes the write-ahead log is cut back to once a checkpoint has emptied it, otherwise
+# it stays as big as the longest offline stretch made it
+DREAM_WAL_SIZE_LIMIT = os.environ.get("DREAM_WAL_SIZE_LIMIT", "4194304")
+
+# The syncer commits its rows once it has DREAM_SYNC_COMMIT_ROWS of them or the oldest
+# has waited DREAM_SYNC_COMMIT_MS milliseconds. Uncommitted rows are lost if it crashes.
+DREAM_SYNC_COMMIT_ROWS = os.environ.get("DREAM_SYNC_COMMIT_ROWS", "1000")
+DREAM_SYNC_COMMIT_MS = os.environ.get("DREAM_SYNC_COMMIT_MS", "500")
+# Past DREAM_SYNC_MAX_BUFFERED_ROWS waiting rows new ones are dropped, and a commit that
+# keeps failing is given up (and its rows dropped) after DREAM_SYNC_COMMIT_ATTEMPTS tries
+DREAM_SYNC_MAX_BUFFERED_ROWS = os.environ.get("DREAM_SYNC_MAX_BUFFERED_ROWS", "100000")
+DREAM_SYNC_COMMIT_ATTEMPTS = os.environ.get("DREAM_SYNC_COMMIT_ATTEMPTS", "5")
+
+# `dream.sniffer --embedded` queues up to DREAM_EMBEDDED_QUEUE bundles for its writer thread.
+# When the queue is full the scanner waits up to DREAM_EMBEDDED_PUT_TIMEOUT_MS, then drops the bundle.
+DREAM_EMBEDDED_QUEUE = os.environ.get("DREAM_EMBEDDED_QUEUE", "100")
+DREAM_EMBEDDED_PUT_TIMEOUT_MS = os.environ.get("DREAM_EMBEDDED_PUT_TIMEOUT_MS", "100")
+
+# The sniffer sends its packets in bundles of up to DREAM_BUNDLE_SIZE packets or DREAM_BUNDLE_MAX_BYTES,
+# and sends a bundle anyway once its first packet is DREAM_BUNDLE_MAX_AGE_MS old.
+DREAM_BUNDLE_SIZE = os.environ.get("DREAM_BUNDLE_SIZE", "100")
+DREAM_BUNDLE_MAX_BYTES = os.environ.get("DREAM_BUNDLE_MAX_BYTES", "65536")
+DREAM_BUNDLE_MAX_AGE_MS = os.environ.get("DREAM_BUNDLE_MAX_AGE_MS", "2000")
+
+# With a backlog, the batcher publishes up to DREAM_PUBLISH_MAX_BATCHES batches in one PubSub request
+DREAM_PUBLISH_MAX_BATCHES = os.environ.get("DREAM_PUBLISH_MAX_BATCHES", "5")
+
+# The batcher keeps up to DREAM_PUBLISH_IN_FLIGHT publish requests going at once, each
+# on its own connection. It runs flat out while there is a backlog and checks for new
+# rows every DREAM_BATCHER_IDLE_MS when there isn't.
+DREAM_PUBLISH_IN_FLIGHT = os.environ.get("DREAM_PUBLISH_IN_FLIGHT", "3")
+DREAM_BATCHER_IDLE_MS = os.environ.get("DREAM_BATCHER_IDLE_MS", "1000")
+
+# When nothing gets through, the batcher waits DREAM_PUBLISH_BACKOFF_MIN_MS before trying
+# again, twice as long after every further failure, up to DREAM_PUBLISH_BACKOFF_MAX_MS.
+# While the Soracom hooks say the link is down, it only tries every DREAM_PUBLISH_BACKOFF_MAX_MS.
+DREAM_PUBLISH_BACKOFF_MIN_MS = os.environ.get("DREAM_PUBLISH_BACKOFF_MIN_MS", "1000")
+DREAM_PUBLISH_BACKOFF_MAX_MS = os.environ.get("DREAM_PUBLISH_BACKOFF_MAX_MS", "300000")
+
+# The batcher starts with batches of BATCH_SIZE rows and tunes the size between
+# DREAM_BATCH_SIZE_MIN and DREAM_BATCH_SIZE_MAX so that a publish request takes
+# about DREAM_PUBLISH_TARGET_MS, see pipeline.BatchSizer.
+DREAM_BATCH_SIZE_MIN = os.environ.get("DREAM_BATCH_SIZE_MIN", "2000")
+DREAM_BATCH_SIZE_MAX = os.environ.get("DREAM_BATCH_SIZE_MAX", "100000")
+DREAM_PUBLISH_TARGET_MS = os.environ.get("DREAM_PUBLISH_TARGET_MS", "30000")
+
+# How the batcher compresses payloads: identity, zlib, gzip or zstd (see compress.py).
+# Hubs don't find out what the drainer reads, so they send plain payloads until a
+# deployment opts in, once the drainer that reads the `encoding` attribute is live.
+DREAM_PUBLISH_ENCODING = os.environ.get("DREAM_PUBLISH_ENCODING", "identity")
+
+# DREAM_PAYLOAD_FORMAT is csv (a line per row) or columnar, see batcher.columnar_payload.
+# Like the encoding, it stays csv until a deployment's drainer reads columnar batches.
+DREAM_PAYLOAD_FORMAT = os.environ.get("DREAM_PAYLOAD_FORMAT", "csv")
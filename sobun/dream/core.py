@@ -1,19 +1,63 @@
+import time
+
+
+def packet_bytes(packet):
+    # about what the packet adds to the JSON message the bundle is sent in
+    if isinstance(packet, dict):
+        return sum(len(str(key)) + len(str(value)) + 6 for key, value in packet.items())
+    return len(str(packet))
+
+
 class PacketBundler(object):
+    """ Gathers packets and hands them to the cleaner (the syncer task) in bundles.
+
+    A bundle goes out once it has `bundle_size` packets, once it holds `max_bytes`
+    or once its first packet is `max_age` seconds old, whichever comes first.
+    Nothing else calls the bundler when no tags are around, so whoever runs the
+    scan calls expire() every now and then and flush() before stopping.
+    """
 
-    def __init__(self, cleaner, bundle_size=100, hci=0):
+    def __init__(self, cleaner, bundle_size=100, hci=0, max_age=None, max_bytes=None, clock=time.time):
         self.cleaner = cleaner
         self.bundle_size = bundle_size
         self.hci = hci
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.clock = clock
         self.bundle = []
+        self.bundle_bytes = 0
+        self.started = None
 
 
     def append(self, packet):
+        if not self.bundle:
+            self.started = self.clock()
         self.bundle.append(packet)
+        if self.max_bytes:
+            self.bundle_bytes += packet_bytes(packet)
+
+        if len(self.bundle) >= self.bundle_size:
+            self.push_to_queue()
+        elif self.max_bytes and self.bundle_bytes >= self.max_bytes:
+            self.push_to_queue()
+        else:
+            self.expire()
+
+
+    def expire(self):
+        """ Pushes the bundle if its first packet has waited max_age seconds """
+        if self.bundle and self.max_age is not None and self.clock() - self.started >= self.max_age:
+            self.push_to_queue()
+
 
-        if len(self.bundle) == self.bundle_size:
+    def flush(self):
+        """ Pushes whatever is in the bundle, e.g. before the sniffer exits """
+        if self.bundle:
             self.push_to_queue()
 
 
     def push_to_queue(self):
         self.cleaner.delay(self.bundle, self.hci)
         self.bundle = []
+        self.bundle_bytes = 0
+        self.started = None
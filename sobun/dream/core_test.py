@@ -11,3 +11,47 @@ def test_packet_bundler():
 
     cleaner.delay.assert_called_once_with(list(xrange(100)), 1)
     assert bundler.bundle == []
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_packet_bundler_pushes_old_bundles():
+    cleaner = Mock()
+    clock = FakeClock()
+    bundler = PacketBundler(cleaner, bundle_size=100, hci=1, max_age=2, clock=clock)
+    bundler.append("packet-1")
+    clock.now += 1
+    bundler.expire()
+    assert not cleaner.delay.called
+
+    clock.now += 1
+    bundler.expire()
+    cleaner.delay.assert_called_once_with(["packet-1"], 1)
+    assert bundler.bundle == []
+
+
+def test_packet_bundler_pushes_big_bundles():
+    cleaner = Mock()
+    bundler = PacketBundler(cleaner, bundle_size=100, max_bytes=25)
+    for packet in ["0123456789"] * 5:
+        bundler.append(packet)
+
+    cleaner.delay.assert_called_once_with(["0123456789"] * 3, 0)
+    assert bundler.bundle == ["0123456789"] * 2
+
+
+def test_packet_bundler_flush():
+    cleaner = Mock()
+    bundler = PacketBundler(cleaner, bundle_size=100)
+    bundler.flush()
+    assert not cleaner.delay.called
+
+    bundler.append("packet-1")
+    bundler.flush()
+    cleaner.delay.assert_called_once_with(["packet-1"], 0)
@@ -0,0 +1,145 @@
+# this file measures the drainer's cold start, with a stubbed BigQuery client
+#
+# The stub takes --latency milliseconds for every request it would make to Google,
+# and creating it takes as long, like finding the credentials does. It loads main.py
+# the way Cloud Functions does and hands it two messages:
+#
+#   import_seconds         loading main.py
+#   first_insert_seconds   from the first message to its first insert
+#   first_message_seconds  the first message, when a new instance makes its client
+#   next_message_seconds   the next message on the same instance
+#   requests               what the stub was asked for
+#
+#   cd sobun/dream/drainer && python benchmark.py --rows 20000 --latency 100
+
+import argparse
+import base64
+from collections import Counter
+import json
+import sys
+import threading
+import time
+import types
+import zlib
+
+
+class Stub(object):
+    latency = 0.1
+    requests = Counter()
+    first_insert = None
+    lock = threading.Lock()
+
+    @classmethod
+    def request(cls, name):
+        time.sleep(cls.latency)
+        with cls.lock:
+            cls.requests[name] += 1
+
+
+class StubClient(object):
+
+    def __init__(self):
+        Stub.request("client")
+
+    def dataset(self, dataset_id):
+        return StubDataset(dataset_id)
+
+    def get_table(self, table_ref):
+        Stub.request("get_table")
+        return StubTable(table_ref)
+
+    def insert_rows(self, table, rows, row_ids=None, skip_invalid_rows=False):
+        Stub.request("insert_rows")
+        with Stub.lock:
+            if Stub.first_insert is None:
+                Stub.first_insert = time.time()
+        return []
+
+    def insert_rows_json(self, table, rows):
+        Stub.request("insert_rows_json")
+        return []
+
+
+class StubDataset(object):
+
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+
+    def table(self, table_id):
+        return (self.dataset_id, table_id)
+
+
+class StubTable(object):
+
+    def __init__(self, table_ref, schema=None):
+        self.reference = table_ref
+        self.schema = schema
+
+
+class StubSchemaField(object):
+
+    def __init__(self, name, field_type):
+        self.name = name
+        self.field_type = field_type
+
+
+def stub_bigquery():
+    bigquery = types.ModuleType("google.cloud.bigquery")
+    bigquery.Client = StubClient
+    bigquery.Table = StubTable
+    bigquery.SchemaField = StubSchemaField
+    cloud = types.ModuleType("google.cloud")
+    cloud.bigquery = bigquery
+    google = types.ModuleType("google")
+    google.cloud = cloud
+    sys.modules.update({"google": google, "google.cloud": cloud, "google.cloud.bigquery": bigquery})
+
+
+def message(rows):
+    lines = "\n".join(
+        "{},{},f5039700f3ffc208,0,-57".format(1539648250 + i // 100, "tag{}".format(i % 100))
+        for i in range(rows))
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = gzip.compress(lines.encode("utf-8")) + gzip.flush()
+    return {"data": base64.b64encode(data).decode("ascii"),
+            "attributes": {"hub_id": "benchmark", "encoding": "gzip"}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the drainer's cold start with a stubbed BigQuery")
+    parser.add_argument("--rows", type=int, default=20000, help="rows in a message")
+    parser.add_argument("--latency", type=float, default=100, help="milliseconds a BigQuery request takes")
+    args = parser.parse_args()
+
+    Stub.latency = args.latency / 1000
+    stub_bigquery()
+    data = message(args.rows)
+
+    started = time.time()
+    import main as drainer
+    imported = time.time()
+
+    # the function's own prints would drown the results
+    stdout, sys.stdout = sys.stdout, open("/dev/null", "w")
+    try:
+        drainer.run(data, None)
+        first = time.time()
+        drainer.run(data, None)
+        done = time.time()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(json.dumps({
+        "rows": args.rows,
+        "latency_ms": args.latency,
+        "import_seconds": round(imported - started, 3),
+        "first_insert_seconds": round(Stub.first_insert - imported, 3),
+        "first_message_seconds": round(first - imported, 3),
+        "next_message_seconds": round(done - first, 3),
+        "requests": dict(Stub.requests),
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,21 @@
 from itertools import islice, chain
+import binascii
+import hashlib
+import struct
+import time
+import zlib
+
+# zlib's wbits for a gzip header and trailer instead of zlib's
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# BigQuery won't take these rows however often we try
+PERMANENT_ERRORS = ('invalid',)
+
+# The Hub's columnar batch format, see columnar_payload in dream/batcher.py
+COLUMNAR_MAGIC = b'DRMC'
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct('<4sBI')
+COLUMNAR_ROWS = struct.Struct('<I')
 
 
 def batch(iterable, size):
@@ -16,19 +33,170 @@ def batch(iterable, size):
             break
 
 
+def insert_concurrently(insert, rows, size, threads):
+    """
+    Calls insert() with lists of up to `size` rows from up to `threads` threads,
+    and returns what it returned (lists of errors) joined together. Only `threads` chunks are ever in memory
+    at once, since the rows can come from a generator.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        running = set()
+        for chunk in batch(rows, size):
+            if len(running) == threads:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    errors.extend(future.result())
+            running.add(executor.submit(insert, list(chunk)))
+        for future in running:
+            errors.extend(future.result())
+    return errors
+
+
+def insert_id(row):
+    """
+    The same row always gets the same insertId, so BigQuery can drop the copies
+    a message delivered again soon after inserts. It only remembers insertIds
+    for about a minute and on a best-effort basis, so it doesn't catch them all.
+    rssi and hci are part of the key, so a tag that sends the same measurements
+    twice within a second still gets two rows when the signal differs.
+    """
+    tag_id, measurements, hub_id, timestamp, rssi, hci = row
+    key = "{},{},{},{},{},{}".format(hub_id, tag_id, timestamp, measurements, rssi, hci)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def insert_with_retries(insert, rows, attempts, delay=1.0, sleep=time.sleep):
+    """
+    Calls insert(rows, row_ids) and tries again with only the rows that failed,
+    up to `attempts` times in all, waiting `delay` seconds and twice as long
+    each time after. insert() returns BigQuery's row errors, e.g.
+    [{"index": 3, "errors": [{"reason": "invalid", ...}]}].
+
+    Returns (row, errors) for the rows that never made it. Rows that are
+    invalid don't get another try, and if insert() still raises on the last
+    attempt the exception goes up.
+    """
+    row_ids = [insert_id(row) for row in rows]
+    given_up = []
+    for attempt in range(attempts):
+        if attempt:
+            sleep(delay * 2 ** (attempt - 1))
+        try:
+            errors = insert(rows, row_ids)
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            print("Inserting {} rows failed, trying again: {}".format(len(rows), e))
+            continue
+
+        errors_of = dict((error["index"], error["errors"]) for error in errors)
+        retry = []
+        for index in sorted(errors_of):
+            if attempt == attempts - 1 or any(error.get("reason") in PERMANENT_ERRORS for error in errors_of[index]):
+                given_up.append((rows[index], errors_of[index]))
+            else:
+                retry.append(index)
+        if not retry:
+            break
+        print("{} of {} rows failed to insert, trying them again".format(len(retry), len(rows)))
+        rows = [rows[index] for index in retry]
+        row_ids = [row_ids[index] for index in retry]
+    return given_up
+
+
+def decompress(data, encoding=None):
+    """
+    Undoes the compression named by the message's `encoding` attribute.
+    Messages from Hubs that don't compress have no attribute.
+    """
+    if encoding in (None, "", "identity"):
+        return data
+    if encoding == "zlib":
+        return zlib.decompress(data)
+    if encoding == "gzip":
+        return zlib.decompress(data, GZIP_WBITS)
+    if encoding == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError("unknown encoding {}".format(encoding))
+
+
 def rows_from_payloads(payloads, hub_id):
-    lines = payloads.split('\n')
-    rows = []
+    """
+    Yields the rows of a csv batch as it goes, without splitting it up front
+    """
     last_tag_id = None
-    for line in lines:
+    start = 0
+    while start < len(payloads):
+        end = payloads.find('\n', start)
+        if end == -1:
+            end = len(payloads)
+        line = payloads[start:end]
+        start = end + 1
         if line.strip() == "":
             continue
-        row = line.split(',')
-        timestamp, tag_id, measurements, hci, rssi = row
+        timestamp, tag_id, measurements, hci, rssi = line.split(',')
         if tag_id == "":
             tag_id = last_tag_id
         else:
             last_tag_id = tag_id
-        bigquery_row = (tag_id, measurements, hub_id, int(timestamp), int(rssi), int(hci))
-        rows.append(bigquery_row)
-    return rows
+        yield (tag_id, measurements, hub_id, int(timestamp), int(rssi), int(hci))
+
+
+def rows_from_batch(payload, hub_id):
+    """
+    The BigQuery rows of a message's (decompressed) data, in either batch format
+    """
+    if payload[:len(COLUMNAR_MAGIC)] == COLUMNAR_MAGIC:
+        return rows_from_columnar(payload, hub_id)
+    return rows_from_payloads(payload.decode('utf-8'), hub_id)
+
+
+def rows_from_columnar(payload, hub_id):
+    """
+    Yields the rows of a columnar batch one tag at a time, in the same
+    form as rows_from_payloads
+    """
+    data = bytearray(payload)
+    magic, version, blocks = COLUMNAR_HEADER.unpack_from(payload)
+    if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+        raise ValueError("not a version {} columnar batch".format(COLUMNAR_VERSION))
+
+    offset = COLUMNAR_HEADER.size
+    for _ in range(blocks):
+        length = data[offset]
+        tag_id = bytes(data[offset + 1:offset + 1 + length]).decode('ascii')
+        offset += 1 + length
+        count, = COLUMNAR_ROWS.unpack_from(payload, offset)
+        offset += COLUMNAR_ROWS.size
+
+        timestamps = []
+        timestamp = 0
+        for _ in range(count):
+            value, shift = 0, 0
+            while True:
+                byte = data[offset]
+                offset += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            # undo the zigzag
+            timestamp += (value >> 1) if value % 2 == 0 else -((value + 1) >> 1)
+            timestamps.append(timestamp)
+
+        hcis = struct.unpack_from('<{}B'.format(count), payload, offset)
+        offset += count
+        rssis = struct.unpack_from('<{}b'.format(count), payload, offset)
+        offset += count
+        measurements = binascii.hexlify(bytes(data[offset:offset + 8 * count])).decode('ascii')
+        offset += 8 * count
+
+        for i in range(count):
+            yield (tag_id, measurements[16 * i:16 * i + 16], hub_id, timestamps[i], rssis[i], hcis[i])
+
+    if offset != len(data):
+        raise ValueError("{} bytes left after the last block".format(len(data) - offset))
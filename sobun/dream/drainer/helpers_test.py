@@ -1,3 +1,8 @@
+import struct
+import threading
+import time
+import zlib
+
 import helpers
 
 
@@ -16,3 +21,109 @@ def test_row_from_payloads():
         tag_ids = [row[0] for row in rows]
         uniq_tag_ids = set(tag_ids)
         assert uniq_tag_ids == set(['tag1', 'tag2', 'tag3'])
+
+
+def test_decompress():
+    with open('payloads.txt', 'rb') as src:
+        data = src.read()
+
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    assert helpers.decompress(gzip.compress(data) + gzip.flush(), "gzip") == data
+    assert helpers.decompress(zlib.compress(data), "zlib") == data
+    # Hubs that don't compress don't send the attribute
+    assert helpers.decompress(data, None) == data
+    assert helpers.decompress(data, "identity") == data
+
+
+def test_rows_from_columnar():
+    payload = (
+        b'DRMC\x01' + struct.pack('<I', 1) +
+        b'\x04tag1' + struct.pack('<I', 2) +
+        # timestamps 5 and 4: zigzag varints of 5 and -1
+        b'\x0a\x01' +
+        b'\x00\x01' + struct.pack('<2b', -57, -60) +
+        bytes.fromhex('f5039700f3ffc20871036a00c5ff1bf8')
+    )
+    rows = list(helpers.rows_from_batch(payload, "ruya"))
+    assert rows == [
+        ('tag1', 'f5039700f3ffc208', 'ruya', 5, -57, 0),
+        ('tag1', '71036a00c5ff1bf8', 'ruya', 4, -60, 1),
+    ]
+    # and the csv format still works
+    assert list(helpers.rows_from_batch(b'5,tag1,f5039700f3ffc208,0,-57', "ruya")) == rows[:1]
+
+
+def test_insert_concurrently():
+    lock = threading.Lock()
+    inserted = []
+    active = [0, 0]
+
+    def insert(chunk):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+            inserted.append(chunk)
+        return ["bad row"] if chunk[0] == 20 else []
+
+    rows = (i for i in range(35))
+    errors = helpers.insert_concurrently(insert, rows, 10, 3)
+    assert errors == ["bad row"]
+    assert active[1] == 3
+    assert sorted(chunk[0] for chunk in inserted) == [0, 10, 20, 30]
+    assert sorted(len(chunk) for chunk in inserted) == [5, 10, 10, 10]
+
+
+ROWS = [('tag{}'.format(i), 'f5039700f3ffc208', 'ruya', 1539648250 + i, -57, 0) for i in range(5)]
+
+
+def test_insert_id():
+    ids = [helpers.insert_id(row) for row in ROWS]
+    assert len(set(ids)) == 5
+    assert helpers.insert_id(tuple(ROWS[0])) == ids[0]
+    # the same measurements heard twice in a second are two readings
+    assert helpers.insert_id(ROWS[0][:4] + (-80, 0)) != ids[0]
+    assert helpers.insert_id(ROWS[0][:4] + (-57, 1)) != ids[0]
+
+
+def test_insert_with_retries_only_tries_the_failed_rows_again():
+    calls = []
+    sleeps = []
+
+    def insert(rows, row_ids):
+        calls.append((list(rows), list(row_ids)))
+        errors = []
+        for index, row in enumerate(rows):
+            if row[0] == 'tag1':
+                errors.append({"index": index, "errors": [{"reason": "invalid"}]})
+            elif row[0] == 'tag3' or row[0] == 'tag4' and len(calls) == 1:
+                errors.append({"index": index, "errors": [{"reason": "backendError"}]})
+        return errors
+
+    failed = helpers.insert_with_retries(insert, ROWS, attempts=3, delay=0.5, sleep=sleeps.append)
+
+    assert [[row[0] for row in rows] for rows, _ids in calls] == [
+        ['tag0', 'tag1', 'tag2', 'tag3', 'tag4'], ['tag3', 'tag4'], ['tag3']]
+    assert calls[1][1] == [helpers.insert_id(ROWS[3]), helpers.insert_id(ROWS[4])]
+    assert sleeps == [0.5, 1.0]
+    # the invalid row right away, the other one after the last attempt
+    assert failed == [
+        (ROWS[1], [{"reason": "invalid"}]),
+        (ROWS[3], [{"reason": "backendError"}]),
+    ]
+
+
+def test_insert_with_retries_raises_when_bigquery_stays_down():
+    def insert(rows, row_ids):
+        raise IOError("503")
+
+    sleeps = []
+    try:
+        helpers.insert_with_retries(insert, ROWS, attempts=2, sleep=sleeps.append)
+    except IOError:
+        pass
+    else:
+        assert False, "expected the IOError"
+    assert sleeps == [1.0]
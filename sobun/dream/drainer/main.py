@@ -9,32 +9,105 @@ https://cloud.google.com/functions/docs/writing/background#functions_background_
 """
 
 import base64
+import json
+import os
 from google.cloud import bigquery
 import helpers
 
-client = bigquery.Client()
+# Configure the GCP Cloud Function here, or with the function's environment
+# variables, by inserting the BigQuery dataset and table IDs
+DATASET_ID = os.environ.get("DRAINER_DATASET", "dream_assets_dataset")
+TABLE_ID = os.environ.get("DRAINER_TABLE", "dream_measurements_table")
 
-# Configure the GCP Cloud Function here by inserting the BigQuery dataset and table IDs 
-dataset_id = 'dream_assets_dataset'
-table_id = 'dream_measurements_table'
-table_ref = client.dataset(dataset_id).table(table_id)
+# the columns of the rows helpers makes, in their order
+SCHEMA = [
+    bigquery.SchemaField("tag_id", "STRING"),
+    bigquery.SchemaField("measurements", "STRING"),
+    bigquery.SchemaField("hub_id", "STRING"),
+    bigquery.SchemaField("timestamp", "INTEGER"),
+    bigquery.SchemaField("rssi", "INTEGER"),
+    bigquery.SchemaField("hci", "INTEGER"),
+]
 
-table = client.get_table(table_ref)
+
+# Nothing talks to Google when the function is loaded. The client is made for
+# the first message and kept for the next ones, and the table needs no
+# get_table request since we know its schema
+client = None
+table = None
+
+
+def get_client():
+    global client
+    if client is None:
+        client = bigquery.Client()
+    return client
+
+
+def get_table():
+    global table
+    if table is None:
+        table = bigquery.Table(get_client().dataset(DATASET_ID).table(TABLE_ID), schema=SCHEMA)
+    return table
+
+
+# BigQuery has a limit of 10K insert at a time, and the function sends up to
+# DRAINER_INSERT_THREADS of those at once
+INSERT_ROWS = 10000
+INSERT_THREADS = int(os.environ.get("DRAINER_INSERT_THREADS", "4"))
+
+# Rows that fail are tried again DRAINER_INSERT_ATTEMPTS times in all. Rows that
+# still fail go to the DRAINER_DEAD_LETTER_TABLE table in the same dataset, or to
+# the function's log when there isn't one
+INSERT_ATTEMPTS = int(os.environ.get("DRAINER_INSERT_ATTEMPTS", "4"))
+DEAD_LETTER_TABLE = os.environ.get("DRAINER_DEAD_LETTER_TABLE", "")
+
+
+def insert(rows, row_ids):
+    # rows with errors don't stop the others from going in
+    return get_client().insert_rows(get_table(), rows, row_ids=row_ids, skip_invalid_rows=True)
+
+
+def insert_chunk(rows):
+    return helpers.insert_with_retries(insert, rows, INSERT_ATTEMPTS)
+
+
+def dead_letter(hub_id, failed):
+    print("{} rows from {} couldn't be inserted".format(len(failed), hub_id))
+    records = [
+        {"hub_id": hub_id, "row": json.dumps(row), "errors": json.dumps(errors)}
+        for row, errors in failed
+    ]
+    if not DEAD_LETTER_TABLE:
+        for record in records:
+            print("dead letter: ", json.dumps(record))
+        return
+    client = get_client()
+    errors = client.insert_rows_json(client.dataset(DATASET_ID).table(DEAD_LETTER_TABLE), records)
+    # PubSub will deliver the message again, and the insertIds keep most of
+    # the rows that made it from going in twice
+    assert errors == [], errors
 
 
 # Run under Python 3.7 runtime
 def run(data, context):
 
-    print("data published: ", data)
     attributes = data['attributes']
     hub_id = attributes["hub_id"]
+    # the data itself is too big to log
+    print("data published: ", attributes, len(data['data']), "bytes")
 
-    # data['data'] is somehow base64 encoded
-    payloads = base64.b64decode(data['data']).decode('utf-8')
-    rows = helpers.rows_from_payloads(payloads, hub_id)
-    # BigQuery has a limit of 10K insert at a time
-    batches = helpers.batch(rows, 10000)
-    for batch in batches:
-        # try to insert this row. If there're errors, return it as a list
-        errors = client.insert_rows(table, list(batch))
-        assert errors == [], errors
+    # data['data'] is somehow base64 encoded, and compressed if the Hub says so
+    encoding = attributes.get("encoding")
+    payload = helpers.decompress(base64.b64decode(data['data']), encoding)
+    # the csv or the columnar format, helpers tells them apart. The rows are
+    # parsed as the inserts take them, so they are never all in memory at once
+    rows = helpers.rows_from_batch(payload, hub_id)
+    # before the threads, so they don't each make a client
+    get_table()
+    # insert the rows, with another try for the ones that fail. What fails
+    # for good is set aside rather than failing the function, since PubSub
+    # would deliver the whole message again
+    failed = helpers.insert_concurrently(insert_chunk, rows, INSERT_ROWS, INSERT_THREADS)
+    if failed:
+        dead_letter(hub_id, failed)
@@ -2,47 +2,209 @@
 #
 # The dataflow in DREAM is bleAdvertisement -> packet -> payload
 # At this point in the project, DREAM sends *payloads* via PubSub to BigQuery
+#
+# Over cellular, setting up is what takes the time: reading the credentials,
+# fetching the API's discovery document and opening an HTTPS connection. The
+# Publisher calls PubSub's REST API directly, loads the credentials once and
+# keeps its connection open. It also packs several batches into one publish
+# request when more than one is ready, and compresses them (see compress.py).
 
 from __future__ import print_function
 
 import base64
+import errno
 import json
 import socket
 
-from google.oauth2 import service_account
-import googleapiclient.discovery
+try:
+    import http.client as http_client
+    from urllib.parse import urlparse
+except ImportError:
+    import httplib as http_client
+    from urlparse import urlparse
 
-from dream import config
+from dream import compress, config
 
-# During setup, we set the RasPi's hostname to the Hub ID  
+# During setup, we set the RasPi's hostname to the Hub ID
 HUB_ID = socket.gethostname()
 
 SCOPES = ['https://www.googleapis.com/auth/pubsub']
 
-# The Hub publishes to this topic on PubSub 
+# The Hub publishes to this topic on PubSub
 TOPIC = "projects/{}/topics/{}".format(config.GOOGLE_PROJECT_ID, config.GOOGLE_PUBSUB_TOPIC)
 
-def send_batch(payload):
-    data = {
-        "messages": [
-            {
-                "data": base64.b64encode(payload),
-                "attributes": {
-                    "hub_id": HUB_ID
-                }
-            }
-        ]
-    }
+PUBSUB_ENDPOINT = "https://pubsub.googleapis.com"
+
+# PubSub takes publish requests of up to 10MB and 1000 messages
+MAX_REQUEST_BYTES = 10 * 1000 * 1000
+MAX_REQUEST_MESSAGES = 1000
+
+
+def unsent(error):
+    """ Whether a failed request can't have reached PubSub: the connection was gone before it got an answer """
+    if isinstance(error, http_client.BadStatusLine):
+        return True
+    return not isinstance(error, socket.timeout) and getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+
+def load_credentials():
+    from google.oauth2 import service_account
 
     # service account file is the same as the secret json file
-    SERVICE_ACCOUNT_FILE = config.GOOGLE_APPLICATION_CREDENTIALS
-    credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-
-    try:
-        pubsub = googleapiclient.discovery.build('pubsub', 'v1', credentials=credentials)
-        res = pubsub.projects().topics().publish(topic=TOPIC, body=data).execute()
-        return res
-    except Exception as e:
-        print("Unable to publish data to Google Cloud due to network error: {}".format(e))
-        return
+    return service_account.Credentials.from_service_account_file(
+        config.GOOGLE_APPLICATION_CREDENTIALS, scopes=SCOPES)
+
+
+def auth_request():
+    # what google-auth uses to refresh the access token
+    import google_auth_httplib2
+    import httplib2
+
+    return google_auth_httplib2.Request(httplib2.Http())
+
+
+class RequestTooLarge(IOError):
+    """ PubSub won't take a request this big: the batch in it needs to be smaller """
+
+
+class Publisher(object):
+    """ Publishes payloads to a PubSub topic over one long-lived connection """
+
+    def __init__(self, topic=TOPIC, credentials=None, endpoint=PUBSUB_ENDPOINT, timeout=None,
+                 max_request_bytes=MAX_REQUEST_BYTES, encoding=None):
+        self.topic = topic
+        self.encoding = compress.choose(encoding or config.DREAM_PUBLISH_ENCODING)
+        self.credentials = credentials
+        self.url = urlparse(endpoint)
+        self.timeout = timeout or int(config.DREAM_PUBSUB_TIMEOUT)
+        self.max_request_bytes = max_request_bytes
+        self.connection = None
+        self.auth_request = None
+        self.requests = 0
+
+    def message(self, payload):
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        attributes = {
+            "hub_id": HUB_ID
+        }
+        if self.encoding != 'identity':
+            attributes["encoding"] = self.encoding
+        return {
+            "data": base64.b64encode(compress.compress(payload, self.encoding)).decode('ascii'),
+            "attributes": attributes
+        }
+
+    def publish(self, messages):
+        """ Sends one publish request and returns PubSub's response, e.g. {"messageIds": [...]} """
+        body = json.dumps({"messages": messages})
+        path = "{}/v1/{}:publish".format(self.url.path.rstrip('/'), self.topic)
+        headers = {"Content-Type": "application/json"}
+        if len(body) > MAX_REQUEST_BYTES:
+            # no use sending it over cellular only to have it turned down
+            raise RequestTooLarge("a {} byte request is more than PubSub takes".format(len(body)))
+        self.authorize(headers)
+
+        # an idle keep-alive connection may have been closed by the other side, so a
+        # request that fails that way on an old connection gets one more try on a new
+        # one. Anything else, a timeout above all, may come after PubSub took the batch,
+        # and sending it again would publish it twice.
+        for attempt in range(2):
+            reused = self.connection is not None
+            response = None
+            try:
+                response = self.request(path, body, headers)
+                data = response.read()
+                break
+            except (http_client.HTTPException, socket.error) as error:
+                self.close()
+                if attempt or not reused or response is not None or not unsent(error):
+                    raise
+
+        if response.status == 413 or (response.status == 400 and b"size" in data):
+            raise RequestTooLarge("PubSub responded {} {}: {}".format(response.status, response.reason, data[:200]))
+        if response.status != 200:
+            raise IOError("PubSub responded {} {}: {}".format(response.status, response.reason, data[:200]))
+        return json.loads(data.decode('utf-8'))
+
+    def request(self, path, body, headers):
+        if self.connection is None:
+            if self.url.scheme == 'https':
+                self.connection = http_client.HTTPSConnection(self.url.netloc, timeout=self.timeout)
+            else:
+                self.connection = http_client.HTTPConnection(self.url.netloc, timeout=self.timeout)
+        self.requests += 1
+        self.connection.request("POST", path, body, headers)
+        return self.connection.getresponse()
+
+    def authorize(self, headers):
+        if self.credentials is None:
+            self.credentials = load_credentials()
+        if not self.credentials.valid:
+            # the access token is missing or about to expire
+            if self.auth_request is None:
+                self.auth_request = auth_request()
+            self.credentials.refresh(self.auth_request)
+        self.credentials.apply(headers)
+
+    def send_batch(self, payload):
+        try:
+            return self.publish([self.message(payload)])
+        except Exception as e:
+            print("Unable to publish data to Google Cloud due to network error: {}".format(e))
+            return
+
+    def send_batches(self, payloads, errors=None):
+        """ Publishes as few requests as the size limit allows.
+
+        Returns a message id for every payload, or None for payloads whose request failed.
+        What made a request fail is added to `errors` when it's given.
+        """
+        message_ids = []
+        for messages in self.requests_for([self.message(payload) for payload in payloads]):
+            try:
+                res = self.publish(messages)
+                message_ids.extend(res["messageIds"])
+            except Exception as e:
+                print("Unable to publish data to Google Cloud due to network error: {}".format(e))
+                message_ids.extend([None] * len(messages))
+                if errors is not None:
+                    errors.append(e)
+        return message_ids
+
+    def requests_for(self, messages):
+        # groups the messages into requests below max_request_bytes
+        group, size = [], 0
+        for message in messages:
+            message_size = len(message["data"]) + len(HUB_ID) + 100
+            if group and (size + message_size > self.max_request_bytes or len(group) == MAX_REQUEST_MESSAGES):
+                yield group
+                group, size = [], 0
+            group.append(message)
+            size += message_size
+        if group:
+            yield group
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+# the batcher publishes through one Publisher for as long as it runs
+publisher = None
+
+
+def get_publisher():
+    global publisher
+    if publisher is None:
+        publisher = Publisher()
+    return publisher
+
+
+def send_batch(payload):
+    return get_publisher().send_batch(payload)
+
+
+def send_batches(payloads):
+    return get_publisher().send_batches(payloads)
@@ -0,0 +1,203 @@
+import base64
+import json
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from dream import batcher, compress, config, gpub
+from dream.batcher_test import make_rows
+from dream.gpub import Publisher
+
+
+class FakeCredentials(object):
+    valid = True
+
+    def apply(self, headers):
+        headers["Authorization"] = "Bearer fake-token"
+
+
+class FakePubSub(ThreadingMixIn, HTTPServer):
+    """ Answers publish requests like PubSub and remembers them """
+
+    # the publisher keeps its connection open, don't wait for it when stopping
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakePubSubHandler)
+        self.requests = []
+        self.connections = 0
+        self.message_ids = 0
+        self.fail_next = False
+        self.too_large_next = False
+        # drop the connection after answering, like a proxy closing an idle one
+        self.drop_connections = False
+        # seconds to wait before answering the next request
+        self.delay_next = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def endpoint(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # the publisher hangs up on answers that come too late
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakePubSubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode('utf-8'))
+        self.server.requests.append((self.path, self.headers["Authorization"], body))
+        if self.server.delay_next:
+            time.sleep(self.server.delay_next)
+            self.server.delay_next = 0
+        if self.server.fail_next:
+            self.server.fail_next = False
+            status, response = 503, {"error": "unavailable"}
+        elif self.server.too_large_next:
+            self.server.too_large_next = False
+            status, response = 400, {"error": {"message": "Request payload size exceeds the limit: 10485760 bytes."}}
+        else:
+            first = self.server.message_ids + 1
+            self.server.message_ids += len(body["messages"])
+            status, response = 200, {"messageIds": [str(first + i) for i in range(len(body["messages"]))]}
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.close_connection = self.server.drop_connections
+
+    def log_message(self, *args):
+        pass
+
+
+def make_publisher(pubsub, **kwargs):
+    kwargs.setdefault("encoding", "zlib")
+    kwargs.setdefault("timeout", 5)
+    return Publisher(topic="projects/p/topics/t", credentials=FakeCredentials(),
+                     endpoint=pubsub.endpoint(), **kwargs)
+
+
+def test_publisher_reuses_its_connection():
+    pubsub = FakePubSub()
+    try:
+        publisher = make_publisher(pubsub)
+        for payload in ["first", "second", "third"]:
+            assert publisher.send_batch(payload)["messageIds"]
+        assert pubsub.connections == 1
+
+        path, authorization, body = pubsub.requests[0]
+        assert path == "/v1/projects/p/topics/t:publish"
+        assert authorization == "Bearer fake-token"
+        message = body["messages"][0]
+        assert message["attributes"]["encoding"] == "zlib"
+        assert compress.decompress(base64.b64decode(message["data"]), "zlib") == b"first"
+    finally:
+        pubsub.stop()
+
+
+def test_publisher_reconnects_when_the_connection_was_closed():
+    pubsub = FakePubSub()
+    try:
+        pubsub.drop_connections = True
+        publisher = make_publisher(pubsub)
+        assert publisher.send_batch("first")
+        assert publisher.send_batch("second")
+        assert pubsub.connections == 2
+        assert len(pubsub.requests) == 2
+    finally:
+        pubsub.stop()
+
+
+def test_publisher_doesnt_send_a_batch_again_after_a_timeout():
+    pubsub = FakePubSub()
+    try:
+        publisher = make_publisher(pubsub, timeout=0.5)
+        assert publisher.send_batch("first")
+        # PubSub may have taken the batch and just be slow to answer
+        pubsub.delay_next = 1
+        assert publisher.send_batch("second") is None
+        assert len(pubsub.requests) == 2
+        assert publisher.connection is None
+    finally:
+        pubsub.stop()
+
+
+def test_send_batches_packs_messages_up_to_the_size_limit():
+    pubsub = FakePubSub()
+    try:
+        publisher = make_publisher(pubsub, max_request_bytes=1300, encoding="identity")
+        message_ids = publisher.send_batches(["x" * 300] * 5)
+        assert len(message_ids) == 5 and all(message_ids)
+        assert [len(body["messages"]) for _path, _auth, body in pubsub.requests] == [2, 2, 1]
+
+        pubsub.fail_next = True
+        assert publisher.send_batches(["x" * 300] * 3) == [None, None, "6"]
+    finally:
+        pubsub.stop()
+
+
+def test_publish_next_batch_drains_a_backlog_in_one_request(monkeypatch):
+    dbconn = batcher.dbconnect(':memory:')
+    batcher.create_schema(dbconn)
+    batcher.insert(make_rows(35), dbconn.cursor(), many=True)
+    dbconn.commit()
+
+    pubsub = FakePubSub()
+    try:
+        monkeypatch.setattr(config, "BATCH_SIZE", "10")
+        monkeypatch.setattr(gpub, "publisher", make_publisher(pubsub))
+        batcher.publish_next_batch(dbconn, max_batches=5)
+
+        # 3 batches of 10 rows in one request, the last 5 rows wait for more
+        assert [len(body["messages"]) for _path, _auth, body in pubsub.requests] == [3]
+        assert batcher.ready_batch_ids(dbconn, 5) == []
+        assert dbconn.execute("SELECT count(*) FROM measurements").fetchone()[0] == 5
+    finally:
+        pubsub.stop()
+
+
+def test_payloads_go_out_plain_until_a_deployment_opts_in():
+    # an older drainer can't read compressed messages
+    message = Publisher(credentials=FakeCredentials()).message("1539648250,tag0,f5039700f3ffc208,0,-57")
+    assert "encoding" not in message["attributes"]
+    assert base64.b64decode(message["data"]) == b"1539648250,tag0,f5039700f3ffc208,0,-57"
+
+
+def test_send_batches_tells_a_request_too_large_from_other_failures(monkeypatch):
+    pubsub = FakePubSub()
+    try:
+        publisher = make_publisher(pubsub)
+        errors = []
+        pubsub.too_large_next = True
+        assert publisher.send_batches(["first"], errors) == [None]
+        pubsub.fail_next = True
+        assert publisher.send_batches(["second"], errors) == [None]
+        assert [type(error) for error in errors] == [gpub.RequestTooLarge, IOError]
+
+        # one PubSub would turn down isn't sent at all
+        monkeypatch.setattr(gpub, "MAX_REQUEST_BYTES", 50)
+        assert publisher.send_batches(["third"], errors) == [None]
+        assert type(errors[-1]) == gpub.RequestTooLarge
+        assert len(pubsub.requests) == 2
+    finally:
+        pubsub.stop()
@@ -6,23 +6,28 @@ from __future__ import print_function
 from time import sleep
 import sys
 
-from google.cloud import bigquery
+from dream import config
 
 query = """
 SELECT hub_id,
     count(hub_id) as count
-FROM `dream-assets-project.dream_assets_raw_packets.measurements_table`
+FROM `{}.{}.{}`
     GROUP BY hub_id
     ORDER BY hub_id;
-"""
+""".format(config.GOOGLE_PROJECT_ID, config.DREAM_BIGQUERY_DATASET, config.DREAM_BIGQUERY_TABLE)
 
-client = bigquery.Client()
+# made when it's first needed, importing this file talks to nobody
+client = None
+
+
+def get_client():
+    global client
+    if client is None:
+        from google.cloud import bigquery
+
+        client = bigquery.Client(project=config.GOOGLE_PROJECT_ID)
+    return client
 
-# TODO let's put these ID's in a config file to simplicity 
-dataset_id = 'dream_assets_raw_packets'
-table_id = 'measurements_table'
-table_ref = client.dataset(dataset_id).table(table_id)
-table = client.get_table(table_ref)
 
 # Display the hub name, count of payloads since starting the script, and total # of payloads ever
 #
@@ -32,7 +37,7 @@ table = client.get_table(table_ref)
 if __name__ == "__main__":
     first_counts = {}  #a set of first_counts for all Hubs 
     while True:
-        job = client.query(query)
+        job = get_client().query(query)
         rows = job.result()
         for row in rows:
             if row.hub_id is not None:
@@ -0,0 +1,308 @@
+# this file writes the sniffer's packets to the database
+#
+# Committing is what costs the syncer: every commit waits for the database lock
+# and syncs the write-ahead log to the SD card. GroupCommitWriter keeps one
+# connection open and gathers the rows of many syncer tasks into one transaction,
+# which is committed once it holds `max_rows` rows or its oldest row is
+# `max_delay` seconds old, whichever comes first.
+#
+# Rows that aren't committed yet are lost if the process dies, so max_delay is
+# also how much data a crash can cost.
+#
+# A commit that fails with an OperationalError (e.g. the database stayed locked) is
+# tried again after a delay that doubles each time, up to `max_attempts` times, and
+# then its rows are dropped. A row that batcher.insert can't take at all is left out
+# of the commit with a log line. Meanwhile write() holds at most `max_buffered` rows
+# and drops what comes on top; everything dropped is counted in stats().
+#
+# EmbeddedSyncer takes the place of the celery syncer for `dream.sniffer --embedded`:
+# the bundles go through a bounded queue to a thread in the sniffer's own process.
+# Both commit through a Committer, so they fail, retry and count the same way.
+
+from __future__ import division, print_function
+
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    from Queue import Empty, Full, Queue
+import sqlite3
+import threading
+import time
+import traceback
+
+from dream import batcher
+
+
+def rows_from_bundle(bundle, hci=0):
+    """ Reduces the sniffer's packets to the rows (payloads) we keep in the database,
+    as tuples in batcher.ROW_FIELDS order """
+    rows = []
+    for packet in bundle:
+        # Fujitsu's mfr_data value has measurements in the last 16 characters (8 bytes)
+        measurements = packet['mfr_data'][-16:]
+        rows.append((packet["timestamp"], packet["tag_id"], measurements, hci, packet["rssi"]))
+    return rows
+
+
+class WriterDied(RuntimeError):
+    """ The writer's thread stopped, so nothing given to write() gets committed """
+
+
+class Committer(object):
+    """ Inserts groups of rows in a transaction each and counts how that went """
+
+    def __init__(self, max_attempts=5, retry_delay=0.5, longest_retry_delay=30):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.longest_retry_delay = longest_retry_delay
+
+        self.written = 0
+        self.commits = 0
+        self.commit_seconds = 0.0
+        self.failed_commits = 0
+        # rows that never made it to the database
+        self.bad_rows = 0
+        self.given_up_rows = 0
+
+    def commit_group(self, dbconn, rows):
+        """ Commits the rows and returns how many went in; never raises """
+        started = time.time()
+        try:
+            committed = self.commit(dbconn, rows)
+        except Exception:
+            # whatever it was, the writer has to keep going for the next rows
+            traceback.print_exc()
+            committed = 0
+            self.given_up_rows += len(rows)
+            dbconn.rollback()
+        if committed:
+            self.commit_seconds += time.time() - started
+            self.commits += 1
+            self.written += committed
+        return committed
+
+    def commit(self, dbconn, rows):
+        """ Inserts the rows in one transaction and returns how many of them went in """
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                try:
+                    batcher.insert(rows, dbconn.cursor(), many=True)
+                    committed = len(rows)
+                except sqlite3.OperationalError:
+                    raise
+                except Exception as e:
+                    # e.g. measurements that aren't hex: find the rows and leave them out
+                    print("could not insert {} rows, inserting them one at a time: {}".format(len(rows), e))
+                    dbconn.rollback()
+                    committed = self._insert_good_rows(dbconn, rows)
+                dbconn.commit()
+                return committed
+            except sqlite3.OperationalError as e:
+                # e.g. the database stayed locked
+                dbconn.rollback()
+                self.failed_commits += 1
+                print("could not commit {} rows (attempt {} of {}): {}".format(len(rows), attempt, self.max_attempts, e))
+                if attempt < self.max_attempts:
+                    time.sleep(min(self.longest_retry_delay, self.retry_delay * 2 ** (attempt - 1)))
+        self.given_up_rows += len(rows)
+        print("gave up on {} rows, {} so far".format(len(rows), self.given_up_rows))
+        return 0
+
+    def _insert_good_rows(self, dbconn, rows):
+        inserted = 0
+        for row in rows:
+            try:
+                batcher.insert(row, dbconn.cursor())
+                inserted += 1
+            except sqlite3.OperationalError:
+                raise
+            except Exception as e:
+                self.bad_rows += 1
+                print("dropped a row the database can't take: {!r}: {}".format(row, e))
+        return inserted
+
+    def stats(self):
+        return {
+            "rows": self.written,
+            "commits": self.commits,
+            "rows_per_commit": round(self.written / self.commits, 1) if self.commits else 0,
+            "commit_seconds": round(self.commit_seconds, 3),
+            "failed_commits": self.failed_commits,
+            "bad_rows": self.bad_rows,
+            "given_up_rows": self.given_up_rows,
+        }
+
+
+class GroupCommitWriter(threading.Thread):
+    """ Owns a database connection and commits the rows given to write() in groups """
+
+    def __init__(self, path=None, max_rows=1000, max_delay=0.5, max_buffered=100000, max_attempts=5,
+                 retry_delay=0.5, longest_retry_delay=30):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+        self.committer = Committer(max_attempts, retry_delay, longest_retry_delay)
+
+        self.rows = []
+        self.oldest = None
+        # rows given to write() that aren't committed yet, queued or being inserted
+        self.uncommitted = 0
+        self.closing = False
+        self.condition = threading.Condition()
+        # rows write() dropped
+        self.overflow_rows = 0
+
+    def write(self, rows):
+        """ Queues rows for the next commit; they are the rows batcher.insert takes """
+        with self.condition:
+            if self.closing:
+                raise RuntimeError("the writer is closed")
+            if self.ident is not None and not self.is_alive():
+                raise WriterDied("the writer thread stopped, see the log")
+            if len(self.rows) + len(rows) > self.max_buffered:
+                self.overflow_rows += len(rows)
+                print("the writer can't keep up, dropped {} rows so far".format(self.overflow_rows))
+                return
+            if not self.rows:
+                self.oldest = time.time()
+            self.rows.extend(rows)
+            self.uncommitted += len(rows)
+            if len(self.rows) >= self.max_rows:
+                self.condition.notify()
+
+    def flush(self):
+        """ Commits whatever is queued and returns once it is in the database """
+        with self.condition:
+            while self.uncommitted and self.is_alive():
+                self.oldest = 0
+                self.condition.notify_all()
+                self.condition.wait(0.1)
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        try:
+            # sqlite connections belong to the thread that opened them
+            dbconn = batcher.dbconnect(self.path)
+        except Exception:
+            # write() raises WriterDied from now on
+            traceback.print_exc()
+            return
+        try:
+            while True:
+                rows = self._next_group()
+                if rows is None:
+                    break
+                self.committer.commit_group(dbconn, rows)
+                with self.condition:
+                    self.uncommitted -= len(rows)
+                    # wakes up flush()
+                    self.condition.notify_all()
+        finally:
+            dbconn.close()
+
+    def _next_group(self):
+        with self.condition:
+            while True:
+                if self.rows:
+                    wait = self.oldest + self.max_delay - time.time()
+                    if self.closing or len(self.rows) >= self.max_rows or wait <= 0:
+                        break
+                    self.condition.wait(wait)
+                elif self.closing:
+                    return None
+                else:
+                    self.condition.wait()
+            rows, self.rows = self.rows, []
+            return rows
+
+    def stats(self):
+        stats = self.committer.stats()
+        stats["overflow_rows"] = self.overflow_rows
+        return stats
+
+
+class EmbeddedSyncer(threading.Thread):
+    """ Looks like the syncer's celery task to PacketBundler, but inserts in process.
+
+    delay() waits at most `put_timeout` seconds for room in the queue, which slows
+    the scanner down (backpressure), and drops the bundle after that. Whatever is
+    in the queue when the thread gets to it goes into one transaction.
+    """
+
+    def __init__(self, path=None, max_bundles=100, put_timeout=0.1, max_attempts=5, retry_delay=0.5,
+                 longest_retry_delay=30):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.put_timeout = put_timeout
+        self.queue = Queue(max_bundles)
+        # while it waits to try a failed commit again, the queue fills up and delay() drops
+        self.committer = Committer(max_attempts, retry_delay, longest_retry_delay)
+
+        self.bundles = 0
+        self.waits = 0
+        self.dropped_bundles = 0
+        self.dropped_packets = 0
+
+    def delay(self, bundle, hci=0):
+        try:
+            self.queue.put_nowait((bundle, hci))
+            return
+        except Full:
+            self.waits += 1
+        try:
+            self.queue.put((bundle, hci), timeout=self.put_timeout)
+        except Full:
+            self.dropped_bundles += 1
+            self.dropped_packets += len(bundle)
+            print("the writer can't keep up, dropped {} packets so far".format(self.dropped_packets))
+
+    def close(self):
+        """ Writes what is queued and stops the thread """
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        # sqlite connections belong to the thread that opened them
+        dbconn = batcher.dbconnect(self.path)
+        batcher.create_schema(dbconn)
+        try:
+            closing = False
+            while not closing:
+                items = [self.queue.get()]
+                while True:
+                    try:
+                        items.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                closing = None in items
+                bundles = [item for item in items if item is not None]
+                rows = []
+                for bundle, hci in bundles:
+                    rows.extend(rows_from_bundle(bundle, hci))
+                if rows:
+                    self.committer.commit_group(dbconn, rows)
+                self.bundles += len(bundles)
+        finally:
+            dbconn.close()
+
+    def stats(self):
+        stats = self.committer.stats()
+        stats.update({
+            "bundles": self.bundles,
+            "queued": self.queue.qsize(),
+            "waits": self.waits,
+            "dropped_bundles": self.dropped_bundles,
+            "dropped_packets": self.dropped_packets,
+        })
+        return stats
@@ -0,0 +1,168 @@
+import sqlite3
+import time
+
+import pytest
+
+from dream import batcher
+from dream.batcher_test import make_rows
+from dream.ingest import EmbeddedSyncer, GroupCommitWriter, WriterDied
+
+
+def count_rows(path):
+    dbconn = batcher.dbconnect(path)
+    count, = dbconn.execute("SELECT count(*) FROM measurements").fetchone()
+    dbconn.close()
+    return count
+
+
+def start_writer(tmpdir, **kwargs):
+    path = str(tmpdir.join('measurements.db'))
+    dbconn = batcher.dbconnect(path)
+    batcher.create_schema(dbconn)
+    dbconn.close()
+    writer = GroupCommitWriter(path, **kwargs)
+    writer.start()
+    return path, writer
+
+
+def test_rows_of_many_tasks_share_a_commit(tmpdir):
+    path, writer = start_writer(tmpdir, max_rows=1000, max_delay=60)
+    for _ in range(25):
+        writer.write(make_rows(100))
+    writer.close()
+
+    assert count_rows(path) == 2500
+    # a commit once 1000 rows are queued (or more, if the writer is slow to wake up)
+    # and one for the rest when closing
+    assert 1 <= writer.stats()["commits"] <= 3
+
+
+def test_rows_are_committed_after_max_delay(tmpdir):
+    path, writer = start_writer(tmpdir, max_rows=1000, max_delay=0.05)
+    writer.write(make_rows(10))
+    deadline = time.time() + 5
+    while count_rows(path) < 10 and time.time() < deadline:
+        time.sleep(0.01)
+    assert count_rows(path) == 10
+
+    writer.write(make_rows(5))
+    writer.flush()
+    assert count_rows(path) == 15
+    writer.close()
+    assert writer.stats()["rows"] == 15
+
+
+def test_bad_rows_are_left_out(tmpdir):
+    path = str(tmpdir.join('measurements.db'))
+    dbconn = batcher.dbconnect(path)
+    batcher.create_schema(dbconn)
+    batcher.migrate_to_compact(dbconn)
+    dbconn.close()
+    writer = GroupCommitWriter(path, max_delay=60)
+    writer.start()
+
+    rows = make_rows(10)
+    # the compact schema stores the measurements as bytes, and this isn't hex
+    rows[3]["measurements"] = "not hex!"
+    writer.write(rows)
+    writer.write(make_rows(5, start=1539648300))
+    writer.flush()
+    assert writer.is_alive()
+    writer.close()
+
+    dbconn = batcher.dbconnect(path)
+    assert dbconn.execute("SELECT count(*) FROM readings").fetchone()[0] == 14
+    assert (writer.stats()["rows"], writer.stats()["bad_rows"]) == (14, 1)
+
+
+def test_a_commit_that_keeps_failing_is_given_up(tmpdir, monkeypatch):
+    path, writer = start_writer(tmpdir, max_delay=60, max_attempts=3, retry_delay=0.01)
+    insert = batcher.insert
+
+    def locked(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(batcher, "insert", locked)
+    writer.write(make_rows(10))
+    writer.flush()
+    monkeypatch.setattr(batcher, "insert", insert)
+    writer.write(make_rows(5))
+    writer.close()
+
+    assert count_rows(path) == 5
+    stats = writer.stats()
+    assert (stats["failed_commits"], stats["given_up_rows"], stats["rows"]) == (3, 10, 5)
+
+
+def test_write_raises_once_the_writer_died(tmpdir):
+    # a directory can't be opened as a database, so the thread stops right away
+    writer = GroupCommitWriter(str(tmpdir))
+    writer.start()
+    writer.join(5)
+    with pytest.raises(WriterDied):
+        writer.write(make_rows(1))
+
+
+def test_write_drops_rows_past_max_buffered(tmpdir):
+    # not started, so nothing is committed
+    writer = GroupCommitWriter(str(tmpdir.join('measurements.db')), max_buffered=10)
+    writer.write(make_rows(8))
+    writer.write(make_rows(5))
+    assert (len(writer.rows), writer.stats()["overflow_rows"]) == (8, 5)
+
+
+def make_bundle(count):
+    return [
+        dict(timestamp=1539648250 + i, tag_id="d5a0e5b5ffc1", rssi=-63,
+             mfr_data="5900010003000300910370003f0030f8")
+        for i in range(count)
+    ]
+
+
+def test_embedded_syncer_inserts_bundles(tmpdir):
+    path = str(tmpdir.join('measurements.db'))
+    syncer = EmbeddedSyncer(path)
+    syncer.start()
+    for _ in range(5):
+        syncer.delay(make_bundle(100), 1)
+    syncer.close()
+
+    assert count_rows(path) == 500
+    dbconn = batcher.dbconnect(path)
+    row = dbconn.execute("SELECT tag_id, measurements, hci, rssi FROM measurements").fetchone()
+    assert tuple(row) == ("d5a0e5b5ffc1", "910370003f0030f8", 1, -63)
+    assert syncer.stats()["bundles"] == 5
+
+
+def test_embedded_syncer_drops_bundles_when_full(tmpdir):
+    path = str(tmpdir.join('measurements.db'))
+    # not started, so nothing drains the queue
+    syncer = EmbeddedSyncer(path, max_bundles=2, put_timeout=0.01)
+    for _ in range(5):
+        syncer.delay(make_bundle(10), 0)
+
+    stats = syncer.stats()
+    assert (stats["queued"], stats["waits"], stats["dropped_bundles"], stats["dropped_packets"]) == (2, 3, 3, 30)
+
+    syncer.start()
+    syncer.close()
+    assert count_rows(path) == 20
+
+
+def test_embedded_syncer_gives_up_on_a_commit_that_keeps_failing(tmpdir, monkeypatch):
+    path = str(tmpdir.join('measurements.db'))
+    syncer = EmbeddedSyncer(path, max_attempts=3, retry_delay=0.01)
+
+    def locked(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(batcher, "insert", locked)
+    syncer.start()
+    syncer.delay(make_bundle(10), 0)
+    started = time.time()
+    syncer.close()
+
+    # three tries, 10ms and 20ms apart, instead of trying for good
+    assert time.time() - started < 1
+    stats = syncer.stats()
+    assert (stats["failed_commits"], stats["given_up_rows"], stats["rows"]) == (3, 10, 0)
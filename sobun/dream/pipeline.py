@@ -0,0 +1,299 @@
+# this file keeps several publish requests in flight while the batcher drains a backlog
+#
+# Publishing a batch at a time, the batcher drains one request per round trip, and
+# over cellular a Hub that was offline for hours takes longer than that to catch up.
+# The PublishPipeline hands batches to `in_flight` worker threads, each with its own
+# PubSub connection, and deletes a batch only once PubSub acknowledged it. Batches
+# whose request failed stay in the database and go out again.
+#
+# The SQLite connection never leaves the batcher's thread: the workers only get
+# payloads and give back message ids.
+#
+# When requests fail the pipeline backs off exponentially, with jitter so Hubs that
+# lost the link together don't all come back at the same moment. The Soracom hooks
+# tell the batcher when the link goes down or comes back (see batcher.main), so it
+# waits out an outage without trying every second, and goes back to work as soon as
+# the link returns, on the connections it already has.
+#
+# The size of new batches follows how fast the link turns out to be (see BatchSizer):
+# big batches make the most of a good link while there is a backlog, and small ones
+# keep a weak 3G link from timing out and sending it all again. A batch PubSub turns
+# down as too large is split to the new size, or it would be turned down forever.
+
+from __future__ import division, print_function
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+import random
+import threading
+import time
+
+from dream import batcher, config
+from dream.gpub import RequestTooLarge
+
+
+def publisher_send_batches():
+    from dream.gpub import Publisher
+
+    return Publisher().send_batches
+
+
+# how often a sleeping pipeline checks whether resume() was called
+DOZE_SECONDS = 0.2
+
+
+class Backoff(object):
+    """ Delays that double with every failure, from `first` up to `longest` seconds.
+
+    A delay is somewhere between half and all of that, so Hubs back off at their own pace.
+    """
+
+    def __init__(self, first, longest, rng=None):
+        self.first = first
+        self.longest = longest
+        self.failures = 0
+        self.rng = rng or random.Random()
+
+    def fail(self):
+        self.failures += 1
+
+    def reset(self):
+        self.failures = 0
+
+    def delay(self):
+        # past 30 doublings we're at `longest` anyway
+        return self.jitter(min(self.longest, self.first * 2 ** min(max(self.failures - 1, 0), 30)))
+
+    def longest_delay(self):
+        return self.jitter(self.longest)
+
+    def jitter(self, seconds):
+        return seconds / 2 + self.rng.random() * seconds / 2
+
+
+class BatchSizer(object):
+    """ Picks the size of new batches so that a publish request takes about `target` seconds.
+
+    With a backlog, batches grow toward what the link publishes in that time, at most
+    twice as big at a time. A request that took noticeably longer shrinks them in
+    proportion, and one that failed after `target` seconds most likely timed out and
+    halves them. A request PubSub turned down as too large, however quickly, halves
+    them too, and they don't grow back past that.
+    """
+
+    def __init__(self, size=None, smallest=None, largest=None, target=None):
+        self.smallest = smallest or int(config.DREAM_BATCH_SIZE_MIN)
+        self.largest = largest or int(config.DREAM_BATCH_SIZE_MAX)
+        self.target = target or int(config.DREAM_PUBLISH_TARGET_MS) / 1000
+        self.size = self.bounded(size or int(config.BATCH_SIZE))
+
+    def bounded(self, size):
+        return max(self.smallest, min(self.largest, int(size)))
+
+    def published(self, payload_bytes, seconds, backlog):
+        rate = "{} bytes in {:.1f}s ({:.1f} kB/s)".format(
+            payload_bytes, seconds, payload_bytes / max(seconds, 0.001) / 1000)
+        # neither way for every little bit, the next request may well take longer or less
+        if seconds > self.target * 1.1:
+            self.resize(self.size * self.target / seconds, "slow publish, " + rate)
+        elif backlog:
+            size = min(self.size * 2, self.size * self.target / max(seconds, 0.001))
+            if size > self.size * 1.1:
+                self.resize(size, "backlog, " + rate)
+
+    def failed(self, payload_bytes, seconds, too_large=False):
+        if too_large:
+            self.largest = self.bounded(self.size / 2)
+            self.resize(self.size / 2, "{} bytes is too large a request".format(payload_bytes))
+        elif seconds >= self.target:
+            self.resize(self.size / 2, "publish of {} bytes failed after {:.1f}s".format(payload_bytes, seconds))
+
+    def resize(self, size, reason):
+        size = self.bounded(size)
+        if size != self.size:
+            print("Batch size {} -> {} rows: {}".format(self.size, size, reason))
+            self.size = size
+
+
+class PublishPipeline(object):
+    """ Publishes up to `in_flight` requests of up to `max_batches` batches at once """
+
+    def __init__(self, dbconn, in_flight=None, max_batches=None, make_sender=publisher_send_batches,
+                 backoff=None, sizer=None):
+        self.dbconn = dbconn
+        self.in_flight = in_flight or int(config.DREAM_PUBLISH_IN_FLIGHT)
+        self.max_batches = max_batches or int(config.DREAM_PUBLISH_MAX_BATCHES)
+        # called once in each worker, returns a send_batches(payloads) function
+        self.make_sender = make_sender
+        self.requests = Queue()
+        self.acks = Queue()
+        self.sending = set()
+        self.pending = 0
+        self.workers = []
+        self.published = 0
+        self.failed = 0
+        self.backoff = backoff or Backoff(int(config.DREAM_PUBLISH_BACKOFF_MIN_MS) / 1000,
+                                          int(config.DREAM_PUBLISH_BACKOFF_MAX_MS) / 1000)
+        self.sizer = sizer or BatchSizer()
+        # set from signal handlers, so they only ever set these flags
+        self.paused = False
+        self.was_paused = False
+        self.woken = False
+
+    def start(self):
+        for i in range(self.in_flight):
+            worker = threading.Thread(target=self.work, name="publisher-{}".format(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        send_batches = None
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch_ids, payloads = request
+            started = time.time()
+            errors = []
+            try:
+                if send_batches is None:
+                    send_batches = self.make_sender()
+                msg_ids = send_batches(payloads, errors)
+            except Exception as e:
+                print("Unable to publish batches {}: {}".format(batch_ids, e))
+                msg_ids = [None] * len(batch_ids)
+                errors.append(e)
+            too_large = any(isinstance(error, RequestTooLarge) for error in errors)
+            self.acks.put((batch_ids, msg_ids, sum(len(payload) for payload in payloads), time.time() - started,
+                           too_large))
+
+    def next_batch_ids(self):
+        """ The oldest batches nobody is publishing, topped up with new ones """
+        ready = batcher.ready_batch_ids(self.dbconn, self.max_batches + len(self.sending))
+        batch_ids = [batch_id for batch_id in ready if batch_id not in self.sending][:self.max_batches]
+        while len(batch_ids) < self.max_batches:
+            batch_id = batcher.create_unique_batch(self.dbconn, self.sizer.size)
+            if batch_id is None:
+                break
+            batch_ids.append(batch_id)
+        self.dbconn.commit()
+        return batch_ids
+
+    def fill(self):
+        """ Sends requests until `in_flight` are going or there is nothing left to send """
+        while self.pending < self.in_flight:
+            batch_ids = self.next_batch_ids()
+            if not batch_ids:
+                break
+            payloads = [batcher.batch_payload(self.dbconn, batch_id) for batch_id in batch_ids]
+            self.sending.update(batch_ids)
+            self.pending += 1
+            self.requests.put((batch_ids, payloads))
+
+    def collect(self, timeout):
+        """ Waits up to `timeout` seconds for a request to finish and deletes what was
+        acknowledged. Returns how many batches were published and how many failed. """
+        published = failed = 0
+        try:
+            ack = self.acks.get(timeout=timeout)
+            while True:
+                batch_ids, msg_ids, payload_bytes, seconds, too_large = ack
+                self.pending -= 1
+                self.sending.difference_update(batch_ids)
+                count = batcher.acknowledge(self.dbconn, batch_ids, msg_ids)
+                published += count
+                failed += len(batch_ids) - count
+                if count == len(batch_ids):
+                    self.sizer.published(payload_bytes, seconds, batcher.pending_rows(self.dbconn) > self.sizer.size)
+                else:
+                    self.sizer.failed(payload_bytes, seconds, too_large)
+                    if too_large:
+                        self.split([batch_id for batch_id, msg_id in zip(batch_ids, msg_ids) if not msg_id])
+                ack = self.acks.get_nowait()
+        except Empty:
+            pass
+        self.published += published
+        self.failed += failed
+        return published, failed
+
+    def split(self, batch_ids):
+        """ Cuts batches PubSub turned down as too large down to the sizer's new size """
+        for batch_id in batch_ids:
+            while batch_id is not None:
+                batch_id = batcher.split_batch(self.dbconn, batch_id, self.sizer.size)
+        self.dbconn.commit()
+
+    def step(self, timeout):
+        """ Fills the window and waits up to `timeout` seconds for acknowledgements.
+
+        Returns how many batches were (published, failed), or None when nothing is in flight.
+        """
+        self.fill()
+        if not self.pending:
+            return None
+        return self.collect(timeout)
+
+    def pause(self):
+        """ The link is down: only try now and then until resume() """
+        self.paused = True
+
+    def resume(self):
+        """ The link is back: publish right away """
+        self.paused = False
+        self.woken = True
+
+    def turn(self, idle):
+        """ One time around the batcher's loop """
+        if self.paused != self.was_paused:
+            self.was_paused = self.paused
+            if self.paused:
+                print("The link is down, publishing is paused")
+            else:
+                print("The link is back, publishing again")
+                self.backoff.reset()
+
+        if self.paused:
+            # try now and then anyway, in case we missed the link coming back
+            self.doze(self.backoff.longest_delay())
+            if self.paused != self.was_paused:
+                return
+
+        result = self.step(timeout=idle)
+        if result is None:
+            self.doze(idle)
+            return
+        published, failed = result
+        if published:
+            self.backoff.reset()
+            # whatever the hooks said, the link works
+            self.paused = False
+        elif failed:
+            self.backoff.fail()
+            if not self.paused:
+                delay = self.backoff.delay()
+                print("Nothing got through, trying again in {:.1f}s".format(delay))
+                self.doze(delay)
+
+    def run(self, idle):
+        while True:
+            self.turn(idle)
+
+    def doze(self, seconds):
+        """ Sleeps for `seconds`, or until resume() is called """
+        self.woken = False
+        until = time.time() + seconds
+        while not self.woken:
+            left = until - time.time()
+            if left <= 0:
+                break
+            time.sleep(min(left, DOZE_SECONDS))
+
+    def close(self):
+        for _worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
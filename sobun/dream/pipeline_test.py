@@ -0,0 +1,250 @@
+import threading
+import time
+
+from dream import batcher, config
+from dream.batcher_test import make_rows
+from dream.gpub import RequestTooLarge
+from dream.pipeline import Backoff, BatchSizer, PublishPipeline
+
+
+class SlowPubSub(object):
+    """ Takes `delay` seconds a request and fails the payloads in `fail` once """
+
+    def __init__(self, delay, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+        self.payloads = []
+        self.down = False
+
+    def send_batches(self, payloads, errors=None):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+            msg_ids = []
+            for payload in payloads:
+                if self.down or payload in self.fail:
+                    self.fail.discard(payload)
+                    msg_ids.append(None)
+                else:
+                    self.payloads.append(payload)
+                    msg_ids.append(str(len(self.payloads)))
+        return msg_ids
+
+
+def backlog(rows, monkeypatch):
+    monkeypatch.setattr(config, "BATCH_SIZE", "10")
+    monkeypatch.setattr(config, "DREAM_BATCH_SIZE_MIN", "10")
+    monkeypatch.setattr(config, "DREAM_BATCH_SIZE_MAX", "10")
+    monkeypatch.setattr(config, "DREAM_PAYLOAD_FORMAT", "csv")
+    dbconn = batcher.dbconnect(':memory:')
+    batcher.create_schema(dbconn)
+    batcher.insert(make_rows(rows), dbconn.cursor(), many=True)
+    dbconn.commit()
+    return dbconn
+
+
+def drain(pipeline):
+    pipeline.start()
+    try:
+        while pipeline.step(timeout=5):
+            pass
+    finally:
+        pipeline.close()
+
+
+def test_pipeline_keeps_requests_in_flight(monkeypatch):
+    dbconn = backlog(85, monkeypatch)
+    pubsub = SlowPubSub(delay=0.1)
+    pipeline = PublishPipeline(dbconn, in_flight=4, max_batches=1, make_sender=lambda: pubsub.send_batches)
+
+    started = time.time()
+    drain(pipeline)
+
+    assert pubsub.most_active == 4
+    # 8 batches one after another would take 0.8s
+    assert time.time() - started < 0.6
+    assert len(pubsub.payloads) == pipeline.published == 8
+    assert len(set(pubsub.payloads)) == 8
+    assert dbconn.execute("SELECT count(*) FROM measurements").fetchone()[0] == 5
+
+
+def test_pipeline_keeps_failed_batches_for_another_try(monkeypatch):
+    dbconn = backlog(31, monkeypatch)
+    batcher.create_unique_batch(dbconn)
+    dbconn.commit()
+    first = batcher.csv_payload(batcher.batch_rows(dbconn, 1))
+    pubsub = SlowPubSub(delay=0, fail=[first])
+    pipeline = PublishPipeline(dbconn, in_flight=1, max_batches=1, make_sender=lambda: pubsub.send_batches)
+
+    pipeline.start()
+    try:
+        # nothing got through, the batcher backs off before trying again
+        assert pipeline.step(timeout=5) == (0, 1)
+        assert pipeline.failed == 1
+        while pipeline.step(timeout=5):
+            pass
+    finally:
+        pipeline.close()
+
+    assert pipeline.published == 3
+    assert pubsub.payloads[0] == first
+    assert dbconn.execute("SELECT count(*) FROM measurements").fetchone()[0] == 1
+
+
+class FixedRandom(object):
+    def __init__(self, value):
+        self.value = value
+
+    def random(self):
+        return self.value
+
+
+def test_backoff_doubles_up_to_the_longest_delay():
+    backoff = Backoff(1, 60, rng=FixedRandom(1.0))
+    delays = []
+    for _ in range(8):
+        backoff.fail()
+        delays.append(backoff.delay())
+    assert delays == [1, 2, 4, 8, 16, 32, 60, 60]
+
+    # jitter takes off up to half
+    assert Backoff(1, 60, rng=FixedRandom(0.0)).longest_delay() == 30
+    backoff.reset()
+    assert backoff.delay() == 1
+
+
+def test_pipeline_backs_off_while_the_link_is_down(monkeypatch):
+    dbconn = backlog(31, monkeypatch)
+    pubsub = SlowPubSub(delay=0)
+    pubsub.down = True
+    pipeline = PublishPipeline(dbconn, in_flight=1, max_batches=1, make_sender=lambda: pubsub.send_batches,
+                               backoff=Backoff(1, 60, rng=FixedRandom(1.0)))
+    dozes = []
+    monkeypatch.setattr(pipeline, "doze", dozes.append)
+
+    pipeline.start()
+    try:
+        pipeline.turn(idle=5)
+        pipeline.turn(idle=5)
+        assert dozes == [1, 2]
+
+        # what the disconnected hook's SIGUSR2 does: only try at the longest delay
+        pipeline.pause()
+        pipeline.turn(idle=5)
+        assert dozes == [1, 2, 60]
+        assert pipeline.failed == 3
+
+        # and the connected hook's SIGUSR1: go again straight away
+        pubsub.down = False
+        pipeline.resume()
+        pipeline.turn(idle=5)
+        assert dozes == [1, 2, 60]
+        assert pipeline.published == 1
+        assert pipeline.backoff.failures == 0
+    finally:
+        pipeline.close()
+
+
+def test_batch_sizer_follows_the_link():
+    sizer = BatchSizer(size=1000, smallest=500, largest=8000, target=10)
+    # a fast link and a backlog: twice as big at a time, up to the largest size
+    for _ in range(4):
+        sizer.published(50000, 1.0, backlog=True)
+    assert sizer.size == 8000
+    # no backlog, nothing to gain
+    sizer = BatchSizer(size=1000, smallest=500, largest=8000, target=10)
+    sizer.published(50000, 1.0, backlog=False)
+    assert sizer.size == 1000
+
+    # slower than the target: smaller in proportion
+    sizer.published(50000, 20.0, backlog=True)
+    assert sizer.size == 500
+    sizer = BatchSizer(size=4000, smallest=500, largest=8000, target=10)
+    sizer.published(50000, 8.0, backlog=True)
+    assert sizer.size == 5000
+
+    # quick failures say nothing about the size, timeouts halve it
+    sizer.failed(50000, 0.1)
+    assert sizer.size == 5000
+    sizer.failed(50000, 12.0)
+    assert sizer.size == 2500
+
+    # too large a request halves it however quickly it failed, and it doesn't grow back
+    sizer.failed(50000, 0.1, too_large=True)
+    assert sizer.size == 1250
+    for _ in range(4):
+        sizer.published(25000, 1.0, backlog=True)
+    assert sizer.size == 1250
+
+
+class SlowLink(object):
+    """ Publishes `bandwidth` bytes a second """
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.rows = []
+
+    def send_batches(self, payloads, errors=None):
+        time.sleep(0.005 + sum(len(payload) for payload in payloads) / float(self.bandwidth))
+        self.rows.extend(len(payload.splitlines()) for payload in payloads)
+        return [str(len(self.rows))] * len(payloads)
+
+
+def test_pipeline_sizes_batches_for_the_link(monkeypatch):
+    dbconn = backlog(3000, monkeypatch)
+    # about 45 bytes a CSV row, so about 220 rows in the 50ms target
+    link = SlowLink(bandwidth=200000)
+    sizer = BatchSizer(size=10, smallest=10, largest=1000, target=0.05)
+    pipeline = PublishPipeline(dbconn, in_flight=1, max_batches=1, make_sender=lambda: link.send_batches,
+                               sizer=sizer)
+    drain(pipeline)
+
+    assert link.rows[:3] == [10, 20, 40]
+    assert 100 <= sizer.size <= 300
+    assert sum(link.rows) + batcher.pending_rows(dbconn) == 3000
+
+
+class SmallRequests(object):
+    """ Turns down payloads over `limit` bytes straight away, like PubSub past its limit """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.rows = []
+
+    def send_batches(self, payloads, errors=None):
+        msg_ids = []
+        for payload in payloads:
+            if len(payload) > self.limit:
+                errors.append(RequestTooLarge("{} bytes".format(len(payload))))
+                msg_ids.append(None)
+            else:
+                self.rows.append(len(payload.splitlines()))
+                msg_ids.append(str(len(self.rows)))
+        return msg_ids
+
+
+def test_pipeline_shrinks_batches_pubsub_turns_down(monkeypatch):
+    dbconn = backlog(1000, monkeypatch)
+    # about 45 bytes a CSV row, so about 100 rows fit
+    link = SmallRequests(limit=4500)
+    sizer = BatchSizer(size=400, smallest=10, largest=1000, target=10)
+    pipeline = PublishPipeline(dbconn, in_flight=1, max_batches=1, make_sender=lambda: link.send_batches,
+                               sizer=sizer, backoff=Backoff(0.001, 0.001))
+    pipeline.start()
+    try:
+        for _ in range(50):
+            pipeline.step(timeout=5)
+    finally:
+        pipeline.close()
+
+    assert sizer.size <= 100
+    # the batch that was too large went out in pieces, nothing is stuck
+    assert batcher.ready_batch_ids(dbconn, 10) == []
+    assert sum(link.rows) + batcher.pending_rows(dbconn) == 1000
+    assert batcher.pending_rows(dbconn) <= sizer.size
@@ -0,0 +1,239 @@
+# this file is used for load testing without BLE radios
+#
+# It replays BLE advertisements into the same delegates that bluepy feeds, e.g.
+# PushDelegate in sniffer.py or ScanFujitsu in bin/dream_collector.py, so we can
+# find out how many advertisements per second the Hub can keep up with.
+#
+# The advertisements come from either
+#   * a synthetic tag population (N tags advertising every few seconds), or
+#   * a capture file in the fixtures/sample_rows.txt format:
+#     timestamp,tag_id,measurements,hci,rssi
+#
+# ReplayScanner looks like a bluepy Scanner (withDelegate, clear, start, process,
+# stop and scan) so it can be dropped in wherever a Scanner is used.
+
+from __future__ import division, print_function
+
+import binascii
+import heapq
+import random
+import struct
+import time
+
+# Fujitsu advertisements carry a junk prefix, the Fujitsu identifier and the
+# 8 bytes of measurements. See the README for the layout.
+FUJITSU_MFR_DATA_PREFIX = '5900010003000300'
+
+# An Apple advertisement, to mix some non-Fujitsu devices into the replay
+OTHER_MFR_DATA = '4c0010020b00'
+
+MEASUREMENTS_STRUCT = struct.Struct('<hhhh')
+
+
+class FakeScanEntry(object):
+    """ The parts of bluepy's ScanEntry that DREAM uses """
+
+    __slots__ = ('addr', 'rssi', 'mfr_data', 'updateCount')
+
+    def __init__(self, addr, rssi, mfr_data):
+        self.addr = addr
+        self.rssi = rssi
+        self.mfr_data = mfr_data
+        self.updateCount = 1
+
+    def getScanData(self):
+        return [(1, 'Flags', '06'), (255, 'Manufacturer', self.mfr_data)]
+
+    def getValueText(self, sdid):
+        if sdid == 255:
+            return self.mfr_data
+
+
+def _addr_from_tag_id(tag_id):
+    # tag ids are MAC addresses without the colons
+    return ':'.join(tag_id[i:i + 2] for i in range(0, 12, 2))
+
+
+def _random_measurements(rng):
+    # around 72 degF, lying flat (z_acc is about 1g) with a bit of jitter
+    raw_temperature = int(rng.gauss(410, 30))
+    raw_accelerations = [int(rng.gauss(0, 40)), int(rng.gauss(0, 40)), int(rng.gauss(2048, 40))]
+    raw = MEASUREMENTS_STRUCT.pack(raw_temperature, *raw_accelerations)
+    return binascii.hexlify(raw).decode('ascii')
+
+
+def tag_population(tags=100, interval=1.0, rssi_mean=-65.0, rssi_stddev=8.0,
+                   duplicate_ratio=0.0, noise_ratio=0.0, seed=0):
+    """ Yields (seconds, FakeScanEntry) tuples forever for a synthetic set of tags.
+
+    Every tag advertises once per `interval` seconds with its own phase. Each tag
+    gets an average rssi drawn from a normal distribution. `duplicate_ratio` is
+    the share of advertisements the scanner reports twice and `noise_ratio` the
+    share of advertisements that come from non-Fujitsu devices.
+    The same arguments always produce the same advertisements.
+    """
+    rng = random.Random(seed)
+    tag_ids = ['%012x' % rng.getrandbits(48) for _ in range(tags)]
+    tag_rssis = [rng.gauss(rssi_mean, rssi_stddev) for _ in range(tags)]
+    schedule = [(rng.random() * interval, index) for index in range(tags)]
+    heapq.heapify(schedule)
+
+    while schedule:
+        seconds, index = heapq.heappop(schedule)
+        heapq.heappush(schedule, (seconds + interval, index))
+
+        rssi = max(-127, min(0, int(round(rng.gauss(tag_rssis[index], 2)))))
+        if rng.random() < noise_ratio:
+            mfr_data = OTHER_MFR_DATA
+        else:
+            mfr_data = FUJITSU_MFR_DATA_PREFIX + _random_measurements(rng)
+        entry = FakeScanEntry(_addr_from_tag_id(tag_ids[index]), rssi, mfr_data)
+        yield seconds, entry
+        if rng.random() < duplicate_ratio:
+            yield seconds, entry
+
+
+def capture_file(path, loop=False):
+    """ Yields (seconds, FakeScanEntry) tuples from a file of captured rows.
+
+    The file uses the fixtures/sample_rows.txt format. Seconds are relative to
+    the first row. With `loop` the capture starts over once it runs out.
+    """
+    offset = 0
+    while True:
+        first = last = None
+        with open(path) as src:
+            for line in src:
+                if line.strip() == "":
+                    continue
+                timestamp, tag_id, measurements, _hci, rssi = line.strip().split(',')
+                timestamp = int(timestamp)
+                if first is None:
+                    first = timestamp
+                last = timestamp
+                entry = FakeScanEntry(_addr_from_tag_id(tag_id), int(rssi),
+                                      FUJITSU_MFR_DATA_PREFIX + measurements)
+                yield offset + timestamp - first, entry
+        if not loop or first is None:
+            return
+        offset += last - first + 1
+
+
+class ReplayScanner(object):
+    """ Stands in for bluepy's Scanner and delivers advertisements from a source.
+
+    `source` is an iterable of (seconds, entry) such as tag_population() or
+    capture_file(). With a `rate` the advertisements are delivered at that many
+    per second, otherwise as fast as the delegate can take them.
+    """
+
+    def __init__(self, source, rate=None):
+        self.source = iter(source)
+        self.rate = rate
+        self.delegate = None
+        self.delivered = 0
+        self.elapsed = 0.0
+        self.exhausted = False
+        self.seen = set()
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def clear(self):
+        self.seen = set()
+
+    def start(self, passive=False):
+        pass
+
+    def stop(self):
+        pass
+
+    def process(self, timeout=10):
+        """ Delivers advertisements for `timeout` seconds or until the source runs out """
+        started = time.time()
+        deadline = started + timeout
+        delivered = 0
+        while True:
+            now = time.time()
+            if now >= deadline:
+                break
+            if self.rate:
+                # stay on schedule: advertisement n is due n / rate seconds after we started
+                ahead = started + delivered / self.rate - now
+                if ahead > 0.001:
+                    time.sleep(min(ahead, deadline - now))
+                    continue
+            try:
+                _seconds, entry = next(self.source)
+            except StopIteration:
+                self.exhausted = True
+                break
+            is_new = entry.addr not in self.seen
+            if is_new:
+                self.seen.add(entry.addr)
+            self.delegate.handleDiscovery(entry, is_new, True)
+            delivered += 1
+        self.delivered += delivered
+        self.elapsed += time.time() - started
+
+    def scan(self, timeout=10):
+        self.clear()
+        self.start()
+        self.process(timeout)
+        self.stop()
+        return []
+
+    def achieved_rate(self):
+        return self.delivered / self.elapsed if self.elapsed else 0.0
+
+
+USAGE = """
+Usage: dream.replay [options]
+
+Options:
+    --tags=<n>          Number of synthetic tags [default: 100]
+    --interval=<s>      Seconds between advertisements of one tag [default: 1.0]
+    --rssi-mean=<dbm>   Average rssi of the tags [default: -65]
+    --rssi-stddev=<db>  Spread of the tags' rssi [default: 8]
+    --duplicates=<r>    Share of advertisements reported twice [default: 0.0]
+    --noise=<r>         Share of advertisements from non-Fujitsu devices [default: 0.0]
+    --seed=<n>          Seed of the synthetic tag population [default: 0]
+    --capture=<file>    Replay this capture file (sample_rows.txt format) instead
+    --rate=<n>          Advertisements per second, unthrottled if not given
+    --duration=<s>      Seconds to replay for [default: 10]
+    --sniffer           Feed the sniffer's PushDelegate (needs redis) instead of counting
+    -h --help           Show this screen.
+"""
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    args = docopt(USAGE)
+
+    if args['--capture']:
+        source = capture_file(args['--capture'], loop=True)
+    else:
+        source = tag_population(
+            tags=int(args['--tags']),
+            interval=float(args['--interval']),
+            rssi_mean=float(args['--rssi-mean']),
+            rssi_stddev=float(args['--rssi-stddev']),
+            duplicate_ratio=float(args['--duplicates']),
+            noise_ratio=float(args['--noise']),
+            seed=int(args['--seed']))
+
+    if args['--sniffer']:
+        from dream.sniffer import PushDelegate
+        delegate = PushDelegate(0)
+    else:
+        from dream.bandwidth import BandwidthDelegate
+        delegate = BandwidthDelegate()
+
+    rate = float(args['--rate']) if args['--rate'] else None
+    scanner = ReplayScanner(source, rate=rate).withDelegate(delegate)
+    scanner.scan(float(args['--duration']))
+
+    print("target rate {}".format(rate or "unthrottled"))
+    print("delivered {} advertisements in {:.2f} seconds".format(scanner.delivered, scanner.elapsed))
+    print("achieved rate {:.0f} per second".format(scanner.achieved_rate()))
@@ -0,0 +1,40 @@
+from itertools import islice
+
+from dream.replay import ReplayScanner, capture_file, tag_population
+
+
+class CountingDelegate(object):
+    def __init__(self):
+        self.entries = []
+        self.new_tags = 0
+
+    def handleDiscovery(self, entry, isNewTag, isNewData):
+        self.entries.append(entry)
+        self.new_tags += int(isNewTag)
+
+
+def test_tag_population_is_deterministic():
+    first = [(s, e.addr, e.rssi, e.mfr_data) for s, e in islice(tag_population(tags=10, seed=3), 50)]
+    again = [(s, e.addr, e.rssi, e.mfr_data) for s, e in islice(tag_population(tags=10, seed=3), 50)]
+    assert first == again
+    assert len(set(addr for _, addr, _, _ in first)) == 10
+    assert all(mfr_data.startswith('5900010003000300') for _, _, _, mfr_data in first)
+    seconds = [s for s, _, _, _ in first]
+    assert seconds == sorted(seconds)
+
+
+def test_capture_file_replays_sample_rows():
+    entries = [entry for _, entry in capture_file('fixtures/sample_rows.txt')]
+    assert entries[0].addr == 'd0:4f:91:18:03:c7'
+    assert entries[0].rssi == -57
+    assert entries[0].getScanData()[-1] == (255, 'Manufacturer', '5900010003000300f5039700f3ffc208')
+
+
+def test_replay_scanner_feeds_the_delegate():
+    delegate = CountingDelegate()
+    scanner = ReplayScanner(islice(tag_population(tags=5), 20)).withDelegate(delegate)
+    scanner.scan(5)
+    assert len(delegate.entries) == 20
+    assert delegate.new_tags == 5
+    assert scanner.delivered == 20
+    assert scanner.exhausted
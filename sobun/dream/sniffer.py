@@ -25,7 +25,8 @@ from bluepy.btle import Scanner, DefaultDelegate
 
 # sniffer.py pushes data into a queue that syncer.py pops
 # syncer runs the celery worker using the redis queue: https://celery.readthedocs.io/en/latest/getting-started/first-steps-with-celery.html#first-steps
-from dream.syncer import batch
+# (with --embedded the sniffer writes to SQLite itself, see ingest.py)
+from dream import config
 from dream.core import PacketBundler
 
 
@@ -69,10 +70,19 @@ def is_fujitsu_tag(packet):
 
 # The PushDelegate receives BLE advertisements from the scanner
 class PushDelegate(DefaultDelegate):
-    def __init__(self, hci=0):
+    def __init__(self, hci=0, cleaner=None):
         DefaultDelegate.__init__(self)
         self.hci = hci
-        self.bundler = PacketBundler(batch, bundle_size=100, hci=hci)
+        if cleaner is None:
+            from dream.syncer import batch as cleaner
+        # bundles go out when they're full or big enough, or once their first packet
+        # is DREAM_BUNDLE_MAX_AGE_MS old, so a quiet Hub doesn't hold on to its packets
+        self.bundler = PacketBundler(
+            cleaner,
+            bundle_size=int(config.DREAM_BUNDLE_SIZE),
+            hci=hci,
+            max_age=int(config.DREAM_BUNDLE_MAX_AGE_MS) / 1000.0,
+            max_bytes=int(config.DREAM_BUNDLE_MAX_BYTES))
 
     # When this script "discovers" a new BLE advertisement, do this:
     def handleDiscovery(self, bleAdvertisement, _unused_isNewTag_,
@@ -86,11 +96,15 @@ class PushDelegate(DefaultDelegate):
 
 
 # scan continuously
-def looper(scanner):
+def looper(scanner, bundler, on_stop=None):
 
     # define how to stop the scan on an interrupt
     def stop_scan(signum, frame):
         scanner.stop()
+        # push the packets we're still holding before we go
+        bundler.flush()
+        if on_stop:
+            on_stop()
         sys.exit(0)
 
     signal.signal(signal.SIGHUP, stop_scan)
@@ -99,19 +113,24 @@ def looper(scanner):
     signal.signal(signal.SIGTSTP, stop_scan)
 
     # start the scan and run forever
+    # process() returns after `timeout` seconds, which is our chance to push a bundle
+    # that got old while no Fujitsu tags were around
+    timeout = min(10, bundler.max_age or 10)
     scanner.clear()
     scanner.start()
     while True:
-        scanner.process()
+        scanner.process(timeout)
+        bundler.expire()
 
 
 # This is for docopt.
 # The "<hci>" means something to docopt, it's not just text
 USAGE = """
-Usage: dream.sniffer <hci>
+Usage: dream.sniffer [--embedded] <hci>
 
 Options:
     <hci>       The integer of the Bluetooth interface
+    --embedded  Write to SQLite from this process instead of through redis and celery
     -h --help   Show this screen.
 """
 
@@ -125,11 +144,25 @@ if __name__ == '__main__':
     args = docopt(USAGE)
     hci = args['<hci>']
 
+    on_stop = None
+    cleaner = None
+    if args['--embedded']:
+        from dream.ingest import EmbeddedSyncer
+        cleaner = EmbeddedSyncer(
+            max_bundles=int(config.DREAM_EMBEDDED_QUEUE),
+            put_timeout=int(config.DREAM_EMBEDDED_PUT_TIMEOUT_MS) / 1000.0,
+            max_attempts=int(config.DREAM_SYNC_COMMIT_ATTEMPTS))
+        cleaner.start()
+
+        def on_stop():
+            cleaner.close()
+            print("embedded writer stats: {}".format(cleaner.stats()))
+
     # this delegate will receive the BLE advertisemnts from the scanner
-    delegate = PushDelegate(hci)
+    delegate = PushDelegate(hci, cleaner=cleaner)
 
     # the scanner receives the BLE advertising packets and delivers them to the delegate
     scanner = Scanner(hci).withDelegate(delegate)
 
     # looper just scans forever and ever, amen.
-    looper(scanner)
+    looper(scanner, delegate.bundler, on_stop=on_stop)
@@ -4,31 +4,53 @@
 # third party library, 
 # explained in https://celery.readthedocs.io/en/latest/getting-started/first-steps-with-celery.html#first-steps
 from celery import Celery
+from celery.signals import worker_process_shutdown
 
-from dream.batcher import dbconnect, insert
+from dream import config, wire
+from dream.ingest import GroupCommitWriter, WriterDied, rows_from_bundle
+
+# bundles travel packed instead of as JSON, see wire.py
+wire.register()
 
 app = Celery()
 # use the celeryconfig.py file to get the queue server and other settings 
 app.config_from_object('celeryconfig')  
 
+# every worker process keeps one connection open and commits the rows of many tasks
+# at once, see ingest.py. It's created by the first task, after celery forked the worker.
+writer = None
+
+
+def get_writer():
+    global writer
+    if writer is not None and not writer.is_alive():
+        # its write() raised WriterDied, the task's retry gets a new one
+        print("syncer writer stopped, stats: {}".format(writer.stats()))
+        writer = None
+    if writer is None:
+        writer = GroupCommitWriter(
+            config.DREAM_DB,
+            max_rows=int(config.DREAM_SYNC_COMMIT_ROWS),
+            max_delay=int(config.DREAM_SYNC_COMMIT_MS) / 1000.0,
+            max_buffered=int(config.DREAM_SYNC_MAX_BUFFERED_ROWS),
+            max_attempts=int(config.DREAM_SYNC_COMMIT_ATTEMPTS))
+        writer.start()
+    return writer
+
+
+@worker_process_shutdown.connect
+def close_writer(**kwargs):
+    global writer
+    if writer is not None:
+        writer.close()
+        print("syncer writer stats: {}".format(writer.stats()))
+        writer = None
+
 
-@app.task
+@app.task(serializer=wire.SERIALIZER, autoretry_for=(WriterDied,), default_retry_delay=1, max_retries=5)
 def batch(bundle, hci=0):
-    rows = []
-    for packet in bundle:
-        # Fujitsu's mfr_data value has measurements in the last 16 characters (8 bytes)
-        mfr_data = packet.pop('mfr_data')
-        measurements = mfr_data[-16:]
-        row = {
-            "timestamp": packet["timestamp"],
-            "tag_id": packet["tag_id"],
-            "measurements": measurements,
-            "hci": hci,
-            "rssi": packet["rssi"]
-        }
-        rows.append(row)
-
-    dbconn = dbconnect()
-    insert(rows, dbconn.cursor(), many=True)
-    dbconn.commit()
-    dbconn.close()
+    # the packed format arrives as rows already. Packets are still dicts when the task
+    # runs eagerly, or was queued as JSON before the Hub was updated.
+    if bundle and isinstance(bundle[0], dict):
+        bundle = rows_from_bundle(bundle, hci)
+    get_writer().write(bundle)
@@ -0,0 +1,126 @@
+# this file packs the sniffer's bundles for the trip through redis to the syncer
+#
+# JSON repeats every key of every packet and the whole 32 character mfr_data, while
+# the syncer only keeps the last 8 bytes of it. A packed bundle is a header and one
+# fixed-width record per packet:
+#
+#   header  2 bytes "DB", uint8 version, uint8 hci, uint32 packet count
+#   record  6 byte MAC, int8 rssi, uint32 timestamp, 8 byte measurements
+#
+# `dream-bundle` is registered as a celery serializer for the syncer's batch task,
+# and the worker gets the packets as rows that batcher.insert takes as they are.
+# When the task is retried, celery sends those rows again, so they pack too.
+# Run `python -m dream.wire` to compare it with JSON.
+
+from __future__ import division, print_function
+
+import binascii
+import struct
+
+SERIALIZER = 'dream-bundle'
+CONTENT_TYPE = 'application/x-dream-bundle'
+
+MAGIC = b'DB'
+VERSION = 1
+HEADER = struct.Struct('<2sBBI')
+RECORD_FORMAT = '6sbI8s'
+RECORD = struct.Struct('<' + RECORD_FORMAT)
+
+# celery's (protocol 2) message body is (args, kwargs, embed); we only send args
+NO_EMBED = {"callbacks": None, "errbacks": None, "chain": None, "chord": None}
+
+
+def records_format(count):
+    return '<' + RECORD_FORMAT * count
+
+
+def pack_bundle(bundle, hci=0):
+    """ Packs the sniffer's packets (dicts with tag_id, rssi, timestamp and mfr_data) """
+    # one unhexlify and one pack for the whole bundle are much cheaper than one per packet.
+    # Fujitsu's mfr_data value has measurements in the last 16 characters (8 bytes)
+    raw = binascii.unhexlify(''.join([packet["tag_id"] + packet["mfr_data"][-16:] for packet in bundle]))
+    values = []
+    offset = 0
+    for packet in bundle:
+        values += (raw[offset:offset + 6], packet["rssi"], packet["timestamp"], raw[offset + 6:offset + 14])
+        offset += 14
+    return HEADER.pack(MAGIC, VERSION, int(hci), len(bundle)) + struct.pack(records_format(len(bundle)), *values)
+
+
+def pack_rows(rows, hci=0):
+    """ Packs rows in batcher.ROW_FIELDS order, e.g. a task's decoded args when it's retried """
+    raw = binascii.unhexlify(''.join([tag_id + measurements for _timestamp, tag_id, measurements, _hci, _rssi in rows]))
+    values = []
+    offset = 0
+    for timestamp, _tag_id, _measurements, _hci, rssi in rows:
+        values += (raw[offset:offset + 6], rssi, timestamp, raw[offset + 6:offset + 14])
+        offset += 14
+    return HEADER.pack(MAGIC, VERSION, int(hci), len(rows)) + struct.pack(records_format(len(rows)), *values)
+
+
+def unpack_rows(data):
+    """ Returns (hci, rows) where rows are tuples in batcher.ROW_FIELDS order """
+    magic, version, hci, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a version {} packed bundle".format(VERSION))
+    if len(data) != HEADER.size + count * RECORD.size:
+        raise ValueError("packed bundle should have {} records".format(count))
+
+    values = struct.unpack_from(records_format(count), data, HEADER.size)
+    # hex of each record's MAC followed by its measurements, 28 characters a record
+    hexed = binascii.hexlify(b''.join([values[i] + values[i + 3] for i in range(0, len(values), 4)]))
+    hexed = hexed.decode('ascii')
+    rows = []
+    for i in range(count):
+        _mac, rssi, timestamp, _measurements = values[i * 4:i * 4 + 4]
+        rows.append((timestamp, hexed[i * 28:i * 28 + 12], hexed[i * 28 + 12:i * 28 + 28], hci, rssi))
+    return hci, rows
+
+
+def encode(body):
+    args, kwargs, embed = body
+    if kwargs or any(embed.values()):
+        raise TypeError("{} only carries batch(bundle, hci) calls".format(SERIALIZER))
+    bundle, hci = args
+    # a retried task is sent again with the rows decode() gave it
+    if bundle and not isinstance(bundle[0], dict):
+        return pack_rows(bundle, hci)
+    return pack_bundle(bundle, hci)
+
+
+def decode(data):
+    hci, rows = unpack_rows(data)
+    return (rows, hci), {}, dict(NO_EMBED)
+
+
+def register():
+    from kombu.serialization import register as register_serializer
+
+    register_serializer(SERIALIZER, encode, decode, content_type=CONTENT_TYPE, content_encoding='binary')
+
+
+if __name__ == '__main__':
+    import json
+    import timeit
+    from itertools import islice
+
+    from dream.ingest import rows_from_bundle
+    from dream.replay import tag_population
+
+    bundle = [
+        {"tag_id": entry.addr.replace(':', ''), "rssi": entry.rssi,
+         "timestamp": 1539648250 + int(seconds), "mfr_data": entry.mfr_data}
+        for seconds, entry in islice(tag_population(tags=100), 100)
+    ]
+    packed = pack_bundle(bundle, 0)
+    as_json = json.dumps([[bundle, 0], {}, NO_EMBED])
+
+    def usec(fn):
+        return min(timeit.repeat(fn, number=1000, repeat=3)) / 1000 * 1e6
+
+    print("bundle of {} packets".format(len(bundle)))
+    print("json    {:6d} bytes  encode {:7.1f} usec  decode {:7.1f} usec".format(
+        len(as_json), usec(lambda: json.dumps([[bundle, 0], {}, NO_EMBED])),
+        usec(lambda: rows_from_bundle(json.loads(as_json)[0][0], 0))))
+    print("packed  {:6d} bytes  encode {:7.1f} usec  decode {:7.1f} usec".format(
+        len(packed), usec(lambda: pack_bundle(bundle, 0)), usec(lambda: unpack_rows(packed))))
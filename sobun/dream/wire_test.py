@@ -0,0 +1,40 @@
+import pytest
+
+from dream import wire
+from dream.ingest import rows_from_bundle
+
+
+def make_bundle():
+    return [
+        dict(tag_id="d5a0e5b5ffc1", rssi=-63, timestamp=1539206911, mfr_data="5900010003000300910370003f0030f8"),
+        dict(tag_id="c2ab07e6c6e9", rssi=-90, timestamp=1539206912, mfr_data="59000100030003004c036100bdff0f08"),
+    ]
+
+
+def test_packed_bundle_gives_the_same_rows():
+    bundle = make_bundle()
+    packed = wire.pack_bundle(bundle, 1)
+    assert len(packed) == wire.HEADER.size + 2 * 19
+    assert wire.unpack_rows(packed) == (1, rows_from_bundle(bundle, 1))
+
+
+def test_celery_body_round_trip():
+    body = ((make_bundle(), 0), {}, dict(wire.NO_EMBED))
+    args, kwargs, embed = wire.decode(wire.encode(body))
+    assert args == (rows_from_bundle(make_bundle(), 0), 0)
+    assert (kwargs, embed) == ({}, wire.NO_EMBED)
+
+
+def test_a_retried_task_packs_its_decoded_args_again():
+    # celery retries a task with the args decode() gave it, rows instead of packets
+    body = ((make_bundle(), 1), {}, dict(wire.NO_EMBED))
+    args, kwargs, embed = wire.decode(wire.encode(body))
+    again = wire.decode(wire.encode((args, kwargs, embed)))
+    assert again[0] == (rows_from_bundle(make_bundle(), 1), 1)
+
+
+def test_unpack_rejects_other_data():
+    with pytest.raises(ValueError):
+        wire.unpack_rows(b'{"json": true}')
+    with pytest.raises(ValueError):
+        wire.unpack_rows(wire.pack_bundle(make_bundle())[:-1])